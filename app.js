@@ -45,7 +45,8 @@ const ai = new GoogleGenAI(process.env.GEMINI_API_KEY);
 
 
 // --- Middleware ---
-app.use(express.json());
+// Image edits send the init image base64-encoded in the JSON body (uploads are capped at 10MB)
+app.use(express.json({ limit: "15mb" }));
 app.use(express.urlencoded({ extended: true }));
 app.use(cookieParser());
 
@@ -102,6 +103,82 @@ const upload = multer({
   limits: { fileSize: 10 * 1024 * 1024 }, // 10MB limit
 });
 
+// --- ML SCRIPT RUNNER ---
+// Python scripts report progress and their final result as JSON lines on a dedicated
+// pipe (fd 3, see ml_scripts/events.py), so stdout/stderr only need to be kept as a
+// bounded tail for error messages instead of being buffered in full.
+const MAX_SCRIPT_OUTPUT_CHARS = 16 * 1024;
+const jobProgress = new Map(); // contentId -> latest stage/progress reported by the script
+
+function appendTail(buffer, chunk) {
+  const combined = buffer + chunk;
+  return combined.length > MAX_SCRIPT_OUTPUT_CHARS
+    ? combined.slice(-MAX_SCRIPT_OUTPUT_CHARS)
+    : combined;
+}
+
+function recordJobEvent(contentId, evt) {
+  const progress = jobProgress.get(contentId) || { stage: null, step: null, total: null, warnings: [] };
+  if (evt.event === "stage_start") {
+    progress.stage = evt.stage;
+    progress.step = null;
+    progress.total = null;
+  } else if (evt.event === "progress") {
+    progress.stage = evt.stage;
+    progress.step = evt.step;
+    progress.total = evt.total;
+  } else if (evt.event === "warning") {
+    progress.warnings = [...progress.warnings, evt.message].slice(-10);
+  }
+  progress.updatedAt = new Date();
+  jobProgress.set(contentId, progress);
+}
+
+function spawnMlScript(args, contentId) {
+  const pythonProcess = spawn(PYTHON_EXE_PATH, args, {
+    stdio: ["pipe", "pipe", "pipe", "pipe"],
+    env: { ...process.env, ML_EVENTS_FD: "3" },
+  });
+  pythonProcess.resultEvent = null; // the script's single "result" record, once received
+  pythonProcess.errorEvent = null;
+
+  let pendingLine = "";
+  pythonProcess.stdio[3].setEncoding("utf8");
+  pythonProcess.stdio[3].on("data", (chunk) => {
+    const lines = (pendingLine + chunk).split("\n");
+    pendingLine = appendTail("", lines.pop());
+    for (const line of lines) {
+      if (!line.trim()) continue;
+      let evt;
+      try {
+        evt = JSON.parse(line);
+      } catch (err) {
+        console.error(`Ignoring malformed event line from ${path.basename(args[0])}: ${line.slice(0, 200)}`);
+        continue;
+      }
+      if (evt.event === "result") {
+        pythonProcess.resultEvent = evt;
+        // The output is durable once this arrives; the script may still be writing renditions
+        pythonProcess.emit("result", evt);
+      } else if (evt.event === "error") {
+        pythonProcess.errorEvent = evt;
+      } else if (evt.event === "rendition") {
+        // Compressed variants/thumbnail, written after the result was reported
+        pythonProcess.emit("rendition", evt);
+      } else if (contentId) {
+        recordJobEvent(contentId, evt);
+      }
+    }
+  });
+  pythonProcess.on("close", () => {
+    if (contentId) jobProgress.delete(contentId);
+  });
+  return pythonProcess;
+}
+
+// Quality tiers accepted by the ml_scripts (see ml_scripts/quality_tiers.py)
+const QUALITY_TIERS = ["draft", "standard", "max"];
+
 // --- NEW UTILITY AND DATA STRUCTURES FOR CONSISTENCY ---
 const CONSISTENCY_TAGS = {
     styles: ["oil painting", "watercolor", "3D render", "cinematic photo", "hyperrealistic", "anime style", "pixel art"],
@@ -236,8 +313,8 @@ app.post("/api/logout", (req, res) => {
 
 
 app.post("/api/generate/image", authenticateAPI, async (req, res) => {
-    // We expect the prompt only; seed is managed automatically here.
-    const { prompt } = req.body; 
+    // We expect the prompt (and optionally a quality tier and an init image to edit); seed is managed automatically here.
+    const { prompt, quality, base64Image } = req.body; 
     const userId = req.user.id;
     
     // Normalize the prompt to find the core subject key
@@ -279,58 +356,95 @@ app.post("/api/generate/image", authenticateAPI, async (req, res) => {
     });
 
     // 4. Start the asynchronous generation process
+    // With an init image, run image-to-image; the image bytes are streamed on stdin ("-")
+    // rather than passed as a (size-limited) command-line argument
     const pythonArgs = [
-        path.join(__dirname, "ml_scripts", "image_gen.py"),
+        path.join(__dirname, "ml_scripts", base64Image ? "img2img_gen.py" : "image_gen.py"),
         prompt,
         contentId,
         seedToUse || "random", // Pass the remembered seed or "random"
     ];
+    if (base64Image) {
+        pythonArgs.push("-");
+    }
+    // Optional quality tier: "draft" for quick previews, "max" (default) for final renders
+    if (QUALITY_TIERS.includes(quality)) {
+        pythonArgs.push("--quality", quality);
+    }
 
-    const pythonProcess = spawn(PYTHON_EXE_PATH, pythonArgs);
+    const pythonProcess = spawnMlScript(pythonArgs, contentId);
+    if (base64Image) {
+        pythonProcess.stdin.on("error", (err) => console.error(`Could not stream init image: ${err.message}`));
+        pythonProcess.stdin.end(Buffer.from(base64Image, "base64"));
+    } else {
+        pythonProcess.stdin.end();
+    }
     
     let outputResult = "";
     let errorOutput = "";
 
     pythonProcess.stdout.on('data', (data) => {
-        outputResult += data.toString().trim();
+        outputResult = appendTail(outputResult, data.toString().trim());
     });
     pythonProcess.stderr.on('data', (data) => {
-        errorOutput += data.toString();
+        errorOutput = appendTail(errorOutput, data.toString());
+    });
+
+    // Gallery thumbnails arrive as a separate event once the renditions are written
+    pythonProcess.on("rendition", (evt) => {
+        if (!evt.thumbnail) return;
+        GeneratedContent.findByIdAndUpdate(contentId, { thumbnailPath: evt.thumbnail }).catch((err) => {
+            console.error("Error saving thumbnail path:", err);
+        });
     });
 
 
-    // 5. Handle process completion (The Critical Step: Auto-Save Seed)
+    // 5. Mark the job completed (The Critical Step: Auto-Save Seed)
+    let completed = false;
+    async function completeImage(filePath, finalSeed) {
+        completed = true;
+        // A. Update the GeneratedContent entry
+        await GeneratedContent.findByIdAndUpdate(contentId, {
+            status: "completed",
+            filePath: filePath,
+            seed: finalSeed, // The final seed used by the model
+            updatedAt: new Date(),
+        });
+
+        // B. AUTOMATICALLY SAVE: Update the User's Map
+        // Fetch the user document again to ensure we don't overwrite concurrent changes
+        const userToUpdate = await User.findById(userId, 'promptSpecificSeeds');
+
+        if (userToUpdate) {
+             // Set the new seed for the core subject key
+             userToUpdate.promptSpecificSeeds.set(coreSubjectKey, String(finalSeed));
+             await userToUpdate.save();
+             console.log(`Image generated for ${userId}. Subject '${coreSubjectKey}' seed saved: ${finalSeed}`);
+        }
+    }
+
+    // As soon as the PNG is saved, not when the process exits after writing the renditions
+    pythonProcess.once("result", (evt) => {
+        completeImage(evt.path, String(evt.seed)).catch((err) => {
+            console.error("Error updating content document or user profile after result:", err);
+        });
+    });
+
+    // 6. Handle process exit: failures, and scripts that reported no result event
     pythonProcess.on('close', async (code) => {
+        if (completed) {
+            if (code !== 0) console.error(`Image script exited with code ${code} after its result: ${errorOutput}`);
+            return;
+        }
         try {
             if (code === 0) {
-                // ASSUMPTION: Python script returns data in the format "filepath:seed"
+                // Fallback: stdout in the format "filepath:seed"
                 const parts = outputResult.split(":");
-                
-                const finalSeed = parts.pop(); 
-                const filePath = parts.join(":"); 
-                
-                if (filePath && finalSeed && finalSeed.trim() !== '') {
-                    
-                    // A. Update the GeneratedContent entry
-                    await GeneratedContent.findByIdAndUpdate(contentId, {
-                        status: "completed",
-                        filePath: filePath,
-                        seed: finalSeed, // The final seed used by the model
-                        updatedAt: new Date(),
-                    });
-
-                    // B. AUTOMATICALLY SAVE: Update the User's Map
-                    // Fetch the user document again to ensure we don't overwrite concurrent changes
-                    const userToUpdate = await User.findById(userId, 'promptSpecificSeeds');
-
-                    if (userToUpdate) {
-                         // Set the new seed for the core subject key
-                         userToUpdate.promptSpecificSeeds.set(coreSubjectKey, String(finalSeed));
-                         await userToUpdate.save();
-                         console.log(`Image generated for ${userId}. Subject '${coreSubjectKey}' seed saved: ${finalSeed}`);
-                    }
-
+                const finalSeed = parts.pop();
+                const filePath = parts.join(":");
 
+                if (filePath && finalSeed && finalSeed.trim() !== '') {
+                    await completeImage(filePath, finalSeed);
                 } else {
                     // Handle case where output format is unexpected or incomplete
                     await GeneratedContent.findByIdAndUpdate(newContent._id, {
@@ -389,33 +503,50 @@ app.post("/api/generate/video/text", authenticateAPI, async (req, res) => {
       contentId: contentId,
     });
 
-  const pythonProcess = spawn(PYTHON_EXE_PATH, [
+  const pythonProcess = spawnMlScript([
     path.join(__dirname, "ml_scripts", "svd_video_gen.py"),
     prompt,
     contentId, // Pass contentId
-  ]);
+  ], contentId);
 
   let outputResult = "";
   let errorOutput = "";
 
   pythonProcess.stdout.on("data", (data) => {
-    outputResult += data.toString().trim();
+    outputResult = appendTail(outputResult, data.toString().trim());
   });
   pythonProcess.stderr.on("data", (data) => {
-    errorOutput += data.toString();
+    errorOutput = appendTail(errorOutput, data.toString());
+  });
+
+  let completed = false;
+  async function completeVideo(finalFilePath) {
+    completed = true;
+    await GeneratedContent.findByIdAndUpdate(contentId, {
+      filePath: finalFilePath,
+      status: "completed",
+      updatedAt: new Date(),
+    });
+    console.log(`Video generated for ${userId}: ${finalFilePath}`);
+  }
+
+  // Completed as soon as the result is reported, before the process has exited
+  pythonProcess.once("result", (evt) => {
+    completeVideo(evt.path).catch((err) => {
+      console.error("Error updating video content document after result:", err);
+    });
   });
 
   pythonProcess.on("close", async (code) => {
+    if (completed) {
+      if (code !== 0) console.error(`Video script exited with code ${code} after its result: ${errorOutput}`);
+      return;
+    }
     try {
       // ⭐ FIX 1: Use findByIdAndUpdate and robustly check output
-      if (code === 0 && outputResult.trim()) {
-        const finalFilePath = outputResult.trim();
-        await GeneratedContent.findByIdAndUpdate(contentId, {
-          filePath: finalFilePath,
-          status: "completed",
-          updatedAt: new Date(),
-        });
-        console.log(`Video generated for ${userId}: ${finalFilePath}`);
+      const finalFilePath = outputResult.trim();
+      if (code === 0 && finalFilePath) {
+        await completeVideo(finalFilePath);
       } else {
         await GeneratedContent.findByIdAndUpdate(contentId, {
           status: "failed",
@@ -478,40 +609,57 @@ app.post(
         contentId: contentId,
       });
 
-    // The key here is the 'outputResult' variable, which will buffer the stdout.
+    // The result path arrives as a "result" event; stdout is only kept as a bounded fallback.
     let outputResult = "";
     let errorOutput = "";
 
     // Call the new Python script
-    const pythonProcess = spawn(PYTHON_EXE_PATH, [
+    const pythonProcess = spawnMlScript([
       path.join(__dirname, "ml_scripts", "story_to_video_gen.py"),
       inputFile,
       contentId, // Pass contentId
-    ]);
+    ], contentId);
 
     pythonProcess.stdout.on("data", (data) => {
-      outputResult += data.toString();
+      outputResult = appendTail(outputResult, data.toString());
     });
 
     pythonProcess.stderr.on("data", (data) => {
-      errorOutput += data.toString();
+      errorOutput = appendTail(errorOutput, data.toString());
       console.error(`Python stderr: ${data.toString()}`);
     });
 
+    let completed = false;
+    async function completeStory(filePath) {
+      completed = true;
+      await GeneratedContent.findByIdAndUpdate(contentId, {
+        status: "completed",
+        filePath: filePath,
+        updatedAt: new Date(),
+      });
+      console.log(`Story video generated successfully: ${filePath}`);
+    }
+
+    // Completed as soon as the result is reported, before the process has exited
+    pythonProcess.once("result", (evt) => {
+      completeStory(evt.path).catch((err) => {
+        console.error("Error updating story content document after result:", err);
+      });
+    });
+
     pythonProcess.on("close", async (code) => {
       fs.unlink(inputFile, (unlinkErr) => {
         if (unlinkErr)
           console.error("Error deleting temp upload file:", unlinkErr);
       });
 
-      if (code === 0 && outputResult.trim()) {
-        const filePath = outputResult.trim();
-        await GeneratedContent.findByIdAndUpdate(contentId, {
-          status: "completed",
-          filePath: filePath,
-          updatedAt: new Date(),
-        });
-        console.log(`Story video generated successfully: ${filePath}`);
+      if (completed) {
+        if (code !== 0) console.error(`Story script exited with code ${code} after its result: ${errorOutput}`);
+        return;
+      }
+      const filePath = outputResult.trim().split("\n").pop();
+      if (code === 0 && filePath) {
+        await completeStory(filePath);
       } else {
         await GeneratedContent.findByIdAndUpdate(contentId, {
           status: "failed",
@@ -591,6 +739,24 @@ app.get("/api/suggest", (req, res) => {
   res.json(categorizedSuggestions);
 });
 
+// --- API Route to Poll Live Progress of a Running Generation ---
+app.get("/api/generate/progress/:contentId", authenticateAPI, async (req, res) => {
+    try {
+        const content = await GeneratedContent.findOne({ _id: req.params.contentId, userId: req.user.id }, "status").lean();
+        if (!content) {
+            return res.status(404).json({ success: false, msg: "Content not found." });
+        }
+        res.json({
+            success: true,
+            status: content.status,
+            progress: jobProgress.get(req.params.contentId) || null,
+        });
+    } catch (err) {
+        console.error("Error fetching generation progress:", err);
+        res.status(500).json({ success: false, msg: "Failed to retrieve progress." });
+    }
+});
+
 // --- API Route to Fetch Gallery Content ---
 app.get("/api/gallery", authenticateAPI, async (req, res) => {
     const userId = req.user.id;
@@ -0,0 +1,269 @@
+# benchmarks/bench_cpu_pipelines.py
+#
+# CPU microbenchmarks for the diffusion pipelines used by ml_scripts, run on tiny
+# random-weight models (see tiny_pipelines.py), so they need no GPU and no network:
+#     python benchmarks/bench_cpu_pipelines.py [--cases sd_txt2img,sd_img2img,svd] [--steps 10] [--repeats 3]
+# For every case it measures load time, seconds per denoising step, VAE decode time,
+# save time and peak RSS (each case runs in its own process, so peak RSS is per case).
+# Prints one JSON object to stdout.
+#
+# Regression gate: results are compared against a stored baseline, and the script exits
+# with status 1 if any metric got slower than the tolerance allows.
+#     python benchmarks/bench_cpu_pipelines.py --update-baseline   # record on this machine
+#     python benchmarks/bench_cpu_pipelines.py                     # compare against it
+import sys
+import os
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ml_scripts'))
+
+import tiny_pipelines
+from profiling import max_rss_mb
+
+CASES = ["sd_txt2img", "sd_img2img", "svd"]
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baselines', 'cpu_tiny_pipelines.json')
+
+# Lower is better for every metric; differences below the floor are treated as noise
+METRIC_FLOORS = {
+    "load_s": 0.02,
+    "seconds_per_step": 0.002,
+    "decode_s": 0.005,
+    "save_s": 0.005,
+    "peak_rss_mb": 20,
+}
+
+SVD_NUM_FRAMES = 4
+SVD_DECODE_CHUNK_SIZE = 2
+
+
+class StepTimer:
+    """A `callback_on_step_end` that timestamps the end of every denoising step."""
+
+    def __init__(self):
+        self.marks = []
+
+    def __call__(self, pipeline, step, timestep, callback_kwargs):
+        self.marks.append(time.perf_counter())
+        return callback_kwargs
+
+    def seconds_per_step(self):
+        # Intervals between step ends exclude the one-off prompt/image encoding before step 1
+        if len(self.marks) < 2:
+            return None
+        return (self.marks[-1] - self.marks[0]) / (len(self.marks) - 1)
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    value = fn()
+    return value, time.perf_counter() - start
+
+
+def _run_sd(kind, model_dir, steps, output_dir):
+    import torch
+    from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline
+
+    pipeline_class = StableDiffusionPipeline if kind == "sd_txt2img" else StableDiffusionImg2ImgPipeline
+    pipeline, load_s = _timed(lambda: pipeline_class.from_pretrained(model_dir, safety_checker=None, requires_safety_checker=False))
+    pipeline.set_progress_bar_config(disable=True)
+
+    extra = {"image": tiny_pipelines.tiny_init_image(), "strength": 0.9} if kind == "sd_img2img" else \
+        {"height": tiny_pipelines.IMAGE_SIZE, "width": tiny_pipelines.IMAGE_SIZE}
+
+    def run_once():
+        timer = StepTimer()
+        latents, sample_s = _timed(lambda: pipeline(
+            "a lighthouse on a cliff at sunset",
+            num_inference_steps=steps,
+            guidance_scale=11.5,
+            generator=torch.Generator("cpu").manual_seed(tiny_pipelines.SEED),
+            output_type="latent",
+            callback_on_step_end=timer,
+            **extra,
+        ).images)
+
+        def decode():
+            with torch.no_grad():
+                decoded = pipeline.vae.decode(latents / pipeline.vae.config.scaling_factor, return_dict=False)[0]
+            return pipeline.image_processor.postprocess(decoded, output_type="pil")
+
+        images, decode_s = _timed(decode)
+        _, save_s = _timed(lambda: images[0].save(os.path.join(output_dir, f"{kind}.png")))
+        return {"seconds_per_step": timer.seconds_per_step(), "sample_s": sample_s, "decode_s": decode_s, "save_s": save_s}
+
+    return load_s, run_once
+
+
+def _run_svd(model_dir, steps, output_dir):
+    import torch
+    from diffusers import StableVideoDiffusionPipeline
+    from diffusers.utils import export_to_video
+
+    pipeline, load_s = _timed(lambda: StableVideoDiffusionPipeline.from_pretrained(model_dir))
+    pipeline.set_progress_bar_config(disable=True)
+    image = tiny_pipelines.tiny_init_image()
+
+    def postprocess(frames):
+        if hasattr(pipeline, "video_processor"):
+            return pipeline.video_processor.postprocess_video(video=frames, output_type="pil")[0]
+        # Older diffusers releases
+        from diffusers.pipelines.stable_video_diffusion.pipeline_stable_video_diffusion import tensor2vid
+        return tensor2vid(frames, pipeline.image_processor, output_type="pil")[0]
+
+    def run_once():
+        timer = StepTimer()
+        latents, sample_s = _timed(lambda: pipeline(
+            image,
+            height=tiny_pipelines.IMAGE_SIZE,
+            width=tiny_pipelines.IMAGE_SIZE,
+            num_frames=SVD_NUM_FRAMES,
+            decode_chunk_size=SVD_DECODE_CHUNK_SIZE,
+            num_inference_steps=steps,
+            generator=torch.Generator("cpu").manual_seed(tiny_pipelines.SEED),
+            output_type="latent",
+            callback_on_step_end=timer,
+        ).frames)
+
+        def decode():
+            with torch.no_grad():
+                frames = pipeline.decode_latents(latents, SVD_NUM_FRAMES, SVD_DECODE_CHUNK_SIZE)
+            return postprocess(frames)
+
+        frames, decode_s = _timed(decode)
+        _, save_s = _timed(lambda: export_to_video(frames, os.path.join(output_dir, "svd.mp4"), fps=7))
+        return {"seconds_per_step": timer.seconds_per_step(), "sample_s": sample_s, "decode_s": decode_s, "save_s": save_s}
+
+    return load_s, run_once
+
+
+def run_case(case, model_dirs, steps, repeats, threads):
+    """Runs one case in this process and returns its metrics (medians over `repeats`)."""
+    import torch
+
+    if threads:
+        torch.set_num_threads(threads)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        if case == "svd":
+            load_s, run_once = _run_svd(model_dirs["svd"], steps, output_dir)
+        else:
+            load_s, run_once = _run_sd(case, model_dirs["sd"], steps, output_dir)
+
+        run_once() # Warm-up: first call pays one-off allocation costs
+        runs = [run_once() for _ in range(repeats)]
+
+    result = {"load_s": round(load_s, 4)}
+    for metric in ("seconds_per_step", "sample_s", "decode_s", "save_s"):
+        values = [run[metric] for run in runs if run[metric] is not None]
+        result[metric] = round(statistics.median(values), 4) if values else None
+    result["peak_rss_mb"] = max_rss_mb()
+    return result
+
+
+def environment(threads):
+    import torch
+    import diffusers
+
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "diffusers": diffusers.__version__,
+        "cpu_count": os.cpu_count(),
+        "threads": threads or torch.get_num_threads(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns the list of metrics that regressed beyond `tolerance` relative to the baseline."""
+    regressions = []
+    for case, metrics in results.items():
+        base_metrics = baseline.get("results", {}).get(case)
+        if not base_metrics:
+            continue
+        for metric, floor in METRIC_FLOORS.items():
+            current, base = metrics.get(metric), base_metrics.get(metric)
+            if current is None or base is None:
+                continue
+            if current > base * (1 + tolerance) and current - base > floor:
+                regressions.append({
+                    "case": case,
+                    "metric": metric,
+                    "baseline": base,
+                    "current": current,
+                    "change": f"+{(current / base - 1) * 100:.1f}%" if base else "n/a",
+                })
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU microbenchmarks on tiny random-weight diffusion pipelines.")
+    parser.add_argument("--cases", default=",".join(CASES))
+    parser.add_argument("--steps", type=int, default=10, help="Denoising steps per run")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per case (after one warm-up)")
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads (default: torch's choice)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before a metric counts as a regression")
+    # Internal: run a single case in a child process
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--model-dirs", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, json.loads(args.model_dirs), args.steps, args.repeats, args.threads)))
+        sys.exit(0)
+
+    cases = [name.strip() for name in args.cases.split(",") if name.strip()]
+    unknown = [name for name in cases if name not in CASES]
+    if unknown:
+        parser.error(f"Unknown case(s): {', '.join(unknown)}. Choose from: {', '.join(CASES)}")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        sys.stderr.write("Building tiny pipelines...\n")
+        model_dirs = tiny_pipelines.save_tiny_pipelines(workdir)
+
+        for case in cases:
+            sys.stderr.write(f"Benchmarking '{case}'...\n")
+            command = [sys.executable, os.path.abspath(__file__), "--run-case", case, "--model-dirs", json.dumps(model_dirs),
+                       "--steps", str(args.steps), "--repeats", str(args.repeats)]
+            if args.threads:
+                command += ["--threads", str(args.threads)]
+            completed = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+            if completed.returncode != 0:
+                sys.stderr.write(f"Case '{case}' failed with exit code {completed.returncode}\n")
+                sys.exit(1)
+            results[case] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    report = {"environment": environment(args.threads), "steps": args.steps, "repeats": args.repeats, "results": results}
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        sys.stderr.write(f"Baseline written to {args.baseline}\n")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if (baseline.get("steps"), baseline.get("environment", {}).get("threads")) != (args.steps, report["environment"]["threads"]):
+            sys.stderr.write("Warning: baseline was recorded with different steps/threads; comparison may be meaningless.\n")
+        report["baseline"] = os.path.relpath(args.baseline)
+        report["regressions"] = compare(results, baseline, args.tolerance)
+    else:
+        sys.stderr.write(f"No baseline at {args.baseline}; run with --update-baseline to record one.\n")
+
+    print(json.dumps(report, indent=2))
+
+    if report.get("regressions"):
+        for regression in report["regressions"]:
+            sys.stderr.write(f"REGRESSION {regression['case']}.{regression['metric']}: "
+                             f"{regression['baseline']} -> {regression['current']} ({regression['change']})\n")
+        sys.exit(1)
@@ -0,0 +1,78 @@
+# benchmarks/bench_doc_extract.py
+#
+# Document extraction time and peak memory on a generated N-page PDF (needs pymupdf):
+#   full_sequential  every page, in-process (what load_text_from_file did)
+#   full_parallel    every page, page ranges across a process pool (doc_extract.extract_pdf_parallel)
+#   budget           stop at story_to_video_gen's 1500-character budget (doc_extract.extract_text)
+#     python benchmarks/bench_doc_extract.py [--pages 50,500] [--workers 4]
+# Each (pages, method) runs in its own process so peak RSS is comparable. Prints JSON to stdout.
+import sys
+import os
+import json
+import time
+import argparse
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ml_scripts'))
+
+import doc_extract
+from profiling import max_rss_mb
+
+METHODS = ["full_sequential", "full_parallel", "budget"]
+PARAGRAPH = ("The lighthouse keeper climbed the stairs every evening, counting the steps as the storm "
+             "gathered over the bay and the boats hurried home before dark. ")
+
+
+def build_pdf(path, pages):
+    import fitz
+
+    doc = fitz.open()
+    for index in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(36, 36, 576, 756), f"Page {index + 1}. " + PARAGRAPH * 18, fontsize=10)
+    doc.save(path)
+    doc.close()
+
+
+def run_method(method, path, workers):
+    start = time.perf_counter()
+    if method == "full_sequential":
+        text = "".join(doc_extract.iter_text(path))
+    elif method == "full_parallel":
+        text = doc_extract.extract_pdf_parallel(path, workers=workers)
+    else:
+        text, _ = doc_extract.extract_text(path, max_chars=1500)
+    return {"seconds": round(time.perf_counter() - start, 3), "peak_rss_mb": max_rss_mb(), "chars": len(text)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark full, page-parallel and budgeted PDF text extraction.")
+    parser.add_argument("--pages", default="50,500")
+    parser.add_argument("--workers", type=int, default=doc_extract.EXTRACT_WORKERS)
+    # Internal: run a single method in a child process
+    parser.add_argument("--run-method", help=argparse.SUPPRESS)
+    parser.add_argument("--pdf", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_method:
+        print(json.dumps(run_method(args.run_method, args.pdf, args.workers)))
+        sys.exit(0)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for pages in [int(count) for count in args.pages.split(",") if count.strip()]:
+            sys.stderr.write(f"Benchmarking a {pages}-page PDF...\n")
+            pdf_path = os.path.join(workdir, f"doc_{pages}.pdf")
+            build_pdf(pdf_path, pages)
+            entry = {"pages": pages}
+            for method in METHODS:
+                completed = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--run-method", method, "--pdf", pdf_path,
+                     "--workers", str(args.workers)],
+                    stdout=subprocess.PIPE, text=True, check=True,
+                )
+                entry[method] = json.loads(completed.stdout.strip().splitlines()[-1])
+            results.append(entry)
+
+    print(json.dumps({"workers": args.workers, "results": results}, indent=2))
@@ -0,0 +1,117 @@
+# benchmarks/bench_image_decode.py
+#
+# Init-image decode cost for img2img uploads of 1-10 MB, old path vs new:
+#   base64  - base64 on argv, b64decode, full-resolution decode, then resize (the old img2img_gen)
+#   draft   - raw bytes from a file, JPEG draft-mode decode straight to ~512px (image_input.py)
+#     python benchmarks/bench_image_decode.py [--sizes-mb 1,2,5,10] [--repeats 5]
+# Each (size, method) runs in its own process so peak RSS is comparable. Prints JSON to stdout.
+import sys
+import os
+import io
+import json
+import time
+import base64
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ml_scripts'))
+
+import image_input
+from profiling import max_rss_mb
+
+METHODS = ["base64", "draft"]
+
+
+def make_jpeg(path, target_mb):
+    """Writes a photo-like JPEG (gradient plus noise) of roughly `target_mb` megabytes."""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+
+    def encode(side):
+        y, x = np.mgrid[0:side, 0:side]
+        gradient = np.stack([x * 255 // side, y * 255 // side, (x + y) * 127 // side], axis=-1)
+        noise = rng.integers(-40, 40, size=(side, side, 3))
+        pixels = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="JPEG", quality=92)
+        return buffer.getvalue()
+
+    # File size scales with pixel count: measure once, then rescale the side length
+    side = 1024
+    data = encode(side)
+    side = int(side * (target_mb * 1024 * 1024 / len(data)) ** 0.5)
+    data = encode(side)
+    with open(path, "wb") as f:
+        f.write(data)
+    return side
+
+
+def decode_base64(path):
+    from PIL import Image
+
+    with open(path, "rb") as f:
+        encoded = base64.b64encode(f.read()).decode("ascii") # what used to travel on argv
+    image = Image.open(io.BytesIO(base64.b64decode(encoded))).convert("RGB")
+    decoded_size = image.size
+    return image.resize((512, 512)), decoded_size
+
+
+def decode_draft(path):
+    from PIL import Image
+
+    with Image.open(path) as probe:
+        probe.draft("RGB", image_input.INIT_IMAGE_SIZE)
+        decoded_size = probe.size
+    return image_input.decode_image(path), decoded_size
+
+
+def run_method(method, path, repeats):
+    decode = decode_base64 if method == "base64" else decode_draft
+    decode(path) # Warm-up
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        _, decoded_size = decode(path)
+        timings.append(time.perf_counter() - start)
+    return {
+        "seconds": round(statistics.median(timings), 4),
+        "decoded_size": list(decoded_size),
+        "peak_rss_mb": max_rss_mb(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark init-image decoding for img2img uploads.")
+    parser.add_argument("--sizes-mb", default="1,2,5,10")
+    parser.add_argument("--repeats", type=int, default=5)
+    # Internal: run a single method in a child process
+    parser.add_argument("--run-method", help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_method:
+        print(json.dumps(run_method(args.run_method, args.path, args.repeats)))
+        sys.exit(0)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size_mb in [float(size) for size in args.sizes_mb.split(",") if size.strip()]:
+            path = os.path.join(workdir, f"upload_{size_mb:g}mb.jpg")
+            side = make_jpeg(path, size_mb)
+            sys.stderr.write(f"Benchmarking {os.path.getsize(path) / 1e6:.1f} MB ({side}x{side}) upload...\n")
+
+            entry = {"file_mb": round(os.path.getsize(path) / (1024 * 1024), 2), "pixels": [side, side]}
+            for method in METHODS:
+                completed = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--run-method", method, "--path", path, "--repeats", str(args.repeats)],
+                    stdout=subprocess.PIPE, text=True, check=True,
+                )
+                entry[method] = json.loads(completed.stdout.strip().splitlines()[-1])
+            entry["speedup"] = round(entry["base64"]["seconds"] / entry["draft"]["seconds"], 2)
+            results.append(entry)
+
+    print(json.dumps({"results": results}, indent=2))
@@ -0,0 +1,89 @@
+# benchmarks/bench_keyframe_batching.py
+#
+# Keyframe throughput for a story's scenes, one denoise call per scene vs batched calls
+# (keyframes.render_keyframes), on the tiny random-weight SD pipeline (see tiny_pipelines.py):
+#     python benchmarks/bench_keyframe_batching.py [--scenes 3,5] [--batch-sizes 1,2,4] [--steps 10] [--repeats 3]
+# Batch size 1 is the old per-scene loop. Prints JSON to stdout with the median seconds per
+# run, images per second and the speedup over per-scene generation.
+import sys
+import os
+import json
+import time
+import argparse
+import statistics
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ml_scripts'))
+
+import tiny_pipelines
+import keyframes
+
+PROMPTS = [
+    "a lighthouse on a cliff at dusk",
+    "a small boat crossing a stormy sea",
+    "a village market in the morning",
+    "a forest path covered in snow",
+    "a city skyline at night",
+    "a desert caravan under the stars",
+    "an old library lit by candles",
+    "a mountain lake at sunrise",
+]
+
+
+def run(pipeline, scenes, batch_size, steps, repeats):
+    prompts = [PROMPTS[index % len(PROMPTS)] for index in range(scenes)]
+
+    def render():
+        return keyframes.render_keyframes(
+            pipeline, prompts, batch_size,
+            negative_prompt="blurry, low quality, distorted, bad anatomy",
+            num_inference_steps=steps,
+            guidance_scale=9.0,
+        )
+
+    render() # Warm-up
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        images = render()
+        timings.append(time.perf_counter() - start)
+    assert len(images) == scenes
+    seconds = statistics.median(timings)
+    return {"seconds": round(seconds, 4), "images_per_s": round(scenes / seconds, 3)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark per-scene vs batched keyframe generation on a tiny CPU pipeline.")
+    parser.add_argument("--scenes", default="3,5")
+    parser.add_argument("--batch-sizes", default="1,2,4")
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads (default: torch's choice)")
+    args = parser.parse_args()
+
+    import torch
+    from diffusers import StableDiffusionPipeline
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        sys.stderr.write("Building tiny pipelines...\n")
+        model_dirs = tiny_pipelines.save_tiny_pipelines(workdir)
+        pipeline = StableDiffusionPipeline.from_pretrained(model_dirs["sd"], safety_checker=None, requires_safety_checker=False)
+        pipeline.set_progress_bar_config(disable=True)
+
+        for scenes in [int(count) for count in args.scenes.split(",") if count.strip()]:
+            entry = {"scenes": scenes, "batch_sizes": {}}
+            for batch_size in [int(size) for size in args.batch_sizes.split(",") if size.strip()]:
+                sys.stderr.write(f"Benchmarking {scenes} scenes, batch size {batch_size}...\n")
+                entry["batch_sizes"][batch_size] = run(pipeline, scenes, batch_size, args.steps, args.repeats)
+            per_scene = entry["batch_sizes"].get(1)
+            if per_scene:
+                for stats in entry["batch_sizes"].values():
+                    stats["speedup"] = round(per_scene["seconds"] / stats["seconds"], 2)
+            results.append(entry)
+
+    print(json.dumps({"steps": args.steps, "repeats": args.repeats, "threads": args.threads or torch.get_num_threads(),
+                      "results": results}, indent=2))
@@ -0,0 +1,68 @@
+# benchmarks/bench_quality_tiers.py
+#
+# Seconds-per-image for each quality tier on the real SD 1.5 txt2img pipeline.
+#     python benchmarks/bench_quality_tiers.py [--tiers draft,standard,max] [--images 3] [--seed 1234]
+# Prints one JSON object with the timings to stdout.
+import sys
+import os
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ml_scripts'))
+
+import image_gen
+import quality_tiers
+
+
+def bench_tier(pipeline, tier, prompt, seed, images):
+    import torch
+
+    settings = image_gen.generation_settings(tier)
+    settings.pop("quality")
+    num_inference_steps = quality_tiers.apply_tier(pipeline, tier)
+    prompt_embeds, negative_embeds = image_gen.encode_prompts(pipeline, [prompt])
+
+    def run_once():
+        generator = torch.Generator(pipeline.device).manual_seed(seed)
+        return pipeline(prompt_embeds=prompt_embeds, negative_prompt_embeds=negative_embeds,
+                        generator=generator, **settings).images[0]
+
+    # Warm-up: first call per scheduler pays one-off allocation costs
+    run_once()
+
+    timings = []
+    for _ in range(images):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        run_once()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+
+    return {
+        "tier": tier,
+        "scheduler": quality_tiers.QUALITY_TIERS[tier]["scheduler"],
+        "num_inference_steps": num_inference_steps,
+        "seconds_per_image": round(sum(timings) / len(timings), 3),
+        "min_seconds": round(min(timings), 3),
+        "max_seconds": round(max(timings), 3),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark seconds-per-image for each quality tier.")
+    parser.add_argument("--tiers", default=",".join(quality_tiers.tier_names()))
+    parser.add_argument("--images", type=int, default=3, help="Timed images per tier (after one warm-up)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--prompt", default="a lighthouse on a cliff at sunset, cinematic lighting, highly detailed")
+    args = parser.parse_args()
+
+    pipeline = image_gen.load_pipeline()
+    results = []
+    for tier in [name.strip() for name in args.tiers.split(",") if name.strip()]:
+        sys.stderr.write(f"Benchmarking tier '{tier}'...\n")
+        results.append(bench_tier(pipeline, tier, args.prompt, args.seed, args.images))
+
+    print(json.dumps({"device": str(pipeline.device), "results": results}, indent=2))
@@ -0,0 +1,87 @@
+# benchmarks/bench_video_encoder.py
+#
+# Peak memory and time for writing an N-frame 1024x576 clip, old path vs new:
+#   list    - every frame materialised as a PIL image, then handed to the encoder at the end
+#             (what export_to_video needed)
+#   stream  - frames generated in decode-sized chunks and piped to ffmpeg as they arrive
+#             (video_encoder.py)
+#     python benchmarks/bench_video_encoder.py [--frames 25,50,100] [--chunk 8]
+# Each (frames, method) runs in its own process so peak RSS is comparable. Prints JSON to stdout.
+import sys
+import os
+import json
+import time
+import argparse
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ml_scripts'))
+
+import video_encoder
+from profiling import max_rss_mb
+
+METHODS = ["list", "stream"]
+WIDTH, HEIGHT = 1024, 576
+
+
+def frame_chunks(num_frames, chunk):
+    """Smooth moving gradients in N x H x W x 3 uint8 chunks, standing in for decoded SVD frames."""
+    import numpy as np
+
+    y, x = np.mgrid[0:HEIGHT, 0:WIDTH]
+    for start in range(0, num_frames, chunk):
+        frames = []
+        for index in range(start, min(start + chunk, num_frames)):
+            shifted = (x + index * 8) % WIDTH
+            frames.append(np.stack([shifted * 255 // WIDTH, y * 255 // HEIGHT, (shifted + y) * 255 // (WIDTH + HEIGHT)], axis=-1))
+        yield np.asarray(frames, dtype=np.uint8)
+
+
+def run_method(method, num_frames, chunk, output_path):
+    from PIL import Image
+
+    start = time.perf_counter()
+    with video_encoder.VideoEncoder(output_path, fps=8, preset="veryfast") as encoder:
+        if method == "list":
+            images = [Image.fromarray(frame) for frames in frame_chunks(num_frames, chunk) for frame in frames]
+            for image in images:
+                encoder.write(image)
+        else:
+            for frames in frame_chunks(num_frames, chunk):
+                encoder.write_frames(frames)
+    return {
+        "seconds": round(time.perf_counter() - start, 3),
+        "peak_rss_mb": max_rss_mb(),
+        "bytes": encoder.summary["bytes"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark streaming video encoding against a materialised frame list.")
+    parser.add_argument("--frames", default="25,50,100")
+    parser.add_argument("--chunk", type=int, default=8, help="Frames per decoded chunk")
+    # Internal: run a single method in a child process
+    parser.add_argument("--run-method", help=argparse.SUPPRESS)
+    parser.add_argument("--num-frames", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_method:
+        print(json.dumps(run_method(args.run_method, args.num_frames, args.chunk, args.output)))
+        sys.exit(0)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for num_frames in [int(count) for count in args.frames.split(",") if count.strip()]:
+            sys.stderr.write(f"Benchmarking a {num_frames}-frame clip...\n")
+            entry = {"frames": num_frames}
+            for method in METHODS:
+                completed = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--run-method", method, "--num-frames", str(num_frames),
+                     "--chunk", str(args.chunk), "--output", os.path.join(workdir, f"{method}_{num_frames}.mp4")],
+                    stdout=subprocess.PIPE, text=True, check=True,
+                )
+                entry[method] = json.loads(completed.stdout.strip().splitlines()[-1])
+            results.append(entry)
+
+    print(json.dumps({"results": results}, indent=2))
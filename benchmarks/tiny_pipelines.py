@@ -0,0 +1,185 @@
+# benchmarks/tiny_pipelines.py
+#
+# Tiny, randomly initialised versions of the pipelines the ml_scripts use
+# (StableDiffusionPipeline, StableDiffusionImg2ImgPipeline, StableVideoDiffusionPipeline,
+# and a GPT-J-shaped text-generation pipeline).
+# They exercise exactly the same code paths as the real checkpoints but build in a second
+# on CPU without touching the network, which makes them suitable for benchmarks that gate
+# performance changes. The absolute numbers say nothing about real-model speed; compare
+# them only against a baseline recorded on the same machine.
+import os
+import json
+
+SEED = 0
+IMAGE_SIZE = 64  # pixels; the tiny VAE downsamples by 2, so latents are 32x32
+
+
+def _tiny_tokenizer(directory):
+    """A byte-level CLIP tokenizer with no merges, written to `directory` (no download)."""
+    from transformers import CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    chars = list(bytes_to_unicode().values())
+    vocab = chars + [char + "</w>" for char in chars] + ["<|startoftext|>", "<|endoftext|>"]
+
+    os.makedirs(directory, exist_ok=True)
+    vocab_file = os.path.join(directory, "vocab.json")
+    merges_file = os.path.join(directory, "merges.txt")
+    with open(vocab_file, "w", encoding="utf-8") as f:
+        json.dump({token: index for index, token in enumerate(vocab)}, f)
+    with open(merges_file, "w", encoding="utf-8") as f:
+        f.write("#version: 0.2\n")
+
+    return CLIPTokenizer(vocab_file, merges_file, model_max_length=77)
+
+
+def tiny_sd_components(workdir):
+    """Component dict for a tiny SD 1.5-shaped txt2img/img2img pipeline."""
+    import torch
+    from diffusers import UNet2DConditionModel, AutoencoderKL, PNDMScheduler
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    tokenizer = _tiny_tokenizer(os.path.join(workdir, "tokenizer_src"))
+
+    torch.manual_seed(SEED)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        sample_size=IMAGE_SIZE // 2,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"],
+        latent_channels=4,
+    )
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=len(tokenizer) - 2,
+        eos_token_id=len(tokenizer) - 1,
+        pad_token_id=len(tokenizer) - 1,
+        hidden_size=32,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=5,
+        vocab_size=len(tokenizer),
+    ))
+    # Same default scheduler as runwayml/stable-diffusion-v1-5
+    scheduler = PNDMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+                              skip_prk_steps=True, steps_offset=1)
+
+    return {
+        "unet": unet,
+        "vae": vae,
+        "text_encoder": text_encoder,
+        "tokenizer": tokenizer,
+        "scheduler": scheduler,
+        "safety_checker": None,
+        "feature_extractor": None,
+        "requires_safety_checker": False,
+    }
+
+
+def tiny_svd_components():
+    """Component dict for a tiny SVD-XT-shaped image-to-video pipeline."""
+    import torch
+    from diffusers import UNetSpatioTemporalConditionModel, AutoencoderKLTemporalDecoder, EulerDiscreteScheduler
+    from transformers import CLIPVisionConfig, CLIPVisionModelWithProjection, CLIPImageProcessor
+
+    torch.manual_seed(SEED)
+    unet = UNetSpatioTemporalConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        sample_size=IMAGE_SIZE // 2,
+        in_channels=8,
+        out_channels=4,
+        down_block_types=("CrossAttnDownBlockSpatioTemporal", "DownBlockSpatioTemporal"),
+        up_block_types=("UpBlockSpatioTemporal", "CrossAttnUpBlockSpatioTemporal"),
+        cross_attention_dim=32,
+        num_attention_heads=8,
+        projection_class_embeddings_input_dim=96,
+        addition_time_embed_dim=32,
+    )
+    vae = AutoencoderKLTemporalDecoder(
+        block_out_channels=[32, 64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+        latent_channels=4,
+    )
+    image_encoder = CLIPVisionModelWithProjection(CLIPVisionConfig(
+        hidden_size=32,
+        projection_dim=32,
+        num_hidden_layers=5,
+        num_attention_heads=4,
+        image_size=32,
+        intermediate_size=37,
+        patch_size=1,
+    ))
+    # Same scheduler configuration as stabilityai/stable-video-diffusion-img2vid-xt
+    scheduler = EulerDiscreteScheduler(
+        beta_schedule="scaled_linear", beta_start=0.00085, beta_end=0.012, interpolation_type="linear",
+        num_train_timesteps=1000, prediction_type="v_prediction", sigma_max=700.0, sigma_min=0.002,
+        steps_offset=1, timestep_spacing="leading", timestep_type="continuous", use_karras_sigmas=True,
+    )
+
+    return {
+        "unet": unet,
+        "vae": vae,
+        "image_encoder": image_encoder,
+        "scheduler": scheduler,
+        "feature_extractor": CLIPImageProcessor(crop_size=32, size=32),
+    }
+
+
+def save_tiny_pipelines(workdir):
+    """
+    Builds the tiny pipelines once and saves them under `workdir`, so loading them can be
+    timed like loading a real checkpoint. Returns {"sd": <dir>, "svd": <dir>}.
+    """
+    from diffusers import StableDiffusionPipeline, StableVideoDiffusionPipeline
+
+    paths = {"sd": os.path.join(workdir, "tiny-sd"), "svd": os.path.join(workdir, "tiny-svd")}
+    StableDiffusionPipeline(**tiny_sd_components(workdir)).save_pretrained(paths["sd"])
+    StableVideoDiffusionPipeline(**tiny_svd_components()).save_pretrained(paths["svd"])
+    return paths
+
+
+def tiny_text_generation(workdir, layers=4, hidden=256):
+    """A GPT-J-shaped text-generation pipeline with a byte-level GPT-2 tokenizer (one token per byte)."""
+    import torch
+    from transformers import GPT2Tokenizer, GPTJConfig, GPTJForCausalLM, pipeline
+    from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+    directory = os.path.join(workdir, "tiny-gptj-tokenizer")
+    os.makedirs(directory, exist_ok=True)
+    vocab = list(bytes_to_unicode().values()) + ["<|endoftext|>"]
+    vocab_file = os.path.join(directory, "vocab.json")
+    merges_file = os.path.join(directory, "merges.txt")
+    with open(vocab_file, "w", encoding="utf-8") as f:
+        json.dump({token: index for index, token in enumerate(vocab)}, f)
+    with open(merges_file, "w", encoding="utf-8") as f:
+        f.write("#version: 0.2\n")
+    tokenizer = GPT2Tokenizer(vocab_file, merges_file)
+
+    torch.manual_seed(SEED)
+    model = GPTJForCausalLM(GPTJConfig(
+        vocab_size=len(vocab), n_positions=2048, n_embd=hidden, n_layer=layers, n_head=4, rotary_dim=16,
+        bos_token_id=len(vocab) - 1, eos_token_id=len(vocab) - 1,
+    )).eval()
+    return pipeline("text-generation", model=model, tokenizer=tokenizer, device=-1)
+
+
+def tiny_init_image(size=IMAGE_SIZE):
+    """A deterministic noise image standing in for an uploaded img2img / SVD input."""
+    import numpy as np
+    from PIL import Image
+
+    pixels = np.random.default_rng(SEED).integers(0, 256, size=(size, size, 3), dtype=np.uint8)
+    return Image.fromarray(pixels)
@@ -0,0 +1,126 @@
+# ml_scripts/batching.py
+#
+# Cross-request micro-batching for the inference server. Requests that share a batch key
+# (e.g. same steps, guidance and resolution) and arrive within a short window are handed
+# to one `run_batch(key, items)` call, and each caller gets back its own result.
+import asyncio
+import threading
+import time
+
+
+class BatchMetrics:
+    """Running counters for batch sizes and the time requests spent waiting in the queue."""
+
+    def __init__(self):
+        self.batches = 0
+        self.items = 0
+        self.batch_size_counts = {} # batch size -> number of batches run at that size
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    def record(self, batch_size, queue_waits):
+        self.batches += 1
+        self.items += batch_size
+        self.batch_size_counts[batch_size] = self.batch_size_counts.get(batch_size, 0) + 1
+        self.total_queue_wait += sum(queue_waits)
+        self.max_queue_wait = max([self.max_queue_wait] + list(queue_waits))
+
+    def as_dict(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": round(self.items / self.batches, 3) if self.batches else 0.0,
+            "batch_size_counts": {str(size): count for size, count in sorted(self.batch_size_counts.items())},
+            "mean_queue_wait_ms": round(1000 * self.total_queue_wait / self.items, 1) if self.items else 0.0,
+            "max_queue_wait_ms": round(1000 * self.max_queue_wait, 1),
+        }
+
+
+class MicroBatcher:
+    """
+    Collects compatible pending requests for up to `window_ms` (or until `max_batch_size`
+    are queued) and runs them together. `run_batch(key, items)` is a blocking function
+    executed on `executor`; it must return one result per item, in order.
+
+    The batch is only taken off the queue when the executor actually starts it, so requests
+    that arrive while the GPU is busy with another job join the next batch instead of
+    queueing up behind it one by one.
+    """
+
+    def __init__(self, run_batch, executor, window_ms=50, max_batch_size=4):
+        self.run_batch = run_batch
+        self.executor = executor
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max(1, max_batch_size)
+        self.lock = threading.Lock()
+        self.pending = {}    # batch key -> list of (item, future, enqueue time)
+        self.timers = {}     # batch key -> scheduled flush handle
+        self.scheduled = set() # batch keys with a run already queued on the executor
+        self.metrics = BatchMetrics()
+
+    async def submit(self, key, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            queue = self.pending.setdefault(key, [])
+            queue.append((item, future, time.perf_counter()))
+            queued = len(queue)
+
+        if queued >= self.max_batch_size:
+            self._flush(key)
+        elif key not in self.timers and key not in self.scheduled:
+            self.timers[key] = loop.call_later(self.window, self._flush, key)
+
+        return await future
+
+    def pending_count(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.pending.values())
+
+    def _flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if key not in self.scheduled:
+            self.scheduled.add(key)
+            asyncio.ensure_future(self._run(key))
+
+    def _take_and_run(self, key):
+        # Runs on the executor thread: take whatever is queued right now (up to the cap)
+        start = time.perf_counter()
+        with self.lock:
+            queue = self.pending.get(key, [])
+            taken, self.pending[key] = queue[:self.max_batch_size], queue[self.max_batch_size:]
+            if not self.pending[key]:
+                del self.pending[key]
+        if not taken:
+            return start, taken, []
+
+        try:
+            results = self.run_batch(key, [item for item, _, _ in taken])
+            if len(results) != len(taken):
+                raise RuntimeError(f"Batch returned {len(results)} results for {len(taken)} requests")
+        except Exception as e:
+            results = e
+        return start, taken, results
+
+    async def _run(self, key):
+        loop = asyncio.get_running_loop()
+        start, taken, results = await loop.run_in_executor(self.executor, self._take_and_run, key)
+        self.scheduled.discard(key)
+
+        if taken:
+            self.metrics.record(len(taken), [start - enqueued for _, _, enqueued in taken])
+            for index, (_, future, _) in enumerate(taken):
+                if future.done():
+                    continue
+                if isinstance(results, Exception):
+                    future.set_exception(results)
+                else:
+                    future.set_result(results[index])
+
+        # Requests that arrived while this batch ran go out in the next one straight away
+        with self.lock:
+            leftover = bool(self.pending.get(key))
+        if leftover:
+            self._flush(key)
@@ -0,0 +1,158 @@
+# ml_scripts/doc_extract.py
+#
+# Incremental text extraction for uploaded documents (PDF, DOCX, plain text). iter_text()
+# yields a document one piece at a time (a PDF page, a DOCX paragraph, a block of a text
+# file), so a caller that only needs the start of a long document stops reading as soon as
+# it has enough. extract_text() does exactly that against a character and/or token budget:
+# time and memory follow what is consumed, not the size of the upload.
+#
+# A full pass (no budget) over a large PDF is split into page ranges that a process pool
+# extracts in parallel; MuPDF's text extraction is CPU-bound and holds the GIL, so threads
+# would not help.
+#   ML_EXTRACT_WORKERS         processes for a full PDF pass (default: CPU count, at most 8)
+#   ML_EXTRACT_PARALLEL_PAGES  smaller PDFs are extracted in-process (default 64)
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+EXTRACT_WORKERS = int(os.environ.get("ML_EXTRACT_WORKERS", str(min(8, os.cpu_count() or 1))))
+PARALLEL_MIN_PAGES = int(os.environ.get("ML_EXTRACT_PARALLEL_PAGES", "64"))
+TEXT_BLOCK_CHARS = 64 * 1024
+CHARS_PER_TOKEN = 4 # Token estimate when no tokenizer is given (English prose, GPT-style BPE)
+
+
+def document_kind(path):
+    ext = os.path.splitext(path)[1].lower()
+    return {".pdf": "pdf", ".docx": "docx"}.get(ext, "text")
+
+
+def _iter_pdf(path):
+    import fitz # pymupdf
+
+    with fitz.open(path) as doc:
+        for page in doc:
+            yield page.get_text()
+
+
+def _iter_docx(path):
+    from docx import Document
+
+    # python-docx parses the whole document.xml up front; only the joined text is incremental
+    for paragraph in Document(path).paragraphs:
+        yield paragraph.text + "\n"
+
+
+def _iter_plain(path):
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for block in iter(lambda: f.read(TEXT_BLOCK_CHARS), ""):
+            yield block
+
+
+def iter_text(path):
+    """Yields the document's text in reading order, one page / paragraph / block at a time."""
+    kind = document_kind(path)
+    if kind == "pdf":
+        return _iter_pdf(path)
+    if kind == "docx":
+        return _iter_docx(path)
+    return _iter_plain(path)
+
+
+def page_count(path):
+    import fitz
+
+    with fitz.open(path) as doc:
+        return doc.page_count
+
+
+def _extract_pages(path, start, stop):
+    # Runs in a pool worker: each opens its own handle, MuPDF documents are not shareable
+    import fitz
+
+    with fitz.open(path) as doc:
+        return "".join(doc[index].get_text() for index in range(start, stop))
+
+
+def extract_pdf_parallel(path, workers=None, pages=None):
+    """Full text of a PDF, page ranges extracted by a process pool and joined in page order."""
+    pages = page_count(path) if pages is None else pages
+    workers = max(1, min(workers or EXTRACT_WORKERS, pages))
+    # A few ranges per worker, so one slow (image-heavy) range does not hold up the pass
+    step = max(1, -(-pages // (workers * 4)))
+    ranges = [(start, min(start + step, pages)) for start in range(0, pages, step)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = pool.map(_extract_pages, [path] * len(ranges), *zip(*ranges))
+        return "".join(parts)
+
+
+def _cut_to_tokens(text, max_tokens, count_tokens):
+    """The longest prefix of `text` within `max_tokens` (binary search over its length)."""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+def extract_text(path, max_chars=None, max_tokens=None, count_tokens=None, parallel=True):
+    """
+    Returns (text, stats). With `max_chars` and/or `max_tokens`, reading stops as soon as
+    the budget is met and `stats["truncated"]` says whether any text was left unread.
+    Tokens are counted with `count_tokens(text) -> int` (e.g. a tokenizer's length) or
+    estimated at CHARS_PER_TOKEN characters each. Without a budget, PDFs of at least
+    ML_EXTRACT_PARALLEL_PAGES pages are extracted page-parallel.
+    """
+    start = time.perf_counter()
+    count_tokens = count_tokens or (lambda text: -(-len(text) // CHARS_PER_TOKEN))
+    stats = {"kind": document_kind(path), "truncated": False}
+
+    if max_chars is None and max_tokens is None:
+        pages = page_count(path) if stats["kind"] == "pdf" and parallel else 0
+        if pages >= PARALLEL_MIN_PAGES and EXTRACT_WORKERS > 1:
+            text = extract_pdf_parallel(path, pages=pages)
+            stats["parallel_workers"] = min(EXTRACT_WORKERS, pages)
+        else:
+            text = "".join(iter_text(path))
+        stats.update(chars=len(text), seconds=round(time.perf_counter() - start, 3))
+        return text, stats
+
+    parts = []
+    chars = 0
+    tokens = 0
+    pieces = iter_text(path)
+    try:
+        for piece in pieces:
+            stats["pieces"] = stats.get("pieces", 0) + 1
+            if max_chars is not None and chars + len(piece) > max_chars:
+                piece = piece[:max_chars - chars]
+                stats["truncated"] = True
+            if max_tokens is not None:
+                piece_tokens = count_tokens(piece)
+                if tokens + piece_tokens > max_tokens:
+                    piece = _cut_to_tokens(piece, max_tokens - tokens, count_tokens)
+                    piece_tokens = count_tokens(piece)
+                    stats["truncated"] = True
+                tokens += piece_tokens
+            parts.append(piece)
+            chars += len(piece)
+            if stats["truncated"]:
+                break
+            if chars == max_chars or tokens == max_tokens:
+                # Exactly at the budget: truncated only if anything non-blank follows
+                stats["truncated"] = any(rest.strip() for rest in pieces)
+                break
+    finally:
+        pieces.close() # Closes the PDF as soon as the budget is met
+
+    text = "".join(parts)
+    stats.update(chars=len(text), seconds=round(time.perf_counter() - start, 3))
+    if max_tokens is not None:
+        stats["tokens"] = tokens
+    sys.stderr.write(f"Extracted {stats['chars']} characters from {stats.get('pieces', 0)} "
+                     f"{'pages' if stats['kind'] == 'pdf' else 'pieces'} in {stats['seconds']:.2f}s"
+                     f"{' (budget reached)' if stats['truncated'] else ''}.\n")
+    return text, stats
@@ -0,0 +1,99 @@
+# ml_scripts/embedding_cache.py
+#
+# Memory-bounded LRU cache of CLIP text embeddings, keyed by (text encoder, prompt text).
+# The fixed negative prompt is encoded once at load time and pinned; prompts users iterate
+# on are served from the cache instead of running the text encoder again.
+import os
+import time
+import threading
+import weakref
+from collections import OrderedDict
+
+DEFAULT_MAX_MB = int(os.environ.get("ML_EMBED_CACHE_MB", "64"))
+
+
+class EmbeddingCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # (id(text_encoder), text) -> (encoder weakref, tensor, nbytes, pinned)
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.encode_seconds = 0.0 # time spent in the text encoder on misses
+
+    def get(self, pipeline, text, pin=False):
+        """Returns the [1, 77, dim] prompt embedding for `text`, encoding it on a miss."""
+        encoder = pipeline.text_encoder
+        key = (id(encoder), text)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            # id() values can be reused after an encoder is freed, so check it is the same object
+            if entry is not None and entry[0]() is encoder:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        import torch
+
+        start = time.perf_counter()
+        # encode_prompt applies the pipeline's own tokenizer/truncation, so this matches `prompt=text`
+        device = getattr(pipeline, "_execution_device", pipeline.device)
+        with torch.no_grad():
+            embeds = pipeline.encode_prompt(text, device, 1, False)[0]
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.misses += 1
+            self.encode_seconds += elapsed
+            self._store(key, encoder, embeds, pin)
+        return embeds
+
+    def warm(self, pipeline, text):
+        """Pre-encodes `text` and pins it, e.g. the fixed negative prompt at load time."""
+        return self.get(pipeline, text, pin=True)
+
+    def _store(self, key, encoder, embeds, pin):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        nbytes = embeds.element_size() * embeds.nelement()
+        self.entries[key] = (weakref.ref(encoder), embeds, nbytes, pin)
+        self.bytes += nbytes
+
+        # Evict least-recently-used, unpinned entries (and entries of freed encoders) first
+        for stale_key in [k for k, entry in self.entries.items() if entry[0]() is None]:
+            self.bytes -= self.entries.pop(stale_key)[2]
+        for lru_key in list(self.entries):
+            if self.bytes <= self.max_bytes:
+                break
+            if lru_key != key and not self.entries[lru_key][3]:
+                self.bytes -= self.entries.pop(lru_key)[2]
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        mean_encode = self.encode_seconds / self.misses if self.misses else 0.0
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "encode_seconds": round(self.encode_seconds, 3),
+            # Every hit skipped one text-encoder pass of roughly the mean miss cost
+            "estimated_seconds_saved": round(self.hits * mean_encode, 3),
+        }
+
+
+# Shared per-process instance used by image_gen / img2img_gen / the inference server
+default_cache = EmbeddingCache()
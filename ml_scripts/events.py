@@ -0,0 +1,162 @@
+# ml_scripts/events.py
+#
+# Shared newline-delimited JSON event emitter for every ml_script. Events go to a dedicated
+# channel, separate from the human-readable logs on stderr:
+#   ML_EVENTS_FD=3          write to an inherited file descriptor (app.js opens fd 3 as a pipe)
+#   ML_EVENTS_FILE=<path>   append to a file instead
+# With neither set, emitting is a no-op, so the scripts still run standalone.
+#
+# Event shapes (all carry "event", "script" and "ts"):
+#   {"event": "stage_start", "stage": "load_model"}
+#   {"event": "stage_end", "stage": "load_model", "duration_s": 4.21, "ok": true}
+#   {"event": "progress", "stage": "denoise", "step": 10, "total": 50}
+#   {"event": "warning", "message": "..."}
+#   {"event": "error", "message": "..."}
+#   {"event": "result", "path": "storage/images/...", ...}   (exactly once, on success)
+#   {"event": "profile", "trace": "storage/images/....trace.json"}   (only with --profile)
+#
+# When a script hands its work to inference_server.py, the events emitted while the server
+# runs the operation are streamed back and re-emitted by the script (see forwarding()), so
+# progress looks the same whether the model runs in-process or in the server.
+#
+# Every stage is also recorded as a profiling span (see profiling.py).
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from profiling import PROFILER
+
+
+class EventEmitter:
+    def __init__(self, stream=None, script=None):
+        self.stream = stream
+        self.script = script or os.path.basename(sys.argv[0] or "ml_script")
+        self.lock = threading.Lock()
+        self.result_sent = False
+        self.local = threading.local()
+
+    @classmethod
+    def from_env(cls):
+        stream = None
+        try:
+            if os.environ.get("ML_EVENTS_FD"):
+                stream = os.fdopen(int(os.environ["ML_EVENTS_FD"]), "w", encoding="utf-8", buffering=1)
+            elif os.environ.get("ML_EVENTS_FILE"):
+                stream = open(os.environ["ML_EVENTS_FILE"], "a", encoding="utf-8", buffering=1)
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f"Warning: event channel unavailable ({e}); continuing without events.\n")
+        return cls(stream)
+
+    @property
+    def enabled(self):
+        return self.stream is not None
+
+    def emit(self, event, **fields):
+        sink = getattr(self.local, "sink", None)
+        if self.stream is None and sink is None:
+            return
+        record = {"event": event, "script": self.script, "ts": round(time.time(), 3), **fields}
+        if sink is not None:
+            sink(record)
+        if self.stream is None:
+            return
+        line = json.dumps(record, default=str)
+        with self.lock:
+            try:
+                self.stream.write(line + "\n")
+                self.stream.flush()
+            except (OSError, ValueError):
+                # The reader went away; the job itself should still finish
+                self.stream = None
+
+    @contextmanager
+    def forwarding(self, sink):
+        """Also passes every record emitted on this thread to `sink(record)` (None: no-op)."""
+        previous = getattr(self.local, "sink", None)
+        self.local.sink = sink
+        try:
+            yield
+        finally:
+            self.local.sink = previous
+
+    def forward(self, record):
+        """Re-emits a record received from another process (e.g. the inference server) as our own."""
+        fields = {key: value for key, value in record.items() if key not in ("event", "script", "ts")}
+        self.emit(record["event"], **fields)
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """Emits stage_start/stage_end (with duration and ok flag) around the block."""
+        self.emit("stage_start", stage=name, **fields)
+        start = time.perf_counter()
+        try:
+            with PROFILER.span(name, **fields):
+                yield
+        except BaseException as e:
+            self.emit("stage_end", stage=name, duration_s=round(time.perf_counter() - start, 4), ok=False, error=str(e))
+            raise
+        self.emit("stage_end", stage=name, duration_s=round(time.perf_counter() - start, 4), ok=True)
+
+    def progress(self, stage, step, total):
+        self.emit("progress", stage=stage, step=step, total=total)
+
+    def warning(self, message):
+        self.emit("warning", message=message)
+
+    def error(self, message):
+        self.emit("error", message=message)
+
+    def result(self, **fields):
+        """The single final record of a successful run."""
+        if self.result_sent:
+            raise RuntimeError("result event already emitted")
+        self.result_sent = True
+        self.emit("result", **fields)
+        if PROFILER.enabled and fields.get("path"):
+            trace_path = PROFILER.save(fields["path"])
+            if trace_path:
+                self.emit("profile", trace=trace_path)
+
+
+class StepProgress:
+    """A diffusers `callback_on_step_end` that reports denoising progress as events."""
+
+    def __init__(self, stage, total, emitter=None):
+        self.stage = stage
+        self.total = total
+        self.emitter = emitter or EVENTS
+
+    def __call__(self, pipeline, step, timestep, callback_kwargs):
+        self.emitter.progress(self.stage, step + 1, self.total)
+        return callback_kwargs
+
+
+def pipeline_callback_kwargs(*callbacks):
+    """
+    Keyword arguments attaching the given step callbacks (None entries are skipped) to a
+    diffusers pipeline call. diffusers accepts a single callback, so they are chained.
+    """
+    callbacks = [callback for callback in callbacks if callback is not None]
+    if not callbacks:
+        return {}
+
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        for callback in callbacks:
+            callback_kwargs = callback(pipeline, step, timestep, callback_kwargs)
+        return callback_kwargs
+
+    return {"callback_on_step_end": on_step_end, "callback_on_step_end_tensor_inputs": ["latents"]}
+
+
+# Process-wide emitter used by all scripts
+EVENTS = EventEmitter.from_env()
+
+
+def fail(message, exit_code=1):
+    """Reports a fatal error on stderr and as an error event, then exits the script."""
+    sys.stderr.write(f"{message}\n")
+    EVENTS.error(message)
+    sys.exit(exit_code)
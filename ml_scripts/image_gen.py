@@ -2,96 +2,279 @@
 import sys
 import os
 import random # Import random for default seed generation
-from diffusers import StableDiffusionPipeline
-import torch
-from PIL import Image
+import argparse
+from inference_client import call_server, InferenceServerError
+import embedding_cache
+import quality_tiers
+import latent_preview
+import result_cache
+import renditions
+from events import EVENTS, StepProgress, pipeline_callback_kwargs, fail
+import profiling
+from profiling import PROFILER
 
-def generate_image(prompt, content_id, requested_seed):
-    """
-    Generates an image using Stable Diffusion, optionally using a specific seed for consistency.
-    The function prints the final file path and the seed used to stdout.
-    """
-    
-    # 1. Determine the final seed (Logic is correct)
-    if requested_seed and requested_seed.lower() != "random":
+# torch/diffusers are imported inside the functions below so that the thin-client
+# path (a resident inference_server.py is running) never pays their import cost.
+
+# ⭐ OPTIMIZED PARAMETERS FOR MAX QUALITY AND REALISM ⭐
+# Step count and scheduler come from the quality tier ("max" = 50 steps, see quality_tiers.py)
+DEFAULT_QUALITY = "max"
+DEFAULT_SETTINGS = {
+    "guidance_scale": 11.5,      # <-- TUNED: Forces strong adherence to prompt, boosting CLIP score (was 12.0/too high)
+    "height": 512,
+    "width": 512,
+}
+
+# Negative prompt includes crucial terms for quality
+NEGATIVE_PROMPT = "blurry, low quality, bad anatomy, ugly, disfigured, poorly drawn face, bad hands, mutated, washed out colors, low contrast, text, signature" # <-- Extended list
+
+
+def explicit_seed(requested_seed):
+    """The requested seed as an int, or None when a random seed will be drawn for it."""
+    if requested_seed and str(requested_seed).lower() != "random":
         try:
-            final_seed = int(requested_seed) 
+            return int(requested_seed)
         except ValueError:
-            final_seed = random.randint(1, 1000000000)
-    else:
-        final_seed = random.randint(1, 1000000000)
-    
-    torch.manual_seed(final_seed)
-    random.seed(final_seed)
+            return None
+    return None
 
-    # 2. Load the Stable Diffusion Model (Logic is correct)
-    try:
-        # Using float16 is essential for GPU speed
-        pipeline = StableDiffusionPipeline.from_pretrained("runwayml/stable-diffusion-v1-5", torch_dtype=torch.float16)
-    except Exception as e:
-        sys.stderr.write(f"Error loading Stable Diffusion model: {e}\n")
-        sys.exit(1)
 
-    # 3. Move pipeline to CUDA GPU (Logic is correct)
-    try:
-        if torch.cuda.is_available():
-            pipeline.to("cuda")
-            sys.stderr.write("Using NVIDIA CUDA GPU for image generation. EXPECT FASTER SPEED!\n")
-        else:
-            pipeline.to("cpu")
-            sys.stderr.write("NVIDIA CUDA GPU not available. Falling back to CPU (VERY SLOW).\n")
-    except Exception as e:
-        sys.stderr.write(f"Error with CUDA configuration: {e}\nFalling back to CPU (VERY SLOW).\n")
-        pipeline.to("cpu")
+def resolve_seed(requested_seed):
+    """Returns the integer seed to use for a request ("random"/None/invalid -> new random seed)."""
+    seed = explicit_seed(requested_seed)
+    return seed if seed is not None else random.randint(1, 1000000000)
 
 
-    try:
-        # Negative prompt includes crucial terms for quality
-        negative_prompt = "blurry, low quality, bad anatomy, ugly, disfigured, poorly drawn face, bad hands, mutated, washed out colors, low contrast, text, signature" # <-- Extended list
-
-        # ⭐ OPTIMIZED PARAMETERS FOR MAX QUALITY AND REALISM ⭐
-        generator = torch.Generator(pipeline.device).manual_seed(final_seed) 
-        
-        image = pipeline(
-            prompt,
-            negative_prompt=negative_prompt,
-            num_inference_steps=50,      # <-- INCREASED: Provides maximum detail refinement (was 40)
-            guidance_scale=11.5,         # <-- TUNED: Forces strong adherence to prompt, boosting CLIP score (was 12.0/too high)
-            generator=generator
-        ).images[0]
-    except Exception as e:
-        sys.stderr.write(f"Error during image generation: {e}\n")
-        sys.exit(1)
+def load_pipeline():
+    """Returns the text-to-image view over the shared Stable Diffusion 1.5 components."""
+    import sd_components
+
+    device = sd_components.select_device()
+    # Cheap when the components are resident: the server calls this for every batch
+    first_load = not sd_components.loaded_keys()
+    if first_load and device == "cuda":
+        sys.stderr.write("Using NVIDIA CUDA GPU for image generation. EXPECT FASTER SPEED!\n")
+    elif first_load:
+        sys.stderr.write("NVIDIA CUDA GPU not available. Falling back to CPU (VERY SLOW).\n")
+    pipeline = sd_components.get_pipeline("txt2img", device)
+    if first_load:
+        # Encode the fixed negative prompt once, up front; every request reuses it from the cache
+        embedding_cache.default_cache.warm(pipeline, NEGATIVE_PROMPT)
+    return pipeline
+
+
+def encode_prompts(pipeline, prompts, negative_prompt=NEGATIVE_PROMPT):
+    """
+    Returns (prompt_embeds, negative_prompt_embeds) for a batch of prompts, served from
+    the shared CLIP embedding cache so repeated prompts skip the text encoder.
+    """
+    import torch
+
+    cache = embedding_cache.default_cache
+    prompt_embeds = torch.cat([cache.get(pipeline, prompt) for prompt in prompts])
+    negative_embeds = cache.get(pipeline, negative_prompt).expand(len(prompts), -1, -1)
+    return prompt_embeds, negative_embeds
+
+
+def generation_settings(quality=None, overrides=None):
+    """
+    Settings for one request: the quality tier's step count plus DEFAULT_SETTINGS, with any
+    recognised overrides applied (unknown keys are ignored). Raises ValueError for unknown tiers.
+    """
+    tier = quality_tiers.get_tier(quality or DEFAULT_QUALITY)
+    settings = dict(DEFAULT_SETTINGS, quality=tier["name"], num_inference_steps=tier["num_inference_steps"])
+    for name, value in (overrides or {}).items():
+        if name in DEFAULT_SETTINGS and value is not None:
+            settings[name] = type(DEFAULT_SETTINGS[name])(value)
+    return settings
+
+
+def cache_key(prompt, seed, quality=None):
+    """Result-cache key covering every input that determines the generated pixels."""
+    import sd_components
+
+    settings = generation_settings(quality)
+    return result_cache.generation_key({
+        "kind": "txt2img",
+        "model": sd_components.SD15_MODEL_ID,
+        "prompt": prompt,
+        "negative_prompt": NEGATIVE_PROMPT,
+        "seed": seed,
+        "scheduler": quality_tiers.get_tier(settings["quality"])["scheduler"],
+        **settings,
+    })
+
+
+def batch_key(settings):
+    """Requests with equal keys can share one batched denoise (same tier, steps, guidance and size)."""
+    return tuple(sorted(settings.items()))
+
+
+def render_image_batch(pipeline, requests, settings=None, rendition_worker=None):
+    """
+    Runs several generations as one batched denoise and saves each under storage/images.
+    `requests` is a list of dicts with "prompt", "content_id" and optional "requested_seed"
+    and "preview_every" (write a latent preview every N steps, see latent_preview.py);
+    every request keeps its own seeded torch.Generator, so its image matches what a batch
+    of one would produce. With a `rendition_worker`, WebP/JPEG/thumbnail renditions are
+    queued from the in-memory images once each PNG is durable.
+    Returns [(relative_path, final_seed), ...] in request order.
+    """
+    import torch
+
+    settings = dict(settings or generation_settings())
+    quality_tiers.apply_tier(pipeline, settings.pop("quality"))
+
+    # 1. Determine the final seeds
+    final_seeds = [resolve_seed(request.get("requested_seed")) for request in requests]
+    # Global RNGs are seeded for parity with single-image runs; the generators below decide the output
+    torch.manual_seed(final_seeds[0])
+    random.seed(final_seeds[0])
 
-    # 4. Save the Image (Logic is correct)
     output_dir = os.path.join(os.path.dirname(__file__), '..', 'storage', 'images')
     if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
 
-    output_filename = f"image_{content_id}_{final_seed}.png"
-    output_path = os.path.join(output_dir, output_filename)
-    relative_path = f"storage/images/{output_filename}"
+    # Optional live previews: image_<id>_preview.jpg is refreshed while denoising
+    previewer = None
+    preview_steps = [int(request["preview_every"]) for request in requests if request.get("preview_every")]
+    if preview_steps:
+        previewer = latent_preview.LatentPreviewer(
+            [os.path.join(output_dir, f"image_{request['content_id']}_preview.jpg") if request.get("preview_every") else None
+             for request in requests],
+            every_n_steps=min(preview_steps),
+        )
 
     try:
-        image.save(output_path)
+        generators = [torch.Generator(pipeline.device).manual_seed(seed) for seed in final_seeds]
+        with PROFILER.span("encode_prompt"):
+            prompt_embeds, negative_embeds = encode_prompts(pipeline, [request["prompt"] for request in requests])
+
+        with PROFILER.span("sample", batch_size=len(requests)), PROFILER.torch_profile("sample"):
+            images = pipeline(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_embeds,
+                generator=generators,
+                **settings,
+                **pipeline_callback_kwargs(StepProgress("denoise", settings["num_inference_steps"]), previewer)
+            ).images
     except Exception as e:
-        sys.stderr.write(f"Error saving generated image: {e}\n")
-        sys.exit(1)
+        raise RuntimeError(f"Error during image generation: {e}")
 
-    # 5. CRITICAL: Print the file path AND the final seed for Node.js to parse
-    print(f"{relative_path}:{final_seed}")
-    
-# --- Execution Block (Logic is correct) ---
+    if previewer is not None:
+        sys.stderr.write(f"Latent previews: {previewer.stats()}\n")
 
-if __name__ == "__main__":
-    if len(sys.argv) >= 3:
-        prompt_arg = sys.argv[1]
-        content_id_arg = sys.argv[2]
-        requested_seed_arg = sys.argv[3] if len(sys.argv) > 3 else None
-        
-        generate_image(prompt_arg, content_id_arg, requested_seed_arg)
+    # 2. Save the Images
+    results = []
+    for request, final_seed, image in zip(requests, final_seeds, images):
+        output_filename = f"image_{request['content_id']}_{final_seed}.png"
+        output_path = os.path.join(output_dir, output_filename)
+
+        try:
+            with PROFILER.span("save"):
+                renditions.save_primary(image, output_path)
+        except Exception as e:
+            raise RuntimeError(f"Error saving generated image: {e}")
+
+        if rendition_worker is not None:
+            rendition_worker.submit(image, f"storage/images/{output_filename}")
+        results.append((f"storage/images/{output_filename}", final_seed))
+
+    return results
+
+
+def render_image(pipeline, prompt, content_id, requested_seed, quality=None, preview_every=None, rendition_worker=None):
+    """
+    Runs one generation on an already-loaded pipeline and saves it under storage/images.
+    Returns (relative_path, final_seed).
+    """
+    request = {"prompt": prompt, "content_id": content_id, "requested_seed": requested_seed, "preview_every": preview_every}
+    return render_image_batch(pipeline, [request], settings=generation_settings(quality), rendition_worker=rendition_worker)[0]
+
+
+def generate_image(prompt, content_id, requested_seed, quality=None, preview_every=None):
+    """
+    Generates an image using Stable Diffusion, optionally using a specific seed for consistency.
+    Uses the resident inference server when one is running, otherwise loads the model here.
+    The function prints the final file path and the seed used to stdout.
+    """
+    # Remembered seeds make repeats common: an identical earlier generation is returned as is
+    seed = explicit_seed(requested_seed)
+    if seed is not None:
+        with EVENTS.stage("result_cache"):
+            cached = result_cache.default_cache.lookup(cache_key(prompt, seed, quality))
+        if cached is not None:
+            sys.stderr.write(f"Result cache hit: reusing {cached['path']}\n")
+            EVENTS.result(path=cached["path"], seed=seed, cached=True)
+            print(f"{cached['path']}:{seed}", flush=True)
+            # Normally already written by the original generation; this only fills gaps
+            finish_renditions(from_png=cached["path"])
+            return
+
+    try:
+        with EVENTS.stage("remote_generate"):
+            result = call_server("generate_image", {
+                "prompt": prompt,
+                "content_id": content_id,
+                "requested_seed": requested_seed,
+                "quality": quality,
+                "preview_every": preview_every,
+            }, on_event=EVENTS.forward) # The server's stages and denoise steps, as if run here
+    except InferenceServerError as e:
+        fail(f"Inference server error: {e}")
+
+    if result is not None:
+        relative_path, final_seed = result["path"], result["seed"]
     else:
-        sys.stderr.write("Usage: python image_gen.py <prompt> <content_id> [seed_value]\n")
-        sys.exit(1)
+        # No server running: load the model in this process (slow path)
+        try:
+            with EVENTS.stage("load_model"):
+                pipeline = load_pipeline()
+        except Exception as e:
+            fail(f"Error loading Stable Diffusion model: {e}")
+
+        try:
+            with EVENTS.stage("generate", quality=quality or DEFAULT_QUALITY):
+                relative_path, final_seed = render_image(pipeline, prompt, content_id, requested_seed, quality, preview_every,
+                                                         rendition_worker=renditions.default_worker)
+        except RuntimeError as e:
+            fail(str(e))
+
+    try:
+        result_cache.default_cache.store(cache_key(prompt, final_seed, quality), relative_path, content_id=content_id)
+    except OSError as e:
+        sys.stderr.write(f"Warning: could not add the result to the cache: {e}\n")
+
+    EVENTS.result(path=relative_path, seed=final_seed)
+    # CRITICAL: Print the file path AND the final seed for Node.js to parse
+    print(f"{relative_path}:{final_seed}", flush=True)
 
+    # The server renders without renditions, so encode them here from the saved PNG
+    finish_renditions(from_png=relative_path if result is not None else None)
+
+
+def finish_renditions(from_png=None):
+    """
+    Waits for this process's renditions once the result has been reported. `from_png`
+    queues renditions of an image that was not rendered in this process first.
+    """
+    if from_png:
+        renditions.default_worker.submit(None, from_png)
+    with EVENTS.stage("renditions"):
+        renditions.default_worker.drain()
+
+# --- Execution Block (Logic is correct) ---
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python image_gen.py <prompt> <content_id> [seed_value] [--quality draft|standard|max] [--preview-every N]")
+    parser.add_argument("prompt")
+    parser.add_argument("content_id")
+    parser.add_argument("seed", nargs="?", default=None)
+    parser.add_argument("--quality", choices=quality_tiers.tier_names(), default=DEFAULT_QUALITY)
+    parser.add_argument("--preview-every", type=int, default=None,
+                        help="Write storage/images/image_<content_id>_preview.jpg every N denoising steps")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
 
+    generate_image(args.prompt, args.content_id, args.seed, args.quality, args.preview_every)
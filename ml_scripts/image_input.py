@@ -0,0 +1,42 @@
+# ml_scripts/image_input.py
+#
+# Loading of user-supplied init images. Uploads reach the scripts as a file path, as raw
+# bytes on stdin ("-") or as bytes inside a server payload - never as base64 on argv - and
+# JPEGs are decoded at reduced resolution (draft mode), so a 10 MB upload is never
+# materialised at full size just to be resized to 512x512.
+import io
+import sys
+
+INIT_IMAGE_SIZE = (512, 512)
+
+
+def read_source(source):
+    """Turns a path, "-" (stdin) or bytes into something PIL can open."""
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source)
+    if source == "-":
+        return io.BytesIO(sys.stdin.buffer.read())
+    return source # A path: PIL reads it lazily, so only the header is touched up front
+
+
+def source_bytes(source):
+    """The raw encoded bytes of a path, "-" (stdin) or bytes source, e.g. for content hashing."""
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    if source == "-":
+        return sys.stdin.buffer.read()
+    with open(source, "rb") as f:
+        return f.read()
+
+
+def decode_image(source, size=INIT_IMAGE_SIZE):
+    """Decodes `source` straight to an RGB image of `size`."""
+    from PIL import Image
+
+    with Image.open(read_source(source)) as image:
+        # JPEG only (a no-op for other formats): the decoder scales by 1/2, 1/4 or 1/8 in
+        # the DCT domain, picking the smallest scale that is still at least `size`
+        image.draft("RGB", size)
+        rgb = image.convert("RGB")
+    # reducing_gap lets Pillow shrink by an integer factor first, then resample the rest
+    return rgb.resize(size, reducing_gap=3.0)
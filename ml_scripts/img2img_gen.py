@@ -1,104 +1,214 @@
 # ml_scripts/img2img_gen.py
 import sys
 import os
-import random 
-from diffusers import StableDiffusionImg2ImgPipeline
-import torch
-from PIL import Image
-import base64 
-from io import BytesIO 
-
-# The signature now requires the base64 image data
-def generate_img2img(prompt, content_id, requested_seed, base64_image, mime_type):
-    
-    # 1. Determine the final seed
-    if requested_seed and requested_seed.lower() != "random":
+import random
+import argparse
+import base64
+from inference_client import call_server, InferenceServerError
+from image_gen import NEGATIVE_PROMPT, encode_prompts, finish_renditions
+import embedding_cache
+import quality_tiers
+import latent_preview
+import image_input
+import latent_cache
+import renditions
+from events import EVENTS, StepProgress, pipeline_callback_kwargs, fail
+import profiling
+from profiling import PROFILER
+
+DEFAULT_QUALITY = "max" # 50 steps with the checkpoint's scheduler, as before
+
+# torch/diffusers/PIL are imported inside the functions below so that the thin-client
+# path (a resident inference_server.py is running) never pays their import cost.
+
+def resolve_seed(requested_seed):
+    """Returns the integer seed to use for a request ("random"/None/invalid -> new random seed)."""
+    if requested_seed and str(requested_seed).lower() != "random":
         try:
-            final_seed = int(requested_seed) 
+            return int(requested_seed)
         except ValueError:
-            final_seed = random.randint(1, 1000000000)
-    else:
-        final_seed = random.randint(1, 1000000000)
-    
+            return random.randint(1, 1000000000)
+    return random.randint(1, 1000000000)
+
+
+def load_pipeline():
+    """Returns the image-to-image view over the shared Stable Diffusion 1.5 components."""
+    import sd_components
+
+    device = sd_components.select_device()
+    # Cheap when the components are resident: the server calls this for every request
+    first_load = not sd_components.loaded_keys()
+    # StableDiffusionImg2ImgPipeline is the correct pipeline for I2I
+    pipeline = sd_components.get_pipeline("img2img", device)
+    if first_load:
+        sys.stderr.write(f"Using Image-to-Image pipeline on {device.upper()}.\n")
+        # Same text encoder as txt2img, so this is a cache hit when both modes are served
+        embedding_cache.default_cache.warm(pipeline, NEGATIVE_PROMPT)
+    return pipeline
+
+
+def decode_init_image(image_source):
+    """
+    Decodes the upload (a file path or raw bytes) at a standard diffusion size (512x512).
+    Large JPEGs are downscaled while decoding rather than after.
+    """
+    if not image_source:
+        # This function should only be called for I2I, but as a safety check:
+        raise RuntimeError("Error: Base image data is missing for Image-to-Image generation.")
+    try:
+        return image_input.decode_image(image_source)
+    except Exception as e:
+        raise RuntimeError(f"Error decoding input image: {e}")
+
+
+def render_img2img(pipeline, prompt, content_id, requested_seed, image_source, quality=None, preview_every=None,
+                   rendition_worker=None):
+    """
+    Runs one image-to-image edit on an already-loaded pipeline and saves it under storage/images.
+    `image_source` is a file path or the raw image bytes. With a `rendition_worker`, the
+    WebP/JPEG/thumbnail renditions are queued once the PNG is durable.
+    Returns (relative_path, final_seed). Used both by the CLI and by inference_server.py.
+    """
+    import torch
+
+    # 1. Determine the final seed
+    final_seed = resolve_seed(requested_seed)
     torch.manual_seed(final_seed)
     random.seed(final_seed)
 
-    # 2. Load Model and Device
+    # 2. Read the Input Image (CRITICAL I2I STEP); it is decoded and encoded below
     try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        # StableDiffusionImg2ImgPipeline is the correct pipeline for I2I
-        pipeline = StableDiffusionImg2ImgPipeline.from_pretrained("runwayml/stable-diffusion-v1-5", torch_dtype=torch.float16).to(device)
-        sys.stderr.write(f"Using Image-to-Image pipeline on {device.upper()}.\n")
-            
-    except Exception as e:
-        sys.stderr.write(f"Error loading Stable Diffusion Img2Img model: {e}\n")
-        sys.exit(1)
+        image_bytes = image_input.source_bytes(image_source)
+    except OSError as e:
+        raise RuntimeError(f"Error reading input image: {e}")
 
-    # 3. Load and Decode Input Image (CRITICAL I2I STEP)
-    init_image = None
-    if base64_image:
-        try:
-            image_bytes = base64.b64decode(base64_image)
-            # Decode and resize to a standard diffusion size (512x512)
-            init_image = Image.open(BytesIO(image_bytes)).convert("RGB").resize((512, 512))
-        except Exception as e:
-            sys.stderr.write(f"Error decoding input image: {e}\n")
-            sys.exit(1)
-    else:
-        # This function should only be called for I2I, but as a safety check:
-        sys.stderr.write("Error: Base image data is missing for Image-to-Image generation.\n")
-        sys.exit(1)
+    output_dir = os.path.join(os.path.dirname(__file__), '..', 'storage', 'images')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
 
+    # Optional live previews: image_edit_<id>_preview.jpg is refreshed while denoising
+    previewer = None
+    if preview_every:
+        previewer = latent_preview.LatentPreviewer(
+            [os.path.join(output_dir, f"image_edit_{content_id}_preview.jpg")], every_n_steps=preview_every
+        )
 
     try:
-        negative_prompt = "blurry, low quality, bad anatomy, ugly, disfigured, poorly drawn face, bad hands, mutated, washed out colors, low contrast, text, signature"
-        generator = torch.Generator(pipeline.device).manual_seed(final_seed) 
-        
+        num_inference_steps = quality_tiers.apply_tier(pipeline, quality or DEFAULT_QUALITY)
+        generator = torch.Generator(pipeline.device).manual_seed(final_seed)
+
+        # Repeat edits of the same upload reuse its VAE latents (decode + encoder pass skipped).
+        # The pipeline treats 4-channel input as latents and skips its own VAE encode.
+        with PROFILER.span("init_latents"):
+            init_latents = latent_cache.default_cache.init_latents(pipeline, image_bytes, decode_init_image, generator)
+
+        with PROFILER.span("encode_prompt"):
+            prompt_embeds, negative_embeds = encode_prompts(pipeline, [prompt])
+
         # --- Image-to-Image Generation (I2I) ---
-        image = pipeline(
-            prompt=prompt,
-            image=init_image, 
-            negative_prompt=negative_prompt,
-            num_inference_steps=50,
-            guidance_scale=11.5,
-            strength=0.9, 
-            generator=generator
-        ).images[0]
+        with PROFILER.span("sample"), PROFILER.torch_profile("sample"):
+            image = pipeline(
+                prompt_embeds=prompt_embeds,
+                image=init_latents,
+                negative_prompt_embeds=negative_embeds,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=11.5,
+                strength=0.9,
+                generator=generator,
+                # img2img only runs the last `strength` fraction of the schedule
+                **pipeline_callback_kwargs(StepProgress("denoise", int(num_inference_steps * 0.9)), previewer)
+            ).images[0]
 
     except Exception as e:
-        sys.stderr.write(f"Error during image-to-image generation: {e}\n")
-        sys.exit(1)
+        raise RuntimeError(f"Error during image-to-image generation: {e}")
 
-    # 4. Save the Image
-    output_dir = os.path.join(os.path.dirname(__file__), '..', 'storage', 'images')
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    if previewer is not None:
+        sys.stderr.write(f"Latent previews: {previewer.stats()}\n")
+    sys.stderr.write(f"Init latent cache: {latent_cache.default_cache.stats()}\n")
 
+    # 3. Save the Image
     output_filename = f"image_edit_{content_id}_{final_seed}.png"
     output_path = os.path.join(output_dir, output_filename)
     relative_path = f"storage/images/{output_filename}"
 
     try:
-        image.save(output_path)
+        with PROFILER.span("save"):
+            renditions.save_primary(image, output_path)
     except Exception as e:
-        sys.stderr.write(f"Error saving generated image: {e}\n")
-        sys.exit(1)
+        raise RuntimeError(f"Error saving generated image: {e}")
+
+    if rendition_worker is not None:
+        rendition_worker.submit(image, relative_path)
+    return relative_path, final_seed
+
+
+def generate_img2img(prompt, content_id, requested_seed, image_source, quality=None, preview_every=None):
+    """
+    `image_source` is a path to the uploaded image, "-" to read its raw bytes from stdin,
+    or the bytes themselves.
+    """
+    if image_source == "-":
+        image_source = sys.stdin.buffer.read()
+
+    # The server shares our filesystem (it writes to storage/ for us), so a path is enough;
+    # bytes from stdin travel in the JSON body, which has no argv-style size limit
+    if isinstance(image_source, (bytes, bytearray)):
+        image_field = {"base64_image": base64.b64encode(image_source).decode("ascii")}
+    else:
+        image_field = {"image_path": os.path.abspath(image_source)}
+
+    try:
+        with EVENTS.stage("remote_generate"):
+            result = call_server("generate_img2img", {
+                "prompt": prompt,
+                "content_id": content_id,
+                "requested_seed": requested_seed,
+                **image_field,
+                "quality": quality,
+                "preview_every": preview_every,
+            }, on_event=EVENTS.forward) # The server's stages and denoise steps, as if run here
+    except InferenceServerError as e:
+        fail(f"Inference server error: {e}")
+
+    if result is not None:
+        relative_path, final_seed = result["path"], result["seed"]
+    else:
+        # No server running: load the model in this process (slow path)
+        try:
+            with EVENTS.stage("load_model"):
+                pipeline = load_pipeline()
+        except Exception as e:
+            fail(f"Error loading Stable Diffusion Img2Img model: {e}")
+
+        try:
+            with EVENTS.stage("generate", quality=quality or DEFAULT_QUALITY):
+                relative_path, final_seed = render_img2img(pipeline, prompt, content_id, requested_seed, image_source, quality, preview_every,
+                                                           rendition_worker=renditions.default_worker)
+        except RuntimeError as e:
+            fail(str(e))
+
+    EVENTS.result(path=relative_path, seed=final_seed)
+    # CRITICAL: Print the file path AND the final seed for Node.js to parse
+    print(f"{relative_path}:{final_seed}", flush=True)
+
+    # The server renders without renditions, so encode them here from the saved PNG
+    finish_renditions(from_png=relative_path if result is not None else None)
 
-    # 5. CRITICAL: Print the file path AND the final seed for Node.js to parse
-    print(f"{relative_path}:{final_seed}")
-    
 # --- Execution Block ---
 
 if __name__ == "__main__":
-    # Expects arguments: [script_path, prompt, content_id, requested_seed, base64_image, mime_type]
-    if len(sys.argv) >= 6:
-        prompt_arg = sys.argv[1]
-        content_id_arg = sys.argv[2]
-        requested_seed_arg = sys.argv[3] 
-        base64_image_arg = sys.argv[4]
-        mime_type_arg = sys.argv[5] 
-
-        generate_img2img(prompt_arg, content_id_arg, requested_seed_arg, base64_image_arg, mime_type_arg)
-    else:
-        sys.stderr.write("Usage: python img2img_gen.py <prompt> <content_id> <seed> <base64_image> <mime_type>\n")
-        sys.exit(1)
\ No newline at end of file
+    # Expects arguments: [script_path, prompt, content_id, requested_seed, image] [--quality tier]
+    # where image is a file path, or "-" to stream the raw image bytes on stdin
+    parser = argparse.ArgumentParser(usage="python img2img_gen.py <prompt> <content_id> <seed> <image_path|-> [--quality draft|standard|max] [--preview-every N]")
+    parser.add_argument("prompt")
+    parser.add_argument("content_id")
+    parser.add_argument("seed")
+    parser.add_argument("image", help='Path to the init image, or "-" to read its bytes from stdin')
+    parser.add_argument("--quality", choices=quality_tiers.tier_names(), default=DEFAULT_QUALITY)
+    parser.add_argument("--preview-every", type=int, default=None,
+                        help="Write storage/images/image_edit_<content_id>_preview.jpg every N denoising steps")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+
+    generate_img2img(args.prompt, args.content_id, args.seed, args.image, args.quality, args.preview_every)
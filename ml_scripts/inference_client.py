@@ -0,0 +1,68 @@
+# ml_scripts/inference_client.py
+import os
+import json
+import socket
+import urllib.request
+import urllib.error
+
+# --- Configuration ---
+# Must match the address inference_server.py is listening on.
+ML_SERVER_HOST = os.environ.get("ML_SERVER_HOST", "127.0.0.1")
+ML_SERVER_PORT = int(os.environ.get("ML_SERVER_PORT", "8765"))
+
+# Set ML_SERVER_DISABLE=1 to always run the models inside the calling script.
+ML_SERVER_DISABLE = os.environ.get("ML_SERVER_DISABLE", "0") == "1"
+
+
+class InferenceServerError(RuntimeError):
+    """Raised when the server was reached but the operation itself failed."""
+
+
+def call_server(operation, payload, timeout=3600, on_event=None):
+    """
+    Runs `operation` on the resident inference server and returns its result dict.
+    Returns None when no server is running, so callers can fall back to loading
+    the models themselves. With `on_event`, the server streams the events it emits while
+    running the operation (stages, denoise progress) and each is passed to on_event(record).
+    """
+    if ML_SERVER_DISABLE:
+        return None
+
+    url = f"http://{ML_SERVER_HOST}:{ML_SERVER_PORT}/{operation}"
+    if on_event is not None:
+        payload = {**payload, "stream_events": True}
+    body = json.dumps(payload).encode("utf-8")
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            if response.headers.get_content_type() == "application/x-ndjson":
+                # One JSON line per event, then the usual {"ok": ...} response as the last line
+                data = None
+                for line in response:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line.decode("utf-8"))
+                    if "event" in record:
+                        on_event(record)
+                    else:
+                        data = record
+                if data is None:
+                    raise InferenceServerError("Inference server closed the event stream without a result")
+            else:
+                data = json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as err:
+        # The server answered, so the error body describes the failed operation
+        try:
+            data = json.loads(err.read().decode("utf-8"))
+        except ValueError:
+            raise InferenceServerError(f"Inference server returned HTTP {err.code}")
+    except (urllib.error.URLError, ConnectionError, socket.timeout) as err:
+        reason = getattr(err, "reason", err)
+        if isinstance(reason, (ConnectionRefusedError, FileNotFoundError, socket.gaierror)) or isinstance(err, ConnectionRefusedError):
+            return None
+        raise InferenceServerError(f"Could not reach inference server: {reason}")
+
+    if not data.get("ok"):
+        raise InferenceServerError(data.get("error", "Unknown inference server error"))
+    return data["result"]
@@ -0,0 +1,328 @@
+# ml_scripts/inference_server.py
+#
+# Long-lived local inference server. Loads the diffusion pipelines once and keeps them
+# resident, so image_gen.py / img2img_gen.py / svd_video_gen.py only have to forward
+# their arguments instead of re-importing torch and reloading the weights per request.
+# Which models stay in VRAM, move to RAM or get dropped is decided by residency.py under
+# ML_VRAM_BUDGET_MB / ML_RAM_BUDGET_MB; models idle past ML_MODEL_IDLE_TTL_S are evicted.
+#
+# Start it next to the Node.js app:
+#     python ml_scripts/inference_server.py [--host 127.0.0.1] [--port 8765] [--preload generate_image]
+#
+# Protocol: POST /<operation> with a JSON body, answered with {"ok": true, "result": {...}}
+# or {"ok": false, "error": "..."}. GET /health reports the resident models and
+# GET /metrics the txt2img batch-size / queue-wait statistics.
+# With "stream_events": true in the body, the answer is application/x-ndjson instead: every
+# event the operation emits (stages, denoise progress; see events.py) as it happens, one per
+# line, then the usual response object as the last line. The calling script re-emits them,
+# so app.js sees step progress for server-backed jobs too.
+import sys
+import json
+import time
+import base64
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from events import EVENTS
+
+from inference_client import ML_SERVER_HOST, ML_SERVER_PORT
+import image_gen
+import img2img_gen
+import svd_video_gen
+import sd_components
+from batching import MicroBatcher
+import embedding_cache
+import latent_cache
+import quality_tiers
+import profiling
+import residency
+
+MAX_BODY_BYTES = 64 * 1024 * 1024 # Generous limit for base64 init images streamed from stdin
+IDLE_EVICTION_INTERVAL_S = 30
+
+# Fields each operation needs; anything else in the payload is optional
+REQUIRED_FIELDS = {
+    "generate_image": ("prompt", "content_id"),
+    "generate_img2img": ("prompt", "content_id"), # plus image_path or base64_image
+    "generate_svd_video": ("prompt", "content_id"),
+}
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class InferenceServer:
+    def __init__(self, batch_window_ms=50, max_batch_size=4):
+        # A single worker thread: model loads and GPU jobs run one at a time, so two
+        # concurrent requests never hold two copies of a model or fight over VRAM.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self.operations = {
+            "generate_image": self._generate_image,
+            "generate_img2img": self._generate_img2img,
+            "generate_svd_video": self._generate_svd_video,
+        }
+        self.stats = {"requests": 0, "failures": 0}
+        # txt2img requests with the same settings are denoised together (see batching.py)
+        self.image_batcher = MicroBatcher(
+            self._render_image_batch, self.executor,
+            window_ms=batch_window_ms, max_batch_size=max_batch_size
+        )
+
+    # --- Pipeline management (runs on the worker thread) ---
+
+    def _get_pipeline(self, name, loader):
+        # No reference is kept here: the loaders acquire through residency.py, which returns
+        # resident models immediately and restores or reloads evicted ones
+        start = time.perf_counter()
+        pipeline = loader()
+        elapsed = time.perf_counter() - start
+        if elapsed > 1.0:
+            sys.stderr.write(f"'{name}' pipeline ready in {elapsed:.1f}s.\n")
+        return pipeline
+
+    # --- Operations: same inputs/outputs as the CLI scripts ---
+
+    async def _generate_image(self, payload):
+        settings = image_gen.generation_settings(payload.get("quality"), payload.get("settings"))
+        return await self.image_batcher.submit(image_gen.batch_key(settings), payload)
+
+    def _render_image_batch(self, key, payloads):
+        # Every request in the batch sees the shared denoise progress
+        sinks = [payload["_event_sink"] for payload in payloads if payload.get("_event_sink")]
+        with EVENTS.forwarding(_fan_out(sinks) if sinks else None):
+            pipeline = self._get_pipeline("txt2img", image_gen.load_pipeline)
+            if len(payloads) > 1:
+                sys.stderr.write(f"Running batched txt2img denoise for {len(payloads)} requests.\n")
+            results = image_gen.render_image_batch(pipeline, payloads, settings=dict(key))
+        return [{"path": relative_path, "seed": final_seed} for relative_path, final_seed in results]
+
+    def _generate_img2img(self, payload):
+        pipeline = self._get_pipeline("img2img", img2img_gen.load_pipeline)
+        # Clients on this machine send a path; bytes they read from stdin arrive base64-encoded
+        image_source = payload.get("image_path") or base64.b64decode(payload["base64_image"])
+        relative_path, final_seed = img2img_gen.render_img2img(
+            pipeline, payload["prompt"], payload["content_id"], payload.get("requested_seed"),
+            image_source, payload.get("quality"), payload.get("preview_every")
+        )
+        return {"path": relative_path, "seed": final_seed}
+
+    def _generate_svd_video(self, payload):
+        device = svd_video_gen.get_device()
+        # Phase 1 uses the same shared SD 1.5 view as generate_image (see sd_components.py)
+        image_pipeline = self._get_pipeline("txt2img", lambda: svd_video_gen.load_image_pipeline(device))
+        starting_image = svd_video_gen.render_keyframe(image_pipeline, payload["prompt"], payload.get("quality"))
+        # Let the residency manager move the SD weights out of VRAM if SVD needs the room
+        del image_pipeline
+
+        svd_pipeline = self._get_pipeline("svd", lambda: svd_video_gen.load_video_pipeline(device))
+        relative_path = svd_video_gen.render_video(
+            svd_pipeline, starting_image, payload["content_id"],
+            payload.get("num_frames") or svd_video_gen.DEFAULT_NUM_FRAMES
+        )
+        return {"path": relative_path}
+
+    async def run_operation(self, name, payload):
+        operation = self.operations[name]
+        if asyncio.iscoroutinefunction(operation):
+            return await operation(payload)
+
+        def run():
+            with EVENTS.forwarding(payload.get("_event_sink")):
+                return operation(payload)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, run)
+
+    async def preload(self, operation_names):
+        """Runs the loaders for the given operations up front instead of on first request."""
+        loaders = {
+            "generate_image": lambda: self._get_pipeline("txt2img", image_gen.load_pipeline),
+            "generate_img2img": lambda: self._get_pipeline("img2img", img2img_gen.load_pipeline),
+            "generate_svd_video": lambda: (
+                self._get_pipeline("txt2img", lambda: svd_video_gen.load_image_pipeline(svd_video_gen.get_device())),
+                self._get_pipeline("svd", lambda: svd_video_gen.load_video_pipeline(svd_video_gen.get_device())),
+            ),
+        }
+        loop = asyncio.get_running_loop()
+        for name in operation_names:
+            if name not in loaders:
+                sys.stderr.write(f"Unknown operation to preload: {name}\n")
+                continue
+            await loop.run_in_executor(self.executor, loaders[name])
+
+    # --- Minimal HTTP/1.1 handling (one request per connection) ---
+
+    async def handle_connection(self, reader, writer):
+        status, response = 500, {"ok": False, "error": "Internal server error"}
+        try:
+            request_line = (await reader.readline()).decode("latin-1").strip()
+            method, target, _ = request_line.split(" ", 2)
+
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                key, _, value = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+
+            content_length = int(headers.get("content-length", "0"))
+            if content_length > MAX_BODY_BYTES:
+                status, response = 413, {"ok": False, "error": "Request body too large"}
+            else:
+                body = await reader.readexactly(content_length) if content_length else b""
+                status, response = await self.dispatch(method, target.strip("/"), body, writer)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, response = 400, {"ok": False, "error": f"Malformed request: {e}"}
+        finally:
+            if response is None:
+                return # Already streamed by dispatch()
+            data = json.dumps(response).encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'Error')}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+                + data
+            )
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+
+    async def dispatch(self, method, operation, body, writer=None):
+        if method == "GET" and operation == "metrics":
+            return 200, {"ok": True, "result": {
+                "generate_image_batching": self.image_batcher.metrics.as_dict(),
+                "generate_image_pending": self.image_batcher.pending_count(),
+                "embedding_cache": embedding_cache.default_cache.stats(),
+                "latent_cache": latent_cache.default_cache.stats(),
+            }}
+        if method == "GET" and operation == "health":
+            return 200, {"ok": True, "result": {
+                "shared_components": sd_components.loaded_keys(),
+                "residency": residency.default_manager.stats(),
+                **self.stats,
+            }}
+        if method != "POST" or operation not in self.operations:
+            return 404, {"ok": False, "error": f"Unknown operation: {method} /{operation}"}
+
+        try:
+            payload = json.loads(body.decode("utf-8") or "{}")
+        except ValueError as e:
+            return 400, {"ok": False, "error": f"Invalid JSON body: {e}"}
+
+        missing = [field for field in REQUIRED_FIELDS[operation] if field not in payload]
+        if missing:
+            return 400, {"ok": False, "error": f"Missing field(s) in request: {', '.join(missing)}"}
+        if operation == "generate_img2img" and not (payload.get("image_path") or payload.get("base64_image")):
+            return 400, {"ok": False, "error": "Missing field(s) in request: image_path or base64_image"}
+        if payload.get("quality"):
+            try:
+                quality_tiers.get_tier(payload["quality"])
+            except ValueError as e:
+                return 400, {"ok": False, "error": str(e)}
+
+        if payload.pop("stream_events", False) and writer is not None:
+            await self._stream_operation(operation, payload, writer)
+            return None, None
+        return await self._execute(operation, payload)
+
+    async def _execute(self, operation, payload):
+        self.stats["requests"] += 1
+        start = time.perf_counter()
+        try:
+            result = await self.run_operation(operation, payload)
+        except Exception as e:
+            self.stats["failures"] += 1
+            sys.stderr.write(f"Operation {operation} failed: {e}\n")
+            return 500, {"ok": False, "error": str(e)}
+
+        sys.stderr.write(f"Operation {operation} finished in {time.perf_counter() - start:.1f}s.\n")
+        return 200, {"ok": True, "result": result}
+
+    async def _stream_operation(self, operation, payload, writer):
+        """Runs the operation, writing its events as NDJSON lines and the response as the last line."""
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        # Events are emitted on the worker thread; hand them to the event loop
+        payload["_event_sink"] = lambda record: loop.call_soon_threadsafe(events.put_nowait, record)
+
+        def write_line(record):
+            writer.write(json.dumps(record, default=str).encode("utf-8") + b"\n")
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nConnection: close\r\n\r\n")
+        task = asyncio.ensure_future(self._execute(operation, payload))
+        try:
+            while not task.done():
+                next_event = asyncio.ensure_future(events.get())
+                await asyncio.wait({task, next_event}, return_when=asyncio.FIRST_COMPLETED)
+                if next_event.done():
+                    write_line(next_event.result())
+                else:
+                    next_event.cancel()
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass # The client went away; the job still finishes
+            await asyncio.sleep(0) # Let the last call_soon_threadsafe callbacks run
+            while not events.empty():
+                write_line(events.get_nowait())
+            _, response = await task
+            write_line(response)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def _fan_out(sinks):
+    def sink(record):
+        for each in sinks:
+            each(record)
+    return sink
+
+
+async def serve(host, port, preload, batch_window_ms, max_batch_size):
+    server = InferenceServer(batch_window_ms=batch_window_ms, max_batch_size=max_batch_size)
+    if preload:
+        await server.preload(preload)
+
+    tcp_server = await asyncio.start_server(server.handle_connection, host, port)
+    sys.stderr.write(f"Inference server listening on http://{host}:{port}\n")
+    eviction_task = asyncio.create_task(evict_idle_models(server))
+    try:
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    finally:
+        eviction_task.cancel()
+
+
+async def evict_idle_models(server, interval_s=IDLE_EVICTION_INTERVAL_S):
+    """Periodically frees models unused for longer than the idle TTL."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval_s)
+        # On the worker thread, so eviction never races a running job
+        await loop.run_in_executor(server.executor, residency.default_manager.evict_idle)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resident inference server for the ml_scripts pipelines.")
+    parser.add_argument("--host", default=ML_SERVER_HOST)
+    parser.add_argument("--port", type=int, default=ML_SERVER_PORT)
+    parser.add_argument("--preload", default="", help="Comma-separated operations whose models are loaded at startup")
+    parser.add_argument("--batch-window-ms", type=int, default=50,
+                        help="How long a txt2img request waits for compatible requests to batch with")
+    parser.add_argument("--max-batch-size", type=int, default=4,
+                        help="Largest txt2img batch denoised at once (bounded by VRAM)")
+    # Spans from every request are kept and written to storage/profiles/ on shutdown
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+
+    preload_ops = [name.strip() for name in args.preload.split(",") if name.strip()]
+    try:
+        asyncio.run(serve(args.host, args.port, preload_ops, args.batch_window_ms, args.max_batch_size))
+    except KeyboardInterrupt:
+        sys.stderr.write("Inference server stopped.\n")
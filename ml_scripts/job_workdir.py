@@ -0,0 +1,114 @@
+# ml_scripts/job_workdir.py
+#
+# Per-job work directory for multi-stage jobs (story_to_video_gen.py), so a failed job can be
+# resumed from the stage that failed instead of being rerun from the start:
+#   storage/jobs/<job_id>/
+#     job.json              {"source_sha256": ..., "artifacts": {name: {...metadata}}}
+#     text.txt, scenes.json, keyframes/scene_001.png, segments/scene_001.mp4, ...
+#
+# An artifact counts as done only when it was recorded in job.json after being written, and
+# its validator (if any) still accepts it. Files are written to a temporary name and renamed,
+# so an interrupted write never looks finished.
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+JOBS_DIR = os.path.join(PROJECT_ROOT, 'storage', 'jobs')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def atomic_write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class JobWorkdir:
+    def __init__(self, job_id, resume=False, source_path=None, jobs_dir=JOBS_DIR):
+        """
+        Opens storage/jobs/<job_id>. Without `resume` any previous state is discarded. With it,
+        state is kept unless `source_path` exists and differs from the input the job started from.
+        """
+        self.root = os.path.join(jobs_dir, job_id)
+        self.lock = threading.Lock() # Artifacts are recorded from pipeline worker threads too
+        self.manifest_path = os.path.join(self.root, "job.json")
+        source_sha256 = file_sha256(source_path) if source_path and os.path.exists(source_path) else None
+
+        self.manifest = self._load_manifest() if resume else None
+        if self.manifest is not None and source_sha256 and self.manifest.get("source_sha256") not in (None, source_sha256):
+            self.manifest = None # A different input: nothing from the earlier run applies
+        if self.manifest is None:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.manifest = {"source_sha256": source_sha256, "artifacts": {}}
+        os.makedirs(self.root, exist_ok=True)
+        self.resumed = bool(self.manifest["artifacts"])
+        self._save_manifest()
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            return manifest if isinstance(manifest.get("artifacts"), dict) else None
+        except (OSError, ValueError):
+            return None
+
+    def _save_manifest(self):
+        atomic_write(self.manifest_path, json.dumps(self.manifest, indent=2).encode("utf-8"))
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def done(self, name, validate=None):
+        """
+        True if artifact `name` was completed and is still valid. `validate(path, metadata)`,
+        called with the metadata it was recorded with, may raise or return False to reject it.
+        """
+        metadata = self.manifest["artifacts"].get(name)
+        if metadata is None or not os.path.exists(self.path(name)):
+            return False
+        if validate is not None:
+            try:
+                return validate(self.path(name), metadata) is not False
+            except Exception:
+                return False
+        return True
+
+    def record(self, name, **metadata):
+        """Marks artifact `name` (already written under path(name)) as complete."""
+        with self.lock:
+            self.manifest["artifacts"][name] = metadata
+            self._save_manifest()
+
+    def write_bytes(self, name, data, **metadata):
+        atomic_write(self.path(name), data)
+        self.record(name, **metadata)
+
+    def write_text(self, name, text, **metadata):
+        self.write_bytes(name, text.encode("utf-8"), **metadata)
+
+    def read_text(self, name):
+        with open(self.path(name), "r", encoding="utf-8") as f:
+            return f.read()
+
+    def write_json(self, name, value, **metadata):
+        self.write_bytes(name, json.dumps(value, indent=2, ensure_ascii=False).encode("utf-8"), **metadata)
+
+    def read_json(self, name):
+        with open(self.path(name), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def remove(self):
+        """Deletes the work directory once the job's final output exists."""
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,94 @@
+# ml_scripts/keyframes.py
+#
+# Batched keyframe generation: every scene's starting image is denoised in as few pipeline
+# calls as memory allows, instead of one call per scene. Same steps and guidance for every
+# prompt, so they batch exactly like one prompt repeated.
+#
+# The batch size is the number of images whose activations fit in the memory that is free
+# right now (an estimate, tunable per host), capped by ML_KEYFRAME_MAX_BATCH. An OOM halves
+# the batch and retries it. Any other failure retries that batch one prompt at a time, so
+# one bad prompt only loses its own keyframe.
+#   ML_KEYFRAME_MB_PER_IMAGE  activation memory per 1024x1024 fp16 image, with CFG (default 1500)
+#   ML_KEYFRAME_MAX_BATCH     default 4
+import os
+import sys
+
+from events import EVENTS, StepProgress, pipeline_callback_kwargs
+import svd_planner
+
+KEYFRAME_MB_PER_IMAGE = float(os.environ.get("ML_KEYFRAME_MB_PER_IMAGE", "1500"))
+KEYFRAME_MAX_BATCH = int(os.environ.get("ML_KEYFRAME_MAX_BATCH", "4"))
+REFERENCE_PIXELS = 1024 * 1024
+
+
+def output_size(pipeline):
+    """The pipeline's default (height, width)."""
+    side = pipeline.unet.config.sample_size * pipeline.vae_scale_factor
+    return side, side
+
+
+def batch_size(pipeline, count, device, free_mb=None):
+    """Largest batch of `count` keyframes that fits in the free memory (at least 1)."""
+    free_mb = svd_planner.free_memory_mb(device) if free_mb is None else free_mb
+    height, width = output_size(pipeline)
+    per_image_mb = KEYFRAME_MB_PER_IMAGE * (height * width) / REFERENCE_PIXELS * (1 if "16" in str(pipeline.unet.dtype) else 2)
+    fits = int(free_mb * svd_planner.SAFETY_FRACTION // per_image_mb)
+    size = max(1, min(count, KEYFRAME_MAX_BATCH, fits))
+    sys.stderr.write(f"Keyframes: {count} to render in batches of {size} "
+                     f"({free_mb:.0f} MB free on {device}, ~{per_image_mb:.0f} MB per image).\n")
+    EVENTS.emit("keyframe_plan", count=count, batch_size=size, free_mb=round(free_mb), per_image_mb=round(per_image_mb))
+    return size
+
+
+def render_keyframes(pipeline, prompts, batch_size, progress_name="keyframes", failures=None, **call_kwargs):
+    """
+    Renders one image per prompt, `batch_size` prompts per denoise call; `call_kwargs`
+    (negative_prompt, num_inference_steps, guidance_scale, ...) apply to every prompt.
+    Returns the PIL images in prompt order. A prompt that fails on its own gets None, and
+    its exception is stored in `failures` (prompt index -> exception) when one is given.
+    """
+    negative_prompt = call_kwargs.pop("negative_prompt", None)
+    steps = call_kwargs.get("num_inference_steps", 50)
+
+    def render(first, batch):
+        return pipeline(
+            batch,
+            negative_prompt=[negative_prompt] * len(batch) if negative_prompt is not None else None,
+            **call_kwargs,
+            **pipeline_callback_kwargs(StepProgress(f"{progress_name}_{first + 1}-{first + len(batch)}", steps))
+        ).images
+
+    def skip(index, error):
+        images.append(None)
+        if failures is not None:
+            failures[index] = error
+        sys.stderr.write(f"Keyframes: prompt {index + 1} failed: {error}\n")
+
+    images = []
+    start = 0
+    while start < len(prompts):
+        batch = prompts[start:start + batch_size]
+        try:
+            images.extend(render(start, batch))
+        except Exception as e:
+            if svd_planner.is_out_of_memory(e):
+                if batch_size <= 1:
+                    raise
+                svd_planner.free_cached_memory()
+                batch_size //= 2
+                sys.stderr.write(f"Keyframes: out of memory, retrying with batches of {batch_size}.\n")
+                EVENTS.emit("keyframe_plan", count=len(prompts) - start, batch_size=batch_size, fallback=True)
+                continue
+            if len(batch) == 1:
+                skip(start, e)
+            else:
+                sys.stderr.write(f"Keyframes: batch {start + 1}-{start + len(batch)} failed ({e}), retrying one at a time.\n")
+                for index in range(start, start + len(batch)):
+                    try:
+                        images.extend(render(index, [prompts[index]]))
+                    except Exception as single:
+                        if svd_planner.is_out_of_memory(single):
+                            svd_planner.free_cached_memory()
+                        skip(index, single)
+        start += len(batch)
+    return images
@@ -0,0 +1,192 @@
+# ml_scripts/latent_cache.py
+#
+# Content-addressed cache of VAE-encoded img2img init images. In the photo-editor flow the
+# same upload is edited again and again with different prompts; on a hit the upload is
+# neither decoded nor run through the VAE encoder.
+#
+# What is cached is the encoder's latent distribution (mean/logvar), not a sample of it:
+# the latents are still drawn with the request's generator, exactly as
+# StableDiffusionImg2ImgPipeline would draw them, so a cached edit is identical to an
+# uncached one with the same seed.
+#
+#   ML_LATENT_CACHE_MB        in-memory budget (default 64; one 512x512 entry is ~64 KB in fp16)
+#   ML_LATENT_CACHE_DIR       optional directory to spill entries to, shared across processes
+#   ML_LATENT_CACHE_DISK_MB   size bound for that directory (default 512)
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_MB = int(os.environ.get("ML_LATENT_CACHE_MB", "64"))
+DEFAULT_DISK_DIR = os.environ.get("ML_LATENT_CACHE_DIR") or None
+DEFAULT_DISK_MAX_MB = int(os.environ.get("ML_LATENT_CACHE_DISK_MB", "512"))
+
+
+def _diagonal_gaussian(parameters):
+    try:
+        from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
+    except ImportError: # Older diffusers releases
+        from diffusers.models.vae import DiagonalGaussianDistribution
+    return DiagonalGaussianDistribution(parameters)
+
+
+class LatentCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_MB * 1024 * 1024, disk_dir=DEFAULT_DISK_DIR,
+                 disk_max_bytes=DEFAULT_DISK_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = OrderedDict() # key -> (latent distribution parameters, nbytes)
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.encode_seconds = 0.0 # decode + VAE encoder time spent on misses
+
+    @staticmethod
+    def key(pipeline, image_bytes):
+        """Hash of the upload bytes plus everything that changes its encoding."""
+        vae = pipeline.vae
+        digest = hashlib.sha256(image_bytes)
+        digest.update(f"|{getattr(vae.config, '_name_or_path', '')}|{vae.dtype}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def init_latents(self, pipeline, image_bytes, decode, generator=None):
+        """
+        Returns scaled init latents for `image_bytes`, ready to pass to the img2img pipeline as
+        `image`. `decode(image_bytes)` must return the preprocessed PIL image; it only runs on
+        a miss. Consumes `generator` exactly like the pipeline's own VAE encode would.
+        """
+        parameters = self.get_parameters(pipeline, image_bytes, decode)
+        latents = _diagonal_gaussian(parameters).sample(generator=generator)
+        return latents * pipeline.vae.config.scaling_factor
+
+    def get_parameters(self, pipeline, image_bytes, decode):
+        key = self.key(pipeline, image_bytes)
+        vae = pipeline.vae
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0].to(vae.device)
+
+        parameters = self._load_from_disk(key)
+        if parameters is not None:
+            parameters = parameters.to(vae.device, vae.dtype)
+            with self.lock:
+                self.disk_hits += 1
+                self._store(key, parameters)
+            return parameters
+
+        import torch
+
+        start = time.perf_counter()
+        image = decode(image_bytes)
+        device = getattr(pipeline, "_execution_device", pipeline.device)
+        pixels = pipeline.image_processor.preprocess(image).to(device=device, dtype=vae.dtype)
+        with torch.no_grad():
+            parameters = vae.encode(pixels).latent_dist.parameters
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.misses += 1
+            self.encode_seconds += elapsed
+            self._store(key, parameters)
+        self._save_to_disk(key, parameters)
+        return parameters
+
+    def _store(self, key, parameters):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        nbytes = parameters.element_size() * parameters.nelement()
+        self.entries[key] = (parameters, nbytes)
+        self.bytes += nbytes
+
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, evicted_bytes) = self.entries.popitem(last=False)
+            self.bytes -= evicted_bytes
+            self.evictions += 1
+
+    # --- Disk spill ---
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pt")
+
+    def _load_from_disk(self, key):
+        if not self.disk_dir or not os.path.exists(self._disk_path(key)):
+            return None
+        import torch
+        try:
+            parameters = torch.load(self._disk_path(key), map_location="cpu", weights_only=True)
+            os.utime(self._disk_path(key)) # Recently used: keep it through the next prune
+            return parameters
+        except Exception:
+            return None # A corrupt or concurrently pruned entry is just a miss
+
+    def _save_to_disk(self, key, parameters):
+        if not self.disk_dir:
+            return
+        import torch
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            # Write then rename, so other processes never load a half-written entry
+            temp_path = f"{self._disk_path(key)}.{os.getpid()}.tmp"
+            torch.save(parameters.detach().cpu(), temp_path)
+            os.replace(temp_path, self._disk_path(key))
+            self._prune_disk()
+        except OSError:
+            pass # The disk tier is best-effort
+
+    def _prune_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".pt"):
+                path = os.path.join(self.disk_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        hits = self.hits + self.disk_hits
+        lookups = hits + self.misses
+        mean_encode = self.encode_seconds / self.misses if self.misses else 0.0
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "disk_dir": self.disk_dir,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "encode_seconds": round(self.encode_seconds, 3),
+            # Every hit skipped one decode + VAE encoder pass of roughly the mean miss cost
+            "estimated_seconds_saved": round(hits * mean_encode, 3),
+        }
+
+
+# Shared per-process instance used by img2img_gen and the inference server
+default_cache = LatentCache()
@@ -0,0 +1,99 @@
+# ml_scripts/latent_preview.py
+#
+# Cheap live previews while a diffusion pipeline is denoising. Every N steps the current
+# latents are projected straight to RGB with a fixed linear map (no VAE decode) and written
+# as a small JPEG next to the final output, e.g. storage/images/image_<id>_preview.jpg.
+# The time spent is measured and previews are skipped whenever they would push the total
+# overhead above `max_overhead` of the elapsed generation time.
+import os
+import sys
+import time
+
+# Least-squares fit of SD 1.x latent channels (rows) to RGB (columns), output roughly in [-1, 1]
+SD15_LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+DEFAULT_MAX_OVERHEAD = 0.03 # previews may cost at most 3% of generation time
+DEFAULT_PREVIEW_SIZE = 128  # longest side of the preview JPEG, in pixels
+
+
+def latents_to_images(latents, size=DEFAULT_PREVIEW_SIZE):
+    """Projects a [batch, 4, h, w] latent tensor to a list of small PIL images."""
+    import torch
+    from PIL import Image
+
+    factors = torch.tensor(SD15_LATENT_RGB_FACTORS, dtype=torch.float32, device=latents.device)
+    rgb = torch.einsum("bchw,cr->bhwr", latents.float(), factors)
+    rgb = ((rgb + 1.0) * 127.5).clamp(0, 255).to(torch.uint8).cpu().numpy()
+
+    images = []
+    for array in rgb:
+        image = Image.fromarray(array)
+        scale = size / max(image.size)
+        images.append(image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BILINEAR))
+    return images
+
+
+class LatentPreviewer:
+    """
+    A `callback_on_step_end` for diffusers pipelines. `output_paths` holds one preview path
+    per image in the batch (None for images that did not ask for a preview).
+    """
+
+    def __init__(self, output_paths, every_n_steps=5, max_overhead=DEFAULT_MAX_OVERHEAD, size=DEFAULT_PREVIEW_SIZE):
+        self.output_paths = list(output_paths)
+        self.every_n_steps = max(1, int(every_n_steps))
+        self.max_overhead = max_overhead
+        self.size = size
+        self.started_at = None
+        self.preview_seconds = 0.0
+        self.previews_written = 0
+        self.skipped_for_budget = 0
+
+    def __call__(self, pipeline, step, timestep, callback_kwargs):
+        now = time.perf_counter()
+        if self.started_at is None:
+            self.started_at = now
+
+        if (step + 1) % self.every_n_steps == 0 and any(self.output_paths):
+            elapsed = now - self.started_at
+            # Skip while previews already cost more than the budget of the time spent so far
+            if elapsed > 0 and self.preview_seconds / elapsed > self.max_overhead:
+                self.skipped_for_budget += 1
+            else:
+                self._write(callback_kwargs["latents"])
+        return callback_kwargs
+
+    def _write(self, latents):
+        import torch
+
+        # Let the step's queued GPU work finish first so it is not billed to the preview
+        if latents.is_cuda:
+            torch.cuda.synchronize(latents.device)
+        start = time.perf_counter()
+        try:
+            for path, image in zip(self.output_paths, latents_to_images(latents, self.size)):
+                if path:
+                    # Write then rename, so a reader never sees a half-written JPEG
+                    tmp_path = f"{path}.tmp"
+                    image.save(tmp_path, format="JPEG", quality=70)
+                    os.replace(tmp_path, path)
+            self.previews_written += 1
+        except Exception as e:
+            # Previews are best-effort and must never fail the generation itself
+            sys.stderr.write(f"Warning: could not write latent preview: {e}\n")
+        self.preview_seconds += time.perf_counter() - start
+
+    def stats(self):
+        total = time.perf_counter() - self.started_at if self.started_at else 0.0
+        return {
+            "previews_written": self.previews_written,
+            "skipped_for_budget": self.skipped_for_budget,
+            "preview_seconds": round(self.preview_seconds, 4),
+            "overhead_fraction": round(self.preview_seconds / total, 4) if total else 0.0,
+        }
+
@@ -4,6 +4,8 @@ import os
 import subprocess
 from pdf2image import convert_from_path # New import
 import time
+from events import EVENTS, fail
+import profiling
 
 def generate_video_from_pdf(pdf_path, content_id):
     # --- Paths and Setup ---
@@ -29,18 +31,18 @@ def generate_video_from_pdf(pdf_path, content_id):
     try:
         sys.stderr.write(f"Converting PDF pages to images. Poppler Path: {POPPLER_PATH}\n")
         # Use convert_from_path with poppler_path
-        images = convert_from_path(pdf_path, poppler_path=POPPLER_PATH)
+        with EVENTS.stage("render_pages"):
+            images = convert_from_path(pdf_path, poppler_path=POPPLER_PATH)
         sys.stderr.write(f"Successfully converted {len(images)} pages from PDF.\n")
     except Exception as e:
         sys.stderr.write(f"Error converting PDF to images: {e}\n")
         # For debug, print full traceback
         import traceback
         traceback.print_exc(file=sys.stderr)
-        sys.exit(1)
+        fail(f"Error converting PDF to images: {e}")
 
     if not images:
-        sys.stderr.write("No images were extracted from the PDF.\n")
-        sys.exit(1)
+        fail("No images were extracted from the PDF.")
 
     # Save images to temp directory
     frame_paths = []
@@ -51,8 +53,7 @@ def generate_video_from_pdf(pdf_path, content_id):
             image.save(frame_path, 'PNG')
             frame_paths.append(frame_path)
         except Exception as e:
-            sys.stderr.write(f"Error saving image {i} to {frame_path}: {e}\n")
-            sys.exit(1)
+            fail(f"Error saving image {i} to {frame_path}: {e}")
     
     sys.stderr.write(f"Saved {len(frame_paths)} temporary image frames.\n")
 
@@ -72,21 +73,20 @@ def generate_video_from_pdf(pdf_path, content_id):
         ]
         sys.stderr.write(f"Running FFmpeg command to combine PDF frames: {' '.join(ffmpeg_command)}\n")
         
-        process = subprocess.run(ffmpeg_command, capture_output=True, text=True, check=False)
+        with EVENTS.stage("encode_video"):
+            process = subprocess.run(ffmpeg_command, capture_output=True, text=True, check=False)
         
         if process.returncode != 0:
             sys.stderr.write(f"FFmpeg failed with error:\n{process.stderr}\n")
-            sys.exit(1)
+            fail(f"FFmpeg exited with code {process.returncode}")
         else:
             sys.stderr.write(f"FFmpeg stdout:\n{process.stdout}\n")
             sys.stderr.write(f"Video generated at: {output_video_path}\n")
             
     except FileNotFoundError:
-        sys.stderr.write("Error: FFmpeg not found at the specified path. Please check FFMPEG_EXE_PATH.\n")
-        sys.exit(1)
+        fail("Error: FFmpeg not found at the specified path. Please check FFMPEG_EXE_PATH.")
     except Exception as e:
-        sys.stderr.write(f"Error during FFmpeg conversion: {e}\n")
-        sys.exit(1)
+        fail(f"Error during FFmpeg conversion: {e}")
     finally:
         # Clean up temporary frames directory
         for f in frame_paths:
@@ -103,13 +103,15 @@ def generate_video_from_pdf(pdf_path, content_id):
             except Exception as e:
                 sys.stderr.write(f"Error removing temp directory {temp_frames_dir}: {e}\n")
 
+    EVENTS.result(path=f"storage/videos/{output_video_filename}", pages=len(frame_paths))
     print(f"storage/videos/{output_video_filename}")
 
 if __name__ == "__main__":
+    profiling.enable_from_argv()
     if len(sys.argv) > 2:
         pdf_path_arg = sys.argv[1]
         content_id_arg = sys.argv[2]
         generate_video_from_pdf(pdf_path_arg, content_id_arg)
     else:
-        sys.stderr.write("Usage: python pdf_to_video.py <pdf_file_path> <content_id>\n")
+        sys.stderr.write("Usage: python pdf_to_video.py <pdf_file_path> <content_id> [--profile]\n")
         sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,140 @@
+# ml_scripts/prefix_cache.py
+#
+# Reuse of the attention KV cache for a prompt's fixed instruction prefix. The LLM scripts
+# wrap every document in the same instructions (story_gen.py's "### Instruction:" header,
+# the scene planner's prompt). The prefix's past_key_values are computed once per loaded
+# model. Each generate() then starts from a copy of them and only prefills the document,
+# which saves most of the time to first token for short documents.
+#
+# The cache lives on the pipeline object, so it lasts as long as the model stays resident
+# (residency.py) and is freed with it. The LLM scripts load their model once per job, so
+# today the reuse spans one run (the scene planner's retry, several plans in one process);
+# reuse across documents needs the model in a long-lived process.
+#
+# The full prompt is tokenised in one piece, exactly as without the cache. Its leading ids
+# must equal the prefix's own ids for the cache to apply; where the tokenizer merges across
+# the boundary (sentencepiece can, for a prefix not ending in "\n"), the prompt is prefilled
+# cold instead and the generation is reported with prefix_mismatch.
+#
+# Every generation's time to first token is measured and emitted as an "llm_ttft" event,
+# along with whether the prefix came from the cache.
+#   ML_PREFIX_CACHE=0  disables reuse (to measure the cold TTFT)
+import os
+import sys
+import copy
+import time
+from collections import OrderedDict
+
+from events import EVENTS
+
+PREFIX_CACHE_ENABLED = os.environ.get("ML_PREFIX_CACHE", "1") != "0"
+MAX_PREFIXES = 4
+
+
+class _FirstTokenTimer:
+    """generate() streamer that only records when the first new token arrives."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.puts = 0
+        self.first_token_s = None
+
+    def put(self, value):
+        # The first put() is the prompt itself; the second is the first generated token
+        self.puts += 1
+        if self.puts == 2:
+            self.first_token_s = time.perf_counter() - self.start
+
+    def end(self):
+        pass
+
+
+class PrefixCache:
+    def __init__(self, model, tokenizer, max_prefixes=MAX_PREFIXES):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_prefixes = max_prefixes
+        self.entries = OrderedDict() # prefix text -> (input_ids, past_key_values)
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = 0
+
+    def _encode(self, text, add_special_tokens):
+        return self.tokenizer(text, return_tensors="pt", add_special_tokens=add_special_tokens)["input_ids"].to(self.model.device)
+
+    def _prefix_ids(self, prefix):
+        if prefix in self.entries:
+            return self.entries[prefix][0]
+        return self._encode(prefix, True)
+
+    def _prefix(self, prefix, input_ids):
+        """(past_key_values, cache hit) for `prefix` (tokenised as `input_ids`), computing and caching them on a miss."""
+        import torch
+
+        if prefix in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(prefix)
+            return self.entries[prefix][1], True
+
+        self.misses += 1
+        start = time.perf_counter()
+        with torch.no_grad():
+            past_key_values = self.model(input_ids=input_ids, use_cache=True).past_key_values
+        sys.stderr.write(f"Prefix cache: computed {input_ids.shape[1]} prefix tokens in {time.perf_counter() - start:.2f}s.\n")
+        self.entries[prefix] = (input_ids, past_key_values)
+        while len(self.entries) > self.max_prefixes:
+            self.entries.popitem(last=False)
+        return past_key_values, False
+
+    def generate(self, prefix, text, **generate_kwargs):
+        """
+        Generates a continuation of `prefix + text` for one prompt; `generate_kwargs` are
+        model.generate() arguments (max_new_tokens, do_sample, logits_processor, ...).
+        Returns (completion, stats) with only the newly generated text.
+        """
+        import torch
+
+        timer = _FirstTokenTimer() # A miss's prefix prefill counts towards its time to first token
+        input_ids = self._encode(prefix + text, True)
+        prefix_ids = self._prefix_ids(prefix)
+        boundary = prefix_ids.shape[1]
+        # At least one prompt token must be left to prefill after the cached ones
+        mismatch = boundary >= input_ids.shape[1] or not torch.equal(input_ids[:, :boundary], prefix_ids)
+        past_key_values, hit = None, False
+        if PREFIX_CACHE_ENABLED and mismatch:
+            self.mismatches += 1
+            sys.stderr.write("Prefix cache: the prompt does not start with the prefix's tokens; prefilling it cold.\n")
+        elif PREFIX_CACHE_ENABLED:
+            past_key_values, hit = self._prefix(prefix, prefix_ids)
+        if past_key_values is not None:
+            # generate() extends the cache in place; the cached prefix must stay as it is
+            generate_kwargs["past_key_values"] = copy.deepcopy(past_key_values)
+
+        with torch.no_grad():
+            output = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                streamer=timer,
+                **generate_kwargs,
+            )
+        new_ids = output[0, input_ids.shape[1]:]
+        stats = {
+            "prefix_tokens": boundary,
+            "prompt_tokens": input_ids.shape[1],
+            "new_tokens": len(new_ids),
+            "cached_prefix": hit,
+            "prefix_mismatch": mismatch,
+            "ttft_s": round(timer.first_token_s, 4) if timer.first_token_s is not None else None,
+            "seconds": round(time.perf_counter() - timer.start, 3),
+        }
+        EVENTS.emit("llm_ttft", **stats)
+        return self.tokenizer.decode(new_ids, skip_special_tokens=True), stats
+
+
+def for_pipeline(llm_pipeline):
+    """The PrefixCache of a loaded text-generation pipeline (created on first use)."""
+    cache = getattr(llm_pipeline, "_prefix_cache", None)
+    if cache is None:
+        cache = PrefixCache(llm_pipeline.model, llm_pipeline.tokenizer)
+        llm_pipeline._prefix_cache = cache
+    return cache
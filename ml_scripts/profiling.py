@@ -0,0 +1,293 @@
+# ml_scripts/profiling.py
+#
+# Opt-in per-stage profiling for every ml_script. Pass --profile to any script to record
+# nested spans (wall time, CPU time, process peak RSS and peak VRAM); the spans are written
+# as a Chrome trace (open in chrome://tracing or https://ui.perfetto.dev) next to the output,
+# e.g. storage/videos/story_video_<id>.mp4.trace.json. --torch-profile additionally wraps the
+# hot sections in torch.profiler and exports its trace as <output>.torch.json.
+#
+# Every events.EVENTS.stage(...) block is a span automatically; extra spans can be added
+# with PROFILER.span(name) or profiling.instrument(obj, "method", name).
+#
+# StageMemory is the always-on exception: multi-model jobs use it to report each stage's
+# own peak RSS/VRAM even without --profile.
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource # Not available on Windows
+except ImportError:
+    resource = None
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def max_rss_mb():
+    """High-water mark of this process's resident memory, in MB (None if unknown)."""
+    # Prefer VmHWM on Linux: ru_maxrss survives fork+exec, so a benchmark child would
+    # report its parent's peak
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in KB on Linux and in bytes on macOS
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().peak_wset / (1024 * 1024), 1)
+    except Exception:
+        return None
+
+
+def current_rss_mb():
+    """This process's resident memory right now, in MB (None if unknown)."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Restarts max_rss_mb() from the current RSS (Linux only); False if it cannot be reset."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _cuda():
+    torch = sys.modules.get("torch") # never import torch just for profiling
+    if torch is not None and torch.cuda.is_available():
+        return torch.cuda
+    return None
+
+
+class _Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.child_peak_vram = 0
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.torch_enabled = False
+        self.events = []
+        self.torch_profiles = []
+        self.stack = threading.local()
+        self.origin = time.perf_counter()
+        self.saved = False
+
+    def enable(self, torch_profile=False):
+        self.enabled = True
+        self.torch_enabled = torch_profile
+        atexit.register(self._save_on_exit)
+
+    def _stack(self):
+        if not hasattr(self.stack, "spans"):
+            self.stack.spans = []
+        return self.stack.spans
+
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+
+        stack = self._stack()
+        span = _Span(name, args)
+        cuda = _cuda()
+        if cuda is not None:
+            # Hand the peak so far to the parent, then measure this span from zero
+            if stack:
+                stack[-1].child_peak_vram = max(stack[-1].child_peak_vram, cuda.max_memory_allocated())
+            cuda.reset_peak_memory_stats()
+        stack.append(span)
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            stack.pop()
+
+            record_args = {
+                "cpu_ms": round(cpu * 1000, 3),
+                "max_rss_mb": max_rss_mb(),
+                **{key: value for key, value in span.args.items() if value is not None},
+            }
+            if cuda is not None:
+                peak = max(cuda.max_memory_allocated(), span.child_peak_vram)
+                record_args["peak_vram_mb"] = round(peak / (1024 * 1024), 1)
+                if stack:
+                    stack[-1].child_peak_vram = max(stack[-1].child_peak_vram, peak)
+
+            self.events.append({
+                "name": name,
+                "cat": "ml_scripts",
+                "ph": "X",
+                "ts": round((wall_start - self.origin) * 1e6, 1),
+                "dur": round(wall * 1e6, 1),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": record_args,
+            })
+
+    @contextmanager
+    def torch_profile(self, name):
+        """Wraps a hot section in torch.profiler when --torch-profile was given."""
+        if not (self.enabled and self.torch_enabled):
+            yield
+            return
+
+        import torch
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities, profile_memory=True) as prof:
+            with torch.profiler.record_function(name):
+                yield
+        self.torch_profiles.append((name, prof))
+
+    def save(self, output_path):
+        """
+        Writes <output_path>.trace.json (and .torch.json files). Relative paths are resolved
+        against the project root, like the paths in result events. Returns the trace path
+        in the same form it was given.
+        """
+        if not self.enabled or self.saved:
+            return None
+        self.saved = True
+
+        full_path = output_path if os.path.isabs(output_path) else os.path.join(PROJECT_ROOT, output_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        with open(f"{full_path}.trace.json", "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+        for index, (name, prof) in enumerate(self.torch_profiles):
+            suffix = "" if len(self.torch_profiles) == 1 else f".{index}_{name}"
+            prof.export_chrome_trace(f"{full_path}{suffix}.torch.json")
+
+        trace_path = f"{output_path}.trace.json"
+        sys.stderr.write(f"Profile written to {trace_path}\n")
+        return trace_path
+
+    def _save_on_exit(self):
+        # Failed runs have no output file; keep their trace under storage/profiles instead
+        if self.enabled and not self.saved and self.events:
+            script = os.path.splitext(os.path.basename(sys.argv[0] or "ml_script"))[0]
+            self.save(os.path.join("storage", "profiles", f"{script}_{int(time.time())}"))
+
+
+class StageMemory:
+    """
+    Always-on peak RSS / VRAM per top-level job stage (spans only measure with --profile).
+    Each stage() restarts the RSS high-water mark and CUDA's peak counter, so a stage's
+    peak is its own rather than the process's. When profiling is on, the stage also takes
+    part in the span stack so nested spans keep handing their VRAM peaks up to it.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        cuda = _cuda()
+        rss_reset = reset_peak_rss()
+        stack = PROFILER._stack() if PROFILER.enabled else None
+        span = _Span(name, {})
+        if cuda is not None:
+            if stack:
+                stack[-1].child_peak_vram = max(stack[-1].child_peak_vram, cuda.max_memory_allocated())
+            cuda.reset_peak_memory_stats()
+        if stack is not None:
+            stack.append(span)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if stack is not None:
+                stack.pop()
+            record = {
+                "stage": name,
+                "seconds": round(time.perf_counter() - start, 3),
+                "peak_rss_mb": max_rss_mb(),
+                "end_rss_mb": current_rss_mb(),
+            }
+            if not rss_reset:
+                record["peak_rss_scope"] = "process" # The peak includes earlier stages
+            if cuda is not None:
+                peak = max(cuda.max_memory_allocated(), span.child_peak_vram)
+                record["peak_vram_mb"] = round(peak / (1024 * 1024), 1)
+                record["end_vram_mb"] = round(cuda.memory_allocated() / (1024 * 1024), 1)
+                if stack:
+                    stack[-1].child_peak_vram = max(stack[-1].child_peak_vram, peak)
+            self.stages.append(record)
+            vram = f", peak VRAM {record['peak_vram_mb']} MB (end {record['end_vram_mb']} MB)" if cuda is not None else ""
+            sys.stderr.write(f"Memory [{name}]: peak RSS {record['peak_rss_mb']} MB (end {record['end_rss_mb']} MB){vram}, "
+                             f"{record['seconds']:.1f}s.\n")
+
+
+def instrument(obj, method_name, span_name):
+    """Wraps obj.method_name so every call is recorded as a span (no-op unless profiling)."""
+    if not PROFILER.enabled:
+        return
+    original = getattr(obj, method_name)
+    if getattr(original, "_profiled", False):
+        return # shared modules (e.g. the SD VAE) are only wrapped once
+
+    def wrapper(*args, **kwargs):
+        with PROFILER.span(span_name):
+            return original(*args, **kwargs)
+
+    wrapper._profiled = True
+    setattr(obj, method_name, wrapper)
+
+
+def add_arguments(parser):
+    """Adds --profile / --torch-profile to an argparse-based script."""
+    parser.add_argument("--profile", action="store_true",
+                        help="Write a Chrome trace of every stage next to the output (<output>.trace.json)")
+    parser.add_argument("--torch-profile", action="store_true",
+                        help="Like --profile, and also run the hot sections under torch.profiler")
+
+
+def enable_from_args(args):
+    if args.profile or args.torch_profile:
+        PROFILER.enable(torch_profile=args.torch_profile)
+
+
+def enable_from_argv(argv=None):
+    """Handles --profile / --torch-profile for scripts that read sys.argv directly, removing them."""
+    argv = sys.argv if argv is None else argv
+    flags = {"--profile", "--torch-profile"}
+    present = flags.intersection(argv)
+    if present:
+        argv[:] = [arg for arg in argv if arg not in flags]
+        PROFILER.enable(torch_profile="--torch-profile" in present)
+
+
+# Process-wide profiler used by all scripts (disabled unless --profile is passed)
+PROFILER = Profiler()
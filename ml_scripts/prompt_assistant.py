@@ -3,6 +3,8 @@ import sys
 import json
 import requests
 import os
+from events import EVENTS
+import profiling
 
 # --- Configuration ---
 # Ensure this URL is correct for the default Ollama API endpoint
@@ -76,21 +78,25 @@ def generate_enhanced_prompt(user_prompt, system_instruction):
 if __name__ == "__main__":
     # Node.js passes arguments: [script_path, user_prompt, system_instruction]
     # We expect arguments 1 and 2 (indices 1 and 2 in sys.argv)
+    profiling.enable_from_argv()
     if len(sys.argv) >= 3:
         user_prompt_arg = sys.argv[1]
         system_instruction_arg = sys.argv[2]
         
-        enhanced_prompt = generate_enhanced_prompt(user_prompt_arg, system_instruction_arg)
+        with EVENTS.stage("enhance_prompt"):
+            enhanced_prompt = generate_enhanced_prompt(user_prompt_arg, system_instruction_arg)
 
         if enhanced_prompt:
+            EVENTS.result(enhanced_prompt=enhanced_prompt)
             # CRITICAL: Print ONLY the final enhanced string to stdout for Node.js
             print(enhanced_prompt)
             sys.exit(0)
         else:
             sys.stderr.write("Failed to generate a clean enhanced prompt.\n")
+            EVENTS.error("Failed to generate a clean enhanced prompt.")
             sys.exit(1)
             
     else:
-        sys.stderr.write("Usage: python prompt_assistant.py <user_prompt> <system_instruction>\n")
+        sys.stderr.write("Usage: python prompt_assistant.py <user_prompt> <system_instruction> [--profile]\n")
         sys.exit(1)
         
\ No newline at end of file
@@ -0,0 +1,125 @@
+# ml_scripts/renditions.py
+#
+# Compressed variants of a finished image, written off the hot path. The primary PNG is
+# saved (and fsynced) first and reported as the result right away; a background worker then
+# writes, next to it:
+#   image_<id>_<seed>.webp        full size, lossy WebP
+#   image_<id>_<seed>.jpg         full size, progressive JPEG
+#   image_<id>_<seed>_thumb.webp  gallery thumbnail (GeneratedContent.thumbnailPath)
+# Each finished set is announced with a "rendition" event, and its encode time and byte
+# savings versus the PNG are logged.
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from events import EVENTS
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+THUMBNAIL_MAX_SIDE = 256
+
+RENDITIONS = {
+    "webp": {"suffix": ".webp", "format": "WEBP", "options": {"quality": 85, "method": 4}},
+    "jpeg": {"suffix": ".jpg", "format": "JPEG", "options": {"quality": 90, "optimize": True, "progressive": True}},
+    "thumbnail": {"suffix": "_thumb.webp", "format": "WEBP", "options": {"quality": 80, "method": 4}, "max_side": THUMBNAIL_MAX_SIDE},
+}
+
+# The PNG is the archival copy and the renditions carry the compression, so favour save speed
+PRIMARY_PNG_OPTIONS = {"compress_level": 1}
+
+
+def _atomic_save(image, path, image_format, fsync=False, **options):
+    """Writes to a temporary file and renames it into place, so readers never see a partial image."""
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        image.save(f, format=image_format, **options)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def save_primary(image, output_path):
+    """Saves the primary PNG durably (fsync + atomic rename) before it is reported."""
+    _atomic_save(image, output_path, "PNG", fsync=True, **PRIMARY_PNG_OPTIONS)
+
+
+def rendition_paths(relative_path):
+    stem = os.path.splitext(relative_path)[0]
+    return {name: f"{stem}{spec['suffix']}" for name, spec in RENDITIONS.items()}
+
+
+def write_renditions(image, relative_path):
+    """
+    Writes every rendition of the primary image at `relative_path` (relative to the project
+    root). `image` is the in-memory PIL image, or None to load it from the PNG (e.g. when the
+    inference server rendered it). Renditions already newer than the PNG are kept as they are.
+    Returns a summary dict.
+    """
+    from PIL import Image
+
+    primary = os.path.join(PROJECT_ROOT, relative_path)
+    primary_bytes = os.path.getsize(primary)
+    primary_mtime = os.path.getmtime(primary)
+
+    start = time.perf_counter()
+    summary = {"path": relative_path, "primary_bytes": primary_bytes, "bytes": {}}
+    for name, rendition_path in rendition_paths(relative_path).items():
+        target = os.path.join(PROJECT_ROOT, rendition_path)
+        if not (os.path.exists(target) and os.path.getmtime(target) >= primary_mtime):
+            if image is None:
+                with Image.open(primary) as loaded:
+                    image = loaded.convert("RGB")
+            spec = RENDITIONS[name]
+            variant = image.convert("RGB")
+            if spec.get("max_side"):
+                variant.thumbnail((spec["max_side"], spec["max_side"]))
+            _atomic_save(variant, target, spec["format"], **spec["options"])
+        summary[name] = rendition_path
+        summary["bytes"][name] = os.path.getsize(target)
+
+    summary["encode_seconds"] = round(time.perf_counter() - start, 4)
+    summary["saved_bytes"] = {name: primary_bytes - size for name, size in summary["bytes"].items() if name != "thumbnail"}
+    return summary
+
+
+class RenditionWorker:
+    """Runs write_renditions on a background thread; drain() before the process exits."""
+
+    def __init__(self, emitter=None):
+        self.emitter = emitter or EVENTS
+        self.executor = None
+        self.futures = []
+
+    def submit(self, image, relative_path):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="renditions")
+        future = self.executor.submit(self._run, image, relative_path)
+        self.futures.append(future)
+        return future
+
+    def _run(self, image, relative_path):
+        summary = write_renditions(image, relative_path)
+        sizes = ", ".join(f"{name} {size / 1024:.0f} KB" for name, size in summary["bytes"].items())
+        sys.stderr.write(f"Renditions for {relative_path}: {sizes} (PNG {summary['primary_bytes'] / 1024:.0f} KB), "
+                         f"encoded in {summary['encode_seconds']:.3f}s\n")
+        self.emitter.emit("rendition", **summary)
+        return summary
+
+    def drain(self):
+        """Waits for pending renditions. Failures are logged: the primary result already stands."""
+        results = []
+        for future in self.futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                sys.stderr.write(f"Warning: could not write renditions: {e}\n")
+                self.emitter.warning(f"Renditions failed: {e}")
+        self.futures = []
+        return results
+
+
+# Shared per-process worker used by image_gen / img2img_gen
+default_worker = RenditionWorker()
@@ -0,0 +1,229 @@
+# ml_scripts/residency.py
+#
+# Memory-budgeted model residency. Every large model is acquired through the manager, which
+# knows its approximate footprint and keeps it resident for as long as the budgets allow:
+#   - under VRAM pressure, the least-recently-used model is offloaded to CPU RAM (cheap to
+#     bring back with .to("cuda")) rather than dropped;
+#   - under RAM pressure, or when offloading is impossible, it is dropped and reloaded later;
+#   - models idle for longer than the TTL are offloaded/dropped even without pressure.
+# So a resident inference server pays each model's load cost once, and back-to-back video
+# jobs swap SD 1.5 and SVD-XT between VRAM and RAM instead of reloading them from disk.
+#
+#   ML_VRAM_BUDGET_MB   default: 90% of the GPU's memory (0 without CUDA)
+#   ML_RAM_BUDGET_MB    default: 75% of physical memory
+#   ML_MODEL_IDLE_TTL_S default: 900
+import os
+import gc
+import sys
+import time
+import threading
+
+# Approximate weight footprints in MB (parameters x bytes per parameter, rounded up)
+FOOTPRINTS_MB = {
+    "sd15": {"fp16": 2200, "fp32": 4400},     # UNet 860M + VAE 84M + CLIP text 123M params
+    "svd_xt": {"fp16": 4600, "fp32": 9200},   # UNet 1.5B + temporal VAE 98M + CLIP ViT-H 632M
+    "sdxl": {"fp16": 7000, "fp32": 14000},    # juggernautXL: UNet 2.6B + two text encoders 0.8B
+    "gptj": {"fp16": 12200, "fp32": 24400},   # GPT-J 6B
+    "mistral_awq": {"fp16": 4300, "fp32": 4300}, # Mistral 7B, 4-bit AWQ weights
+}
+
+# Activation memory a model needs on the GPU while it runs, on top of its resident weights
+WORKING_VRAM_MB = {
+    "sd15": 1500,
+    "svd_xt": 6000, # SVD runs with model CPU offload: the UNet plus activations for 25 frames
+    "sdxl": 3000,
+}
+
+DEFAULT_IDLE_TTL_S = float(os.environ.get("ML_MODEL_IDLE_TTL_S", "900"))
+
+
+def footprint_mb(model, dtype):
+    """Footprint of `model` (a FOOTPRINTS_MB key) loaded with torch `dtype`."""
+    return FOOTPRINTS_MB[model]["fp16" if "16" in str(dtype) else "fp32"]
+
+
+def _default_vram_budget_mb():
+    if os.environ.get("ML_VRAM_BUDGET_MB"):
+        return int(os.environ["ML_VRAM_BUDGET_MB"])
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return int(torch.cuda.get_device_properties(0).total_memory / (1024 * 1024) * 0.9)
+    except Exception:
+        pass
+    return 0
+
+
+def _default_ram_budget_mb():
+    if os.environ.get("ML_RAM_BUDGET_MB"):
+        return int(os.environ["ML_RAM_BUDGET_MB"])
+    try:
+        return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1024 * 1024) * 0.75)
+    except (ValueError, OSError, AttributeError): # sysconf is unavailable on Windows
+        return 16 * 1024
+
+
+def _free_memory():
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+class _Resident:
+    def __init__(self, name, model, footprint_mb, tier, offload, restore, release):
+        self.name = name
+        self.model = model
+        self.footprint_mb = footprint_mb
+        self.tier = tier              # where the weights are now: "vram" or "ram"
+        self.home_tier = tier         # where they live while in use
+        self.offload = offload        # model -> None, moves the weights to CPU RAM
+        self.restore = restore        # model -> None, moves them back to the GPU
+        self.release = release        # model -> None, drops other references before unloading
+        self.last_used = time.monotonic()
+
+
+class ResidencyManager:
+    def __init__(self, vram_budget_mb=None, ram_budget_mb=None, idle_ttl_s=DEFAULT_IDLE_TTL_S):
+        self._vram_budget_mb = vram_budget_mb
+        self._ram_budget_mb = ram_budget_mb
+        self.idle_ttl_s = idle_ttl_s
+        self.residents = {} # name -> _Resident
+        # Reentrant: a loader may itself acquire a model (e.g. a pipeline view of shared weights)
+        self.lock = threading.RLock()
+        self.counters = {"hits": 0, "loads": 0, "restores": 0, "offloads": 0, "drops": 0, "load_seconds": 0.0}
+
+    @property
+    def vram_budget_mb(self):
+        if self._vram_budget_mb is None:
+            self._vram_budget_mb = _default_vram_budget_mb()
+        return self._vram_budget_mb
+
+    @property
+    def ram_budget_mb(self):
+        if self._ram_budget_mb is None:
+            self._ram_budget_mb = _default_ram_budget_mb()
+        return self._ram_budget_mb
+
+    def budget_mb(self, tier):
+        return self.vram_budget_mb if tier == "vram" else self.ram_budget_mb
+
+    def used_mb(self, tier):
+        return sum(resident.footprint_mb for resident in self.residents.values() if resident.tier == tier)
+
+    def acquire(self, name, load, footprint_mb, tier, working_vram_mb=0, offload=None, restore=None, release=None):
+        """
+        Returns the model `name`, loading it with `load()` or restoring it from CPU RAM as needed.
+        `tier` is where its weights live while in use ("vram", or "ram" for CPU-only or
+        CPU-offloaded pipelines); `working_vram_mb` is GPU memory it needs while it runs.
+        `offload`/`restore` enable VRAM -> RAM eviction; `release` runs before it is dropped.
+        """
+        with self.lock:
+            self.evict_idle(exclude=name)
+            resident = self.residents.get(name)
+
+            if resident is not None and resident.tier == resident.home_tier:
+                self.counters["hits"] += 1
+            elif resident is not None:
+                # Offloaded to RAM earlier: moving it back is far cheaper than reloading it
+                self._make_room("vram", resident.footprint_mb + working_vram_mb, exclude=name)
+                start = time.perf_counter()
+                resident.restore(resident.model)
+                resident.tier = resident.home_tier
+                self.counters["restores"] += 1
+                sys.stderr.write(f"Residency: restored '{name}' to VRAM in {time.perf_counter() - start:.1f}s.\n")
+            else:
+                self._make_room(tier, footprint_mb, exclude=name)
+                start = time.perf_counter()
+                model = load()
+                elapsed = time.perf_counter() - start
+                resident = _Resident(name, model, footprint_mb, tier, offload, restore, release)
+                self.residents[name] = resident
+                self.counters["loads"] += 1
+                self.counters["load_seconds"] += elapsed
+                sys.stderr.write(f"Residency: loaded '{name}' (~{footprint_mb} MB, {tier}) in {elapsed:.1f}s.\n")
+
+            if working_vram_mb:
+                self._make_room("vram", working_vram_mb, exclude=name)
+            resident.last_used = time.monotonic()
+            return resident.model
+
+    def _make_room(self, tier, needed_mb, exclude):
+        """Evicts least-recently-used models from `tier` until `needed_mb` more fits in its budget."""
+        if tier == "vram" and self.vram_budget_mb <= 0:
+            return # CPU-only: nothing lives in VRAM
+        while self.used_mb(tier) + needed_mb > self.budget_mb(tier):
+            candidates = [resident for resident in self.residents.values() if resident.tier == tier and resident.name != exclude]
+            if not candidates:
+                sys.stderr.write(f"Residency: '{exclude}' needs {needed_mb} MB of {tier} beyond the "
+                                 f"{self.budget_mb(tier)} MB budget; continuing over budget.\n")
+                return
+            self._evict(min(candidates, key=lambda resident: resident.last_used), reason="memory pressure")
+
+    def _evict(self, resident, reason):
+        # From VRAM, prefer offloading to RAM if the RAM budget can take it without dropping anything
+        can_offload = (resident.tier == "vram" and resident.offload is not None and resident.restore is not None
+                       and self.used_mb("ram") + resident.footprint_mb <= self.ram_budget_mb)
+        if can_offload:
+            resident.offload(resident.model)
+            resident.tier = "ram"
+            self.counters["offloads"] += 1
+            sys.stderr.write(f"Residency: offloaded '{resident.name}' to RAM ({reason}).\n")
+        else:
+            self.drop(resident.name, reason)
+        _free_memory()
+
+    def drop(self, name, reason="released"):
+        """Unloads `name` completely (it is reloaded on the next acquire)."""
+        with self.lock:
+            resident = self.residents.pop(name, None)
+            if resident is None:
+                return
+            if resident.release is not None:
+                resident.release(resident.model)
+            resident.model = None
+            self.counters["drops"] += 1
+            sys.stderr.write(f"Residency: dropped '{name}' ({reason}).\n")
+        _free_memory()
+
+    def evict_idle(self, exclude=None):
+        """Offloads (from VRAM) or drops (from RAM) models unused for longer than the idle TTL."""
+        with self.lock:
+            now = time.monotonic()
+            for resident in list(self.residents.values()):
+                if resident.name != exclude and now - resident.last_used > self.idle_ttl_s:
+                    # Offloaded models that stay idle for another TTL are dropped entirely
+                    self._evict(resident, reason=f"idle for {now - resident.last_used:.0f}s")
+                    resident.last_used = now
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            return {
+                "vram_budget_mb": self.vram_budget_mb,
+                "ram_budget_mb": self.ram_budget_mb,
+                "vram_used_mb": self.used_mb("vram"),
+                "ram_used_mb": self.used_mb("ram"),
+                "idle_ttl_s": self.idle_ttl_s,
+                "residents": {
+                    name: {"tier": resident.tier, "footprint_mb": resident.footprint_mb,
+                           "idle_s": round(now - resident.last_used, 1)}
+                    for name, resident in self.residents.items()
+                },
+                **{key: round(value, 3) if isinstance(value, float) else value for key, value in self.counters.items()},
+            }
+
+
+def move_modules(components, device):
+    """offload/restore helper for a diffusers component dict: moves every nn.Module in place."""
+    import torch
+    for component in components.values():
+        if isinstance(component, torch.nn.Module):
+            component.to(device)
+
+
+# Process-wide manager used by sd_components, svd_video_gen and the inference server
+default_manager = ResidencyManager()
@@ -0,0 +1,160 @@
+# ml_scripts/result_cache.py
+#
+# Content-addressed index of finished generations. The key is a hash of a canonical JSON
+# encoding of every input that determines the output (model, prompt, negative prompt, seed,
+# scheduler, steps, guidance, size), so a request that repeats a remembered seed is answered
+# with the file already under storage/images without loading the model at all.
+#
+# The index is one small JSON file per key under storage/cache/results/, so concurrent
+# scripts never rewrite a shared file. The artifacts themselves belong to the content
+# records that created them, so eviction only drops index entries, never images:
+#   ML_RESULT_CACHE_MB        total size of the artifacts the index may reference (default 2048)
+#   ML_RESULT_CACHE_DISABLE=1 always regenerate
+import os
+import json
+import time
+import hashlib
+import threading
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFAULT_INDEX_DIR = os.path.join(PROJECT_ROOT, 'storage', 'cache', 'results')
+DEFAULT_MAX_MB = int(os.environ.get("ML_RESULT_CACHE_MB", "2048"))
+RESULT_CACHE_DISABLE = os.environ.get("ML_RESULT_CACHE_DISABLE", "0") == "1"
+
+# Bump when a code change alters the pixels produced for the same inputs
+KEY_VERSION = 1
+
+
+def generation_key(inputs):
+    """sha256 of the canonical JSON form of `inputs` (key order and whitespace don't matter)."""
+    canonical = json.dumps({"version": KEY_VERSION, **inputs}, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR, max_bytes=DEFAULT_MAX_MB * 1024 * 1024, enabled=not RESULT_CACHE_DISABLE):
+        self.index_dir = index_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.integrity_failures = 0
+        self.evictions = 0
+
+    def _index_path(self, key):
+        return os.path.join(self.index_dir, f"{key}.json")
+
+    def lookup(self, key):
+        """
+        Returns the index entry ({"path": "storage/images/...", ...}) for `key` if its artifact
+        still exists and is byte-for-byte what was stored, otherwise None.
+        """
+        if not self.enabled:
+            return None
+
+        index_path = self._index_path(key)
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        artifact = os.path.join(PROJECT_ROOT, entry.get("path", ""))
+        try:
+            intact = os.path.getsize(artifact) == entry.get("size") and file_sha256(artifact) == entry.get("sha256")
+        except OSError:
+            intact = False
+
+        if not intact:
+            # Deleted or modified since it was indexed: forget it and regenerate
+            self._remove(index_path)
+            with self.lock:
+                self.integrity_failures += 1
+                self.misses += 1
+            return None
+
+        try:
+            os.utime(index_path) # mtime doubles as "last used" for eviction
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return entry
+
+    def store(self, key, relative_path, **metadata):
+        """Indexes the finished artifact at `relative_path` (relative to the project root) under `key`."""
+        if not self.enabled:
+            return
+        artifact = os.path.join(PROJECT_ROOT, relative_path)
+        entry = {
+            "path": relative_path,
+            "size": os.path.getsize(artifact),
+            "sha256": file_sha256(artifact),
+            "created": round(time.time(), 3),
+            **metadata,
+        }
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        # Write then rename, so a concurrent lookup never reads a half-written entry
+        index_path = self._index_path(key)
+        temp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(temp_path, index_path)
+        self._prune()
+
+    def _prune(self):
+        """Drops least-recently-used entries until the referenced artifacts fit in max_bytes."""
+        entries = []
+        for name in os.listdir(self.index_dir):
+            if not name.endswith(".json"):
+                continue
+            index_path = os.path.join(self.index_dir, name)
+            try:
+                with open(index_path, "r", encoding="utf-8") as f:
+                    size = json.load(f).get("size", 0)
+                entries.append((os.path.getmtime(index_path), size, index_path))
+            except (OSError, ValueError):
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, index_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(index_path)
+            total -= size
+            with self.lock:
+                self.evictions += 1
+
+    @staticmethod
+    def _remove(index_path):
+        try:
+            os.remove(index_path)
+        except OSError:
+            pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "integrity_failures": self.integrity_failures,
+            "evictions": self.evictions,
+        }
+
+
+# Shared per-process instance used by image_gen
+default_cache = ResultCache()
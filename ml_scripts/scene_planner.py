@@ -0,0 +1,360 @@
+# ml_scripts/scene_planner.py
+#
+# Map-reduce condensing of long documents for scene planning, so the scene prompt sees the
+# whole story rather than its first page. A document that fits the reduce budget is used
+# as-is. A longer one is split into token chunks, each chunk is summarised (map; several
+# chunks per batched generate call), and the summaries are joined. If they still exceed the
+# budget, they are grouped and summarised again (reduce), until they fit. The result always
+# fits REDUCE_TOKENS, whatever the document length.
+#
+# Each summary's length is the reduce budget divided by the number of chunks, so a level
+# usually fits in one pass. A level summarises at most MAX_CHUNKS chunks: above that, an
+# evenly spaced sample of them (always the first and the last) stands in for the rest. The
+# map work is therefore bounded, MAX_CHUNKS / batch size generate calls per level and at
+# most MAX_LEVELS levels, at the cost of skipping parts of very long stories (reported as
+# "skipped_chunks" in the story_condensed event).
+#   ML_PLAN_CHUNK_TOKENS   tokens of document per map prompt (default 1200; GPT-J has 2048)
+#   ML_PLAN_REDUCE_TOKENS  token budget of the text handed to the scene prompt (default 900)
+#   ML_PLAN_MAP_BATCH      chunk prompts per generate call (default 4 on CUDA, 1 on CPU)
+#   ML_PLAN_MAX_CHUNKS     chunks summarised per level (default 16)
+#   ML_PLAN_MAX_DOC_TOKENS documents are read up to this many tokens (default 65536)
+#
+# The scene list itself is generated under SceneArrayConstraint: a logits processor that
+# only admits tokens keeping the output a prefix of `[{"prompt": "..."}, ...]`, and stops
+# generation the moment the array closes. Only the completion is returned, so json.loads
+# gets exactly the array, and no tokens are spent after it.
+import os
+import sys
+import json
+import time
+
+from events import EVENTS
+import prefix_cache
+
+CHUNK_TOKENS = int(os.environ.get("ML_PLAN_CHUNK_TOKENS", "1200"))
+REDUCE_TOKENS = int(os.environ.get("ML_PLAN_REDUCE_TOKENS", "900"))
+MAP_BATCH = os.environ.get("ML_PLAN_MAP_BATCH")
+MAX_CHUNKS = max(2, int(os.environ.get("ML_PLAN_MAX_CHUNKS", "16")))
+MAX_DOCUMENT_TOKENS = int(os.environ.get("ML_PLAN_MAX_DOC_TOKENS", "65536"))
+MIN_SUMMARY_TOKENS = 48
+MAX_SUMMARY_TOKENS = 256
+MAX_LEVELS = 4
+
+MIN_SCENES = 3
+MAX_SCENES = 5
+SCENE_MAX_NEW_TOKENS = 512
+SCENE_ATTEMPTS = 2
+SCENE_PROMPT_HEADER = (
+    "You are a helpful assistant that breaks a story into 3-5 scenes.\n"
+    "For each scene, output a JSON object with a single key 'prompt' that contains a detailed, cinematic, text-to-image description.\n"
+    "Return ONLY a JSON array of these objects and nothing else. No explanations, no extra text.\n"
+)
+
+# Per-process totals, so a long-running caller can report its parse-failure rate
+PLAN_STATS = {"plans": 0, "attempts": 0, "parse_failures": 0, "tokens": 0}
+
+# Grammar of the scene list, see SceneArrayConstraint
+WHITESPACE = " \t\n\r"
+KEY = '"prompt"'
+STRUCTURAL_CHARS = set('[]{}:,"prompt' + WHITESPACE)
+START = ("start", 0, 0)
+_VOCABS = {}
+
+
+def token_count(tokenizer, text):
+    return len(tokenizer(text, add_special_tokens=False, verbose=False)["input_ids"])
+
+
+def split_by_tokens(tokenizer, text, chunk_tokens=CHUNK_TOKENS):
+    """Splits `text` into pieces of at most `chunk_tokens` tokens, preferring paragraph breaks."""
+    ids = tokenizer(text, add_special_tokens=False, verbose=False)["input_ids"]
+    chunks = []
+    start = 0
+    while start < len(ids):
+        stop = min(start + chunk_tokens, len(ids))
+        chunk = tokenizer.decode(ids[start:stop])
+        if stop < len(ids):
+            # Move the cut back to the last paragraph (or sentence) break in the chunk's second half
+            for separator in ("\n\n", "\n", ". "):
+                cut = chunk.rfind(separator)
+                if cut > len(chunk) // 2:
+                    chunk = chunk[:cut + len(separator)]
+                    stop = start + max(1, token_count(tokenizer, chunk))
+                    break
+        chunks.append(chunk.strip())
+        start = stop
+    return [chunk for chunk in chunks if chunk]
+
+
+def sample_chunks(chunks, max_chunks=MAX_CHUNKS):
+    """At most `max_chunks` of `chunks`, evenly spaced and in order, keeping the first and the last."""
+    if len(chunks) <= max_chunks:
+        return chunks
+    last = len(chunks) - 1
+    return [chunks[round(k * last / (max_chunks - 1))] for k in range(max_chunks)]
+
+
+def _summary_prompt(chunk, words):
+    return (
+        f"Summarise the following part of a story in at most {words} words. Keep the characters, "
+        "places and key events in order. Write plain prose.\n"
+        f"Text:\n{chunk}\n"
+        "Summary:"
+    )
+
+
+def _map_batch_size(llm_pipeline):
+    if MAP_BATCH:
+        return max(1, int(MAP_BATCH))
+    return 4 if str(llm_pipeline.device).startswith("cuda") else 1
+
+
+def summarise(llm_pipeline, chunks, summary_tokens, level=1):
+    """One map pass: a summary of at most `summary_tokens` tokens per chunk, in chunk order."""
+    tokenizer = llm_pipeline.tokenizer
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id # GPT-J has no pad token; batching needs one
+    tokenizer.padding_side = "left" # Decoder-only models generate after the prompt's last token
+    batch_size = _map_batch_size(llm_pipeline)
+    prompts = [_summary_prompt(chunk, int(summary_tokens * 0.75)) for chunk in chunks]
+
+    start = time.perf_counter()
+    with EVENTS.stage("summarise_chunks", level=level, chunks=len(chunks), batch_size=batch_size):
+        outputs = llm_pipeline(
+            prompts,
+            batch_size=batch_size,
+            max_new_tokens=summary_tokens,
+            do_sample=False,
+            return_full_text=False,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+    summaries = [output[0]["generated_text"].strip() for output in outputs]
+    sys.stderr.write(f"Scene planning: summarised {len(chunks)} chunks (level {level}, batches of {batch_size}, "
+                     f"<= {summary_tokens} tokens each) in {time.perf_counter() - start:.1f}s.\n")
+    return summaries
+
+
+def condense(llm_pipeline, text, reduce_tokens=REDUCE_TOKENS, chunk_tokens=CHUNK_TOKENS):
+    """
+    Returns (text, stats): `text` unchanged if it fits `reduce_tokens`, otherwise a map-reduce
+    summary of it that does. stats has the document's token count and the chunks per level
+    (with "skipped_chunks" where a level had more than MAX_CHUNKS).
+    """
+    tokenizer = llm_pipeline.tokenizer
+    document_tokens = token_count(tokenizer, text)
+    stats = {"document_tokens": document_tokens, "levels": []}
+    level = 0
+    tokens = document_tokens
+    while tokens > reduce_tokens:
+        level += 1
+        chunks = split_by_tokens(tokenizer, text, chunk_tokens)
+        level_stats = {}
+        if len(chunks) > MAX_CHUNKS:
+            level_stats["skipped_chunks"] = len(chunks) - MAX_CHUNKS
+            sys.stderr.write(f"Scene planning: {len(chunks)} chunks at level {level}, summarising an evenly spaced "
+                             f"{MAX_CHUNKS} of them (ML_PLAN_MAX_CHUNKS).\n")
+            chunks = sample_chunks(chunks)
+        summary_tokens = max(MIN_SUMMARY_TOKENS, min(MAX_SUMMARY_TOKENS, reduce_tokens // len(chunks)))
+        if level == MAX_LEVELS:
+            # Last level: whatever the summaries say, they must fit the reduce budget
+            summary_tokens = max(1, reduce_tokens // len(chunks))
+        text = "\n\n".join(summary for summary in summarise(llm_pipeline, chunks, summary_tokens, level) if summary)
+        tokens = token_count(tokenizer, text)
+        stats["levels"].append({"chunks": len(chunks), "summary_tokens": summary_tokens, "output_tokens": tokens, **level_stats})
+        if level == MAX_LEVELS and tokens > reduce_tokens:
+            text = tokenizer.decode(tokenizer(text, add_special_tokens=False)["input_ids"][:reduce_tokens])
+            tokens = reduce_tokens
+
+    stats["condensed_tokens"] = tokens
+    if level:
+        EVENTS.emit("story_condensed", **stats)
+    return text, stats
+
+
+def _vocab(tokenizer):
+    """Every token's text, and the token ids each grammar state has to check, computed once per tokenizer."""
+    key = (tokenizer.name_or_path, len(tokenizer))
+    if key not in _VOCABS:
+        texts = tokenizer.batch_decode([[token_id] for token_id in range(len(tokenizer))])
+        plain, candidates = [], []
+        for token_id, text in enumerate(texts):
+            if not text:
+                continue
+            if all(ch >= " " and ch not in '"\\' for ch in text):
+                plain.append(token_id) # Always valid inside a string
+            if '"' in text or set(text) <= STRUCTURAL_CHARS:
+                candidates.append(token_id) # May be valid outside a string, or close one
+        _VOCABS[key] = (texts, plain, candidates)
+    return _VOCABS[key]
+
+
+class SceneArrayConstraint:
+    """
+    Logits processor for `[{"prompt": "..."}, ...]` with min_scenes..max_scenes objects.
+    Whitespace is allowed between structural tokens; prompts must be non-empty and may not
+    use backslash escapes or control characters (image prompts never need them). EOS is
+    only allowed once the array is closed. stopping_criteria() ends generation there.
+
+    The grammar is a small character automaton; the tokens allowed in each of its states
+    are computed once (strings only check the few tokens containing a quote) and cached.
+    """
+
+    def __init__(self, tokenizer, min_scenes=MIN_SCENES, max_scenes=MAX_SCENES):
+        self.texts, self.plain, self.candidates = _vocab(tokenizer)
+        self.eos_token_id = tokenizer.eos_token_id
+        self.min_scenes = min_scenes
+        self.max_scenes = max_scenes
+        self.allowed = {}
+        self.prompt_length = None
+        self.states = []
+        self.tokens = []
+        self.tokens_seen = 0
+
+    def _step(self, state, ch):
+        phase, count, chars = state
+        if phase == "str":
+            if ch == '"':
+                return ("post_value", count, 0) if chars else None
+            return None if ch == "\\" or ch < " " else ("str", count, 1)
+        if ch in WHITESPACE:
+            return None if phase in ("key", "done") else state
+        if phase == "start" and ch == "[":
+            return ("obj", 0, 0)
+        if phase == "obj" and ch == "{":
+            return ("pre_key", count, 0)
+        if phase == "pre_key" and ch == '"':
+            return ("key", count, 1)
+        if phase == "key" and ch == KEY[chars]:
+            return ("colon", count, 0) if chars + 1 == len(KEY) else ("key", count, chars + 1)
+        if phase == "colon" and ch == ":":
+            return ("pre_value", count, 0)
+        if phase == "pre_value" and ch == '"':
+            return ("str", count, 0)
+        if phase == "post_value" and ch == "}":
+            return ("after_obj", count + 1, 0)
+        if phase == "after_obj" and ch == "," and count < self.max_scenes:
+            return ("obj", count, 0)
+        if phase == "after_obj" and ch == "]" and count >= self.min_scenes:
+            return ("done", count, 0)
+        return None
+
+    def advance(self, state, text):
+        for ch in text:
+            state = self._step(state, ch)
+            if state is None:
+                return None
+        return state
+
+    def _allowed_ids(self, state, device):
+        import torch
+
+        if state not in self.allowed:
+            if state[0] == "done":
+                ids = [self.eos_token_id]
+            else:
+                ids = [token_id for token_id in self.candidates if self.advance(state, self.texts[token_id]) is not None]
+                if state[0] == "str":
+                    ids = sorted(set(ids).union(self.plain))
+            self.allowed[state] = torch.tensor(ids or [self.eos_token_id], dtype=torch.long, device=device)
+        return self.allowed[state]
+
+    def update(self, input_ids):
+        """Feeds each row's newly generated token through the automaton (idempotent per step)."""
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+            self.states = [START] * input_ids.shape[0]
+            self.tokens = [0] * input_ids.shape[0]
+        while self.prompt_length + self.tokens_seen < input_ids.shape[1]:
+            index = self.prompt_length + self.tokens_seen
+            for row, state in enumerate(self.states):
+                if state is not None and state[0] != "done":
+                    self.states[row] = self.advance(state, self.texts[int(input_ids[row, index])])
+                    self.tokens[row] += 1
+            self.tokens_seen += 1
+
+    def done(self, row=0):
+        return self.states[row] is not None and self.states[row][0] == "done"
+
+    def __call__(self, input_ids, scores):
+        import torch
+
+        self.update(input_ids)
+        mask = torch.full_like(scores, float("-inf"))
+        for row, state in enumerate(self.states):
+            # A row that left the grammar (only possible via a forced token) is left unconstrained
+            if state is None:
+                mask[row] = 0
+            else:
+                mask[row, self._allowed_ids(state, scores.device)] = 0
+        return scores + mask
+
+    def stopping_criteria(self):
+        return _ArrayClosed(self)
+
+
+class _ArrayClosed:
+    """Stopping criterion: a row is finished as soon as its array is closed."""
+
+    def __init__(self, constraint):
+        self.constraint = constraint
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+
+        self.constraint.update(input_ids)
+        return torch.tensor([self.constraint.done(row) for row in range(input_ids.shape[0])], device=input_ids.device)
+
+
+def plan_scenes(llm_pipeline, story_text, max_new_tokens=SCENE_MAX_NEW_TOKENS):
+    """
+    The story's scene list ([{"prompt": ...}, ...]) under SceneArrayConstraint. A plan that
+    did not close within max_new_tokens is retried, up to SCENE_ATTEMPTS times; every
+    attempt's token count and outcome are emitted as a "scene_plan" event.
+    """
+    from transformers import LogitsProcessorList, StoppingCriteriaList
+
+    # The instructions are the same for every story: their KV cache is reused (prefix_cache.py)
+    prefix = f"{SCENE_PROMPT_HEADER}Story:\n"
+    PLAN_STATS["plans"] += 1
+    for attempt in range(1, SCENE_ATTEMPTS + 1):
+        constraint = SceneArrayConstraint(llm_pipeline.tokenizer)
+        start = time.perf_counter()
+        with EVENTS.stage("plan_scenes", attempt=attempt):
+            raw_output, generation = prefix_cache.for_pipeline(llm_pipeline).generate(
+                prefix,
+                f"{story_text}\n",
+                max_new_tokens=max_new_tokens,
+                do_sample=True,
+                logits_processor=LogitsProcessorList([constraint]),
+                stopping_criteria=StoppingCriteriaList([constraint.stopping_criteria()]),
+                pad_token_id=llm_pipeline.tokenizer.eos_token_id,
+            )
+        tokens = constraint.tokens[0] if constraint.tokens else 0
+        PLAN_STATS["attempts"] += 1
+        PLAN_STATS["tokens"] += tokens
+
+        scenes = None
+        if constraint.done():
+            try:
+                scenes = json.loads(raw_output)
+            except ValueError:
+                pass
+        if scenes is None:
+            PLAN_STATS["parse_failures"] += 1
+        stats = {
+            "attempt": attempt,
+            "tokens": tokens,
+            "closed": constraint.done(),
+            "parsed": scenes is not None,
+            "seconds": round(time.perf_counter() - start, 3),
+            "ttft_s": generation["ttft_s"],
+            "cached_prefix": generation["cached_prefix"],
+            "parse_failure_rate": round(PLAN_STATS["parse_failures"] / PLAN_STATS["attempts"], 3),
+        }
+        EVENTS.emit("scene_plan", **stats)
+        sys.stderr.write(f"Scene plan: {tokens} tokens in {stats['seconds']:.1f}s, "
+                         f"{'parsed' if scenes is not None else 'not closed'} (attempt {attempt}).\n")
+        if scenes is not None:
+            return scenes, stats
+        sys.stderr.write(f"Unparsed scene plan output:\n{raw_output}\n")
+    raise ValueError(f"The scene list was not closed within {max_new_tokens} tokens ({SCENE_ATTEMPTS} attempts).")
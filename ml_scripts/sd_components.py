@@ -0,0 +1,135 @@
+# ml_scripts/sd_components.py
+#
+# Process-wide registry for the Stable Diffusion 1.5 weights. The UNet, VAE, text encoder
+# and tokenizer are loaded once per (model, device, dtype) and every pipeline "view"
+# (txt2img, img2img, the SVD keyframe phase) is built on top of those same modules, so
+# serving several modes never holds more than one copy of the weights.
+#
+# The components are owned by the residency manager (residency.py): under VRAM pressure
+# they are moved to CPU RAM in place (views stay valid) and moved back on the next use.
+import sys
+import profiling
+import residency
+
+SD15_MODEL_ID = "runwayml/stable-diffusion-v1-5"
+
+_fallbacks = {}  # (model_id, device, dtype) -> CPU key used instead after a failed device move
+_pipelines = {}  # (kind, model_id, device, dtype) -> pipeline view
+
+
+def select_device():
+    """Returns "cuda" when an NVIDIA GPU is usable, otherwise "cpu"."""
+    import torch
+
+    try:
+        if torch.cuda.is_available():
+            return "cuda"
+    except Exception as e:
+        sys.stderr.write(f"Error with CUDA configuration: {e}\n")
+    return "cpu"
+
+
+def default_dtype(device):
+    """float16 is essential for GPU speed; CPU kernels need float32."""
+    import torch
+    return torch.float16 if device == "cuda" else torch.float32
+
+
+def _pipeline_classes():
+    from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline
+    return {
+        "txt2img": StableDiffusionPipeline,
+        "img2img": StableDiffusionImg2ImgPipeline,
+    }
+
+
+def _resident_name(key):
+    model_id, device, dtype = key
+    return f"sd15:{model_id}@{device}/{dtype.replace('torch.', '')}"
+
+
+class _DeviceMoveError(Exception):
+    """The weights loaded but could not be moved to the requested device."""
+
+
+def _load_components(key, dtype):
+    from diffusers import StableDiffusionPipeline
+
+    model_id, device, _ = key
+    sys.stderr.write(f"Loading shared Stable Diffusion components ({model_id}, {device}, {dtype})...\n")
+    base = StableDiffusionPipeline.from_pretrained(model_id, torch_dtype=dtype)
+    try:
+        base.to(device)
+    except Exception as e:
+        sys.stderr.write(f"Error moving model to {device}: {e}\nFalling back to CPU (VERY SLOW).\n")
+        del base
+        raise _DeviceMoveError(str(e))
+    # With --profile, VAE work shows up as its own span inside "sample"
+    profiling.instrument(base.vae, "encode", "vae_encode")
+    profiling.instrument(base.vae, "decode", "vae_decode")
+    # The txt2img view is the pipeline we just built; keep it instead of rebuilding
+    _pipelines[("txt2img",) + key] = base
+    return base.components
+
+
+def _release_views(key):
+    for view_key in [k for k in _pipelines if k[1:] == key]:
+        del _pipelines[view_key]
+
+
+def get_components(device=None, dtype=None, model_id=SD15_MODEL_ID):
+    """Loads (or restores) and returns the shared component dict for `model_id`."""
+    device = device or select_device()
+    dtype = dtype or default_dtype(device)
+    key = (model_id, device, str(dtype))
+    # Remember a CPU fallback so later calls do not retry the failing device
+    if key in _fallbacks:
+        return get_components("cpu", None, model_id)
+
+    try:
+        return residency.default_manager.acquire(
+            _resident_name(key),
+            lambda: _load_components(key, dtype),
+            footprint_mb=residency.footprint_mb("sd15", dtype),
+            tier="vram" if device == "cuda" else "ram",
+            working_vram_mb=residency.WORKING_VRAM_MB["sd15"] if device == "cuda" else 0,
+            offload=lambda components: residency.move_modules(components, "cpu"),
+            restore=lambda components: residency.move_modules(components, device),
+            release=lambda components: _release_views(key),
+        )
+    except _DeviceMoveError:
+        _fallbacks[key] = True
+        return get_components("cpu", None, model_id)
+
+
+def get_pipeline(kind, device=None, dtype=None, model_id=SD15_MODEL_ID):
+    """
+    Returns the `kind` ("txt2img" or "img2img") pipeline built from the shared components.
+    Views are cheap: they only hold references to the already-loaded modules.
+    """
+    classes = _pipeline_classes()
+    if kind not in classes:
+        raise ValueError(f"Unknown pipeline kind: {kind}")
+
+    device = device or select_device()
+    dtype = dtype or default_dtype(device)
+    components = get_components(device, dtype, model_id)
+
+    # get_components may have fallen back to CPU; key the view on where the weights really live
+    actual_device = str(components["unet"].device).split(":")[0]
+    key = (kind, model_id, actual_device, str(components["unet"].dtype))
+    if key not in _pipelines:
+        _pipelines[key] = classes[kind](**components)
+    return _pipelines[key]
+
+
+def loaded_keys():
+    """Describes what is currently resident, for logging and health checks."""
+    return [name for name in residency.default_manager.residents if name.startswith("sd15:")]
+
+
+def release_all():
+    """Drops every shared component and view so the memory can be reclaimed."""
+    for name in loaded_keys():
+        residency.default_manager.drop(name)
+    _pipelines.clear()
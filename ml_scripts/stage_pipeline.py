@@ -0,0 +1,106 @@
+# ml_scripts/stage_pipeline.py
+#
+# Small producer/consumer helpers for overlapping a GPU-bound loop with CPU-side work
+# (PNG encoding, piping frames to ffmpeg, disk writes). The GPU loop stays on the calling
+# thread; each CPU stage is a StageWorker thread fed through a bounded queue, so a slow
+# consumer applies backpressure instead of letting decoded frames pile up in memory.
+#
+# Every stage records its busy time. utilisation() reports, per stage, busy seconds / wall
+# seconds and how long the producer was blocked on a full queue. A stage near 100% is the
+# critical path; large "blocked" time on a worker means it is the bottleneck.
+import sys
+import time
+import queue
+import threading
+from contextlib import contextmanager
+
+from events import EVENTS
+
+_STOP = object()
+
+
+class StageClock:
+    """Busy time of the stages that run on the calling thread (the GPU loop)."""
+
+    def __init__(self):
+        self.busy_s = {}
+        self.items = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.busy_s[name] = self.busy_s.get(name, 0.0) + time.perf_counter() - start
+            self.items[name] = self.items.get(name, 0) + 1
+
+
+class StageWorker:
+    """
+    Runs `handler(item)` on a dedicated thread for each submitted item, in order. At most
+    `max_pending` items wait in the queue; submit() blocks beyond that. The handler is
+    expected to deal with its own per-item failures; an exception that escapes it stops the
+    stage and is re-raised by the next submit() or by close().
+    """
+
+    def __init__(self, name, handler, max_pending=2):
+        self.name = name
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.busy_s = 0.0
+        self.blocked_s = 0.0 # producer time spent waiting for queue space
+        self.items = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name=f"stage-{name}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            if self.error is not None:
+                continue # Keep draining so the producer never blocks on a dead stage
+            start = time.perf_counter()
+            try:
+                self.handler(item)
+            except BaseException as e:
+                self.error = e
+            self.busy_s += time.perf_counter() - start
+            self.items += 1
+
+    def submit(self, item):
+        if self.error is not None:
+            raise self.error
+        start = time.perf_counter()
+        self.queue.put(item)
+        self.blocked_s += time.perf_counter() - start
+
+    def close(self):
+        """Waits for every queued item to be handled."""
+        self.queue.put(_STOP)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def utilisation(wall_s, clock=None, workers=()):
+    """Per-stage busy time and utilisation over `wall_s`; logged to stderr and emitted as an event."""
+    stages = {}
+    if clock is not None:
+        for name, busy_s in clock.busy_s.items():
+            stages[name] = {"thread": "main", "busy_s": round(busy_s, 3), "items": clock.items[name]}
+    for worker in workers:
+        stages[worker.name] = {"thread": "worker", "busy_s": round(worker.busy_s, 3), "items": worker.items,
+                               "producer_blocked_s": round(worker.blocked_s, 3)}
+    for stats in stages.values():
+        stats["utilisation"] = round(stats["busy_s"] / wall_s, 3) if wall_s > 0 else 0.0
+
+    sys.stderr.write(f"Stage utilisation over {wall_s:.1f}s:\n")
+    for name, stats in sorted(stages.items(), key=lambda item: -item[1]["busy_s"]):
+        blocked = f", producer blocked {stats['producer_blocked_s']:.1f}s" if "producer_blocked_s" in stats else ""
+        sys.stderr.write(f"  {name:<16} {stats['utilisation'] * 100:5.1f}%  ({stats['busy_s']:.1f}s busy, "
+                         f"{stats['items']} items, {stats['thread']}{blocked})\n")
+    EVENTS.emit("stage_utilisation", wall_s=round(wall_s, 3), stages=stages)
+    return stages
@@ -3,44 +3,54 @@ import sys
 import os
 import torch
 from transformers import pipeline
+from events import EVENTS, fail
+import profiling
+import prefix_cache
+from profiling import PROFILER
+
+# Every story uses the same instruction header; its KV cache is computed once per loaded
+# model and reused (prefix_cache.py)
+INSTRUCTION_PREFIX = "### Instruction:\nWrite a high-quality, creative short story with a clear beginning, middle, and end, based on the following content. The story should be coherent and engaging.\n### Content:\n"
 
 def generate_story(file_path, content_id):
     try:
         # Load a high-quality LLM model (e.g., fine-tuned Mistral)
-        llm_pipeline = pipeline(
-            "text-generation", 
-            model="TheBloke/Mistral-7B-Instruct-v0.2-AWQ", # A good, fast model
-            device=0,
-            torch_dtype=torch.float16
-        )
+        with EVENTS.stage("load_llm"):
+            llm_pipeline = pipeline(
+                "text-generation", 
+                model="TheBloke/Mistral-7B-Instruct-v0.2-AWQ", # A good, fast model
+                device=0,
+                torch_dtype=torch.float16
+            )
 
         sys.stderr.write("LLM pipeline loaded.\n")
 
     except Exception as e:
-        sys.stderr.write(f"Error loading LLM model: {e}\n")
-        sys.exit(1)
+        fail(f"Error loading LLM model: {e}")
 
     try:
         with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
             file_content = f.read()
         
         # Use an improved prompt template for better story quality
-        prompt = f"### Instruction:\nWrite a high-quality, creative short story with a clear beginning, middle, and end, based on the following content. The story should be coherent and engaging.\n### Content:\n{file_content}\n### Response:\n"
-
-        story_output = llm_pipeline(
-            prompt,
-            max_new_tokens=1024, # Increased for a longer, more detailed story
-            do_sample=True,
-            temperature=0.7,
-            top_k=50,
-            top_p=0.95
-        )
-
-        generated_story = story_output[0]['generated_text']
+        content = f"{file_content}\n### Response:\n"
+
+        with EVENTS.stage("generate_story"), PROFILER.torch_profile("generate_story"):
+            completion, _ = prefix_cache.for_pipeline(llm_pipeline).generate(
+                INSTRUCTION_PREFIX,
+                content,
+                max_new_tokens=1024, # Increased for a longer, more detailed story
+                do_sample=True,
+                temperature=0.7,
+                top_k=50,
+                top_p=0.95
+            )
+
+        # Same file contents as before: the prompt followed by the story
+        generated_story = INSTRUCTION_PREFIX + content + completion
         
     except Exception as e:
-        sys.stderr.write(f"Error during story generation: {e}\n")
-        sys.exit(1)
+        fail(f"Error during story generation: {e}")
 
     # Save the generated story to a text file
     output_dir = os.path.join(os.path.dirname(__file__), '..', 'storage', 'stories')
@@ -54,20 +64,21 @@ def generate_story(file_path, content_id):
         with open(output_path, 'w', encoding='utf-8') as f:
             f.write(generated_story)
         
-        # Print the relative path to Node.js
-        print(f"storage/stories/{output_filename}")
-        
     except Exception as e:
-        sys.stderr.write(f"Error saving story: {e}\n")
-        sys.exit(1)
+        fail(f"Error saving story: {e}")
+
+    EVENTS.result(path=f"storage/stories/{output_filename}")
+    # Print the relative path to Node.js
+    print(f"storage/stories/{output_filename}")
 
 if __name__ == "__main__":
+    profiling.enable_from_argv()
     if len(sys.argv) > 2:
         file_path_arg = sys.argv[1]
         content_id_arg = sys.argv[2]
         generate_story(file_path_arg, content_id_arg)
     else:
-        sys.stderr.write("Usage: python story_gen.py <file_path> <content_id>\n")
+        sys.stderr.write("Usage: python story_gen.py <file_path> <content_id> [--profile] [--torch-profile]\n")
         sys.exit(1)
 
 
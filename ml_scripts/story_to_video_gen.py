@@ -6,154 +6,344 @@ import io
 import os
 import torch
 import json
-import re
+import time
 from diffusers import StableDiffusionPipeline, StableVideoDiffusionPipeline
-from diffusers.utils import export_to_video
 from transformers import pipeline
 from PIL import Image
-import fitz  # pymupdf
-from docx import Document
+from events import EVENTS, StepProgress, pipeline_callback_kwargs, fail
+import profiling
+import svd_planner
+import keyframes
+import stage_pipeline
+import job_workdir
+import video_encoder
+import residency
+import doc_extract
+import scene_planner
+from profiling import PROFILER
 
 # --- Fix for Windows Unicode output errors ---
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
 
 
-def extract_text_from_pdf(path):
-    doc = fitz.open(path)
-    text = ""
-    for page in doc:
-        text += page.get_text()
-    return text
+def log(message):
+    # Progress messages go to stderr: stdout is reserved for the final result path
+    print(message, file=sys.stderr)
+
+
+# Long stories are condensed by map-reduce before scene planning (scene_planner.py); the
+# limit only bounds how much of a huge upload is read at all
+STORY_CHAR_LIMIT = scene_planner.MAX_DOCUMENT_TOKENS * doc_extract.CHARS_PER_TOKEN
+KEYFRAME_NEGATIVE_PROMPT = "blurry, low quality, distorted, bad anatomy"
+KEYFRAME_STEPS = 30
+KEYFRAME_GUIDANCE = 9.0
+SCENE_FRAMES = 25
+VIDEO_FPS = 8
+
+
+def extract_story_text(job, file_path):
+    """Stage 1: the (truncated) input text, reused from the job directory when resuming."""
+    if job.done("text.txt"):
+        log("Reusing extracted text from the job directory.")
+        return job.read_text("text.txt")
+
+    log("Loading and extracting text from input file...")
+    with EVENTS.stage("extract_text"):
+        file_content, stats = doc_extract.extract_text(file_path, max_chars=STORY_CHAR_LIMIT)
 
+    if stats["truncated"]:
+        log(f"Warning: Story is very long. Processing first {STORY_CHAR_LIMIT} characters only.")
+        EVENTS.warning(f"Input is longer than {STORY_CHAR_LIMIT} characters; only the first {STORY_CHAR_LIMIT} are used.")
+    job.write_text("text.txt", file_content)
+    return file_content
 
-def extract_text_from_docx(path):
-    doc = Document(path)
-    return "\n".join([para.text for para in doc.paragraphs])
 
+def _valid_scenes(path, metadata):
+    with open(path, "r", encoding="utf-8") as f:
+        scenes = json.load(f)
+    return isinstance(scenes, list) and bool(scenes) and all(isinstance(scene.get("prompt"), str) for scene in scenes)
 
-def load_text_from_file(file_path):
-    ext = os.path.splitext(file_path)[1].lower()
-    if ext == '.pdf':
-        return extract_text_from_pdf(file_path)
-    elif ext == '.docx':
-        return extract_text_from_docx(file_path)
-    else:
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            return f.read()
 
+def plan_story_scenes(job, file_content):
+    """Stage 2: the scene list from GPT-J, reused from the job directory when resuming."""
+    if job.done("scenes.json", validate=_valid_scenes):
+        log("Reusing the scene script from the job directory.")
+        return job.read_json("scenes.json")
 
-def generate_story_video(file_path, content_id):
-    try:
-        print("Loading and extracting text from input file...")
-        file_content = load_text_from_file(file_path)
-
-        if len(file_content) > 1500:
-            print("Warning: Story is very long. Processing first 1500 characters only.")
-            file_content = file_content[:1500]
-
-        print("Generating story script from text using LLM...")
-
-        llm_pipeline = pipeline(
-            "text-generation",
-            model="EleutherAI/gpt-j-6B",
-            device=0 if torch.cuda.is_available() else -1,
-            torch_dtype=torch.float16 if torch.cuda.is_available() else None,
-        )
-
-        llm_prompt = (
-            "You are a helpful assistant that breaks a story into 3-5 scenes.\n"
-            "For each scene, output a JSON object with a single key 'prompt' that contains a detailed, cinematic, text-to-image description.\n"
-            "Return ONLY a JSON array of these objects and nothing else. No explanations, no extra text.\n"
-            f"Story:\n{file_content}\n"
-        )
-
-        script_output = llm_pipeline(llm_prompt, max_new_tokens=512, do_sample=True, pad_token_id=llm_pipeline.tokenizer.eos_token_id)
-        raw_output = script_output[0]['generated_text']
-
-        print("Raw LLM output:")
-        print(raw_output)
-
-        # --- FIX: Refine JSON extraction with a more robust regex ---
-        # This regex looks for the first '[' and the last ']' in the output,
-        # which should capture the entire JSON array even if there is
-        # leading or trailing text.
-        json_match = re.search(r'\[.*\]', raw_output.strip(), re.DOTALL)
-        
-        if json_match:
-            json_string = json_match.group(0)
-            
-            # --- FIX: Attempt to clean up common LLM output issues ---
-            # Remove any trailing commas that might exist before the closing bracket
-            json_string = re.sub(r',\s*]', ']', json_string)
-            
-            try:
-                scenes = json.loads(json_string)
-            except json.JSONDecodeError as e:
-                print(f"Failed to parse cleaned JSON: {e}", file=sys.stderr)
-                print(f"Problematic JSON string: {json_string}", file=sys.stderr)
-                raise
-        else:
-            raise ValueError("Failed to find a valid JSON array in LLM output.")
-        
-        if not scenes:
-            raise ValueError("No scenes generated by LLM")
-
-        print("Story script generated successfully.")
-
-        print("Loading video generation models...")
-        image_model_path = os.path.join(os.path.dirname(__file__), 'models', 'juggernautXL_v9.safetensors')
-        image_pipeline = StableDiffusionPipeline.from_single_file(
-            image_model_path,
-            torch_dtype=torch.float16,
-            use_safetensors=True
-        )
-        svd_pipeline = StableVideoDiffusionPipeline.from_pretrained(
-            "stabilityai/stable-video-diffusion-img2vid-xt",
-            torch_dtype=torch.float16,
-            variant="fp16"
-        )
-
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        image_pipeline.to(device)
-        svd_pipeline.to(device)
+    log("Generating story script from text using LLM...")
 
-    except Exception as e:
-        print(f"Error loading models or generating script: {e}", file=sys.stderr)
-        sys.exit(1)
+    with EVENTS.stage("load_llm"):
+        llm_pipeline = acquire_model("gptj", load_llm, torch.float16 if torch.cuda.is_available() else torch.float32)
+
+    # Stories longer than the prompt's budget are summarised chunk by chunk first
+    file_content, condense_stats = scene_planner.condense(llm_pipeline, file_content)
+    if condense_stats["levels"]:
+        log(f"Condensed a {condense_stats['document_tokens']}-token story to {condense_stats['condensed_tokens']} tokens "
+            f"in {len(condense_stats['levels'])} summarisation pass(es).")
+
+    # Constrained to the [{"prompt": ...}] shape and stopped as soon as the array closes
+    # (scene_planner.SceneArrayConstraint), so the completion parses as it is
+    with PROFILER.torch_profile("plan_scenes"):
+        scenes, _ = scene_planner.plan_scenes(llm_pipeline, file_content)
+    # GPT-J is not needed again in this job: free its ~12 GB before any image model loads
+    del llm_pipeline
+    residency.default_manager.drop("gptj", reason="script done")
+
+    log("Story script generated successfully.")
+    job.write_json("scenes.json", scenes)
+    return scenes
+
+
+def acquire_model(name, load, dtype):
+    """
+    Loads one of the job's models through the residency manager, so its footprint is
+    accounted for and drop() frees it (each stage drops its model before the next loads).
+    """
+    cuda = torch.cuda.is_available()
+    return residency.default_manager.acquire(
+        name, load, residency.footprint_mb(name, dtype),
+        tier="vram" if cuda else "ram",
+        working_vram_mb=residency.WORKING_VRAM_MB.get(name, 0) if cuda else 0,
+    )
+
+
+def load_llm():
+    return pipeline(
+        "text-generation",
+        model="EleutherAI/gpt-j-6B",
+        device=0 if torch.cuda.is_available() else -1,
+        torch_dtype=torch.float16 if torch.cuda.is_available() else None,
+    )
 
-    all_video_frames = []
-    for i, scene in enumerate(scenes):
-        try:
-            print(f"Generating image for scene {i+1}: {scene['prompt']}")
-            starting_image = image_pipeline(
-                scene['prompt'],
-                negative_prompt="blurry, low quality, distorted, bad anatomy",
-                num_inference_steps=30,
-                guidance_scale=9.0
-            ).images[0]
-            starting_image = starting_image.resize((1024, 576))
-            
-            # 
-            
-            print("Generating video frames...")
-            video_frames = svd_pipeline(
-                starting_image,
-                num_frames=25,
-                decode_chunk_size=8,
-                motion_bucket_id=140,
-                noise_aug_strength=0.01
-            ).frames[0]
 
-            all_video_frames.extend(video_frames)
+def load_image_pipeline(device):
+    image_model_path = os.path.join(os.path.dirname(__file__), 'models', 'juggernautXL_v9.safetensors')
+    image_pipeline = StableDiffusionPipeline.from_single_file(
+        image_model_path,
+        torch_dtype=torch.float16,
+        use_safetensors=True
+    )
+    image_pipeline.to(device)
+    # With --profile, VAE decoding shows up as its own span inside keyframe
+    profiling.instrument(image_pipeline.vae, "decode", "vae_decode")
+    return image_pipeline
+
+
+def load_video_pipeline(device):
+    svd_pipeline = StableVideoDiffusionPipeline.from_pretrained(
+        "stabilityai/stable-video-diffusion-img2vid-xt",
+        torch_dtype=torch.float16,
+        variant="fp16"
+    )
+    svd_pipeline.to(device)
+    # With --profile, VAE decoding shows up as its own span inside encode_scene
+    profiling.instrument(svd_pipeline, "decode_latents", "vae_decode")
+    return svd_pipeline
+
+
+def _valid_image(path, metadata):
+    with Image.open(path) as image:
+        image.verify()
+
+
+def _valid_segment(path, metadata):
+    video_encoder.validate_mp4(path, metadata["frames"])
+
+
+def keyframe_name(index):
+    return f"keyframes/scene_{index + 1:03d}.png"
+
+
+def segment_name(index):
+    return f"segments/scene_{index + 1:03d}.mp4"
 
+
+def generate_story_video(file_path, content_id, resume=False):
+    # Every finished stage is kept in storage/jobs/<content_id>; with resume=True a rerun
+    # skips whatever is already there and valid (see job_workdir.py)
+    job = job_workdir.JobWorkdir(content_id, resume=resume, source_path=file_path)
+    if job.resumed:
+        log(f"Resuming job from {job.root}")
+        EVENTS.emit("job_resumed", artifacts=sorted(job.manifest["artifacts"]))
+
+    # The job runs as explicit model stages, each of which drops its model before the next
+    # one loads: GPT-J (script) -> SDXL (keyframes) -> SVD (animate). Only one large model
+    # is ever resident, so peak memory is the largest single stage rather than their sum.
+    # The measured peak RSS/VRAM of every stage is logged and emitted as "stage_memory".
+    memory = profiling.StageMemory()
+    try:
+        with memory.stage("script"):
+            file_content = extract_story_text(job, file_path)
+            scenes = plan_story_scenes(job, file_content)
+        EVENTS.emit("scenes_planned", count=len(scenes))
+    except Exception as e:
+        fail(f"Error loading models or generating script: {e}")
+
+    # Only load the models that the remaining scenes need
+    pending = [i for i in range(len(scenes)) if not job.done(segment_name(i), validate=_valid_segment)]
+    need_keyframes = [i for i in pending if not job.done(keyframe_name(i), validate=_valid_image)]
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    # The scene loop is a small producer/consumer pipeline (stage_pipeline.py). The calling
+    # thread runs the GPU stages (keyframe, animate, decode); PNG writes and the ffmpeg encode
+    # of each decoded chunk run on worker threads behind bounded queues, so they overlap the
+    # next chunk's decode and the next scene's denoising. Each scene goes into its own segment,
+    # joined losslessly at the end, so a failed scene never leaves partial frames behind.
+    clock = stage_pipeline.StageClock()
+    encoders = {}    # scene index -> VideoEncoder, touched only by the encode worker
+    failed = {}      # scene index -> error, from any stage
+
+    def write_keyframe(item):
+        i, image = item
+        try:
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG")
+            job.write_bytes(keyframe_name(i), buffer.getvalue())
+        except Exception as e:
+            # Only resume loses out: the scene itself already has its keyframe in memory
+            log(f"Warning: could not save the keyframe for scene {i+1}: {e}")
+
+    def encode_chunk(item):
+        kind, i, frames = item
+        if kind == "abort":
+            # Queued after the main thread marked the scene failed, so handled before that check
+            if i in encoders:
+                encoders.pop(i).abort()
+            return
+        if i in failed:
+            return
+        try:
+            if kind == "frames":
+                if i not in encoders:
+                    encoders[i] = video_encoder.VideoEncoder(job.path(segment_name(i)), fps=VIDEO_FPS)
+                encoders[i].write_frames(frames)
+            elif kind == "end":
+                # Popped only once close() succeeded, so a failed close is aborted below
+                summary = encoders[i].close()
+                del encoders[i]
+                job.record(segment_name(i), frames=summary["frames"])
+                EVENTS.emit("scene_encoded", scene=i + 1, total_scenes=len(scenes), frames=summary["frames"])
+        except Exception as e:
+            failed[i] = e
+            if i in encoders:
+                encoders.pop(i).abort()
+            print(f"Error encoding video for scene {i+1}: {e}", file=sys.stderr)
+            EVENTS.warning(f"Scene {i+1} skipped: {e}")
+
+    keyframe_writer = stage_pipeline.StageWorker("keyframe_write", write_keyframe, max_pending=2)
+    # Two chunks in flight (at 1024x576 and decode_chunk_size 8, ~14 MB each)
+    frame_encoder = stage_pipeline.StageWorker("encode", encode_chunk, max_pending=2)
+    loop_start = time.perf_counter()
+
+    # Every missing keyframe first, in as few batched denoise calls as memory allows
+    # (keyframes.py); the PNGs are written in the background while animation starts
+    starting_images = {}
+    if need_keyframes:
+        prompts = [scenes[i]['prompt'] for i in need_keyframes]
+        keyframe_failures = {}
+        try:
+            with memory.stage("keyframes"):
+                log("Loading image generation model...")
+                with EVENTS.stage("load_image_model"):
+                    image_pipeline = acquire_model("sdxl", lambda: load_image_pipeline(device), torch.float16)
+                log(f"Generating {len(prompts)} keyframes...")
+                with EVENTS.stage("keyframes", count=len(prompts)), clock.stage("keyframe"):
+                    images = keyframes.render_keyframes(
+                        image_pipeline,
+                        prompts,
+                        keyframes.batch_size(image_pipeline, len(prompts), device),
+                        negative_prompt=KEYFRAME_NEGATIVE_PROMPT,
+                        num_inference_steps=KEYFRAME_STEPS,
+                        guidance_scale=KEYFRAME_GUIDANCE,
+                        failures=keyframe_failures,
+                    )
+                # Every keyframe that could be rendered exists now, so SDXL is done before SVD loads
+                del image_pipeline
+                residency.default_manager.drop("sdxl", reason="keyframes done")
+        except Exception as e:
+            fail(f"Error generating keyframes: {e}")
+        for index, e in keyframe_failures.items():
+            # Only the scenes whose prompt failed on its own are lost
+            failed[need_keyframes[index]] = e
+            print(f"Error generating keyframe for scene {need_keyframes[index]+1}: {e}", file=sys.stderr)
+            EVENTS.warning(f"Scene {need_keyframes[index]+1} skipped: {e}")
+        for i, image in zip(need_keyframes, images):
+            if image is None:
+                continue
+            starting_images[i] = image.resize((1024, 576))
+            keyframe_writer.submit((i, starting_images[i]))
+
+    with memory.stage("animate"):
+        if pending:
+            try:
+                log("Loading video generation model...")
+                with EVENTS.stage("load_video_model", pending_scenes=len(pending)):
+                    svd_pipeline = acquire_model("svd_xt", lambda: load_video_pipeline(device), torch.float16)
+            except Exception as e:
+                fail(f"Error loading the video model: {e}")
+
+        for i, scene in enumerate(scenes):
+            if i not in pending:
+                log(f"Scene {i+1}: reusing the clip from the earlier run.")
+                EVENTS.emit("scene_reused", scene=i + 1, total_scenes=len(scenes))
+                continue
+            if i in failed:
+                continue # Its keyframe failed; already reported
+            try:
+                if i in starting_images:
+                    starting_image = starting_images.pop(i)
+                else:
+                    log(f"Scene {i+1}: reusing the keyframe from the earlier run.")
+                    with Image.open(job.path(keyframe_name(i))) as keyframe:
+                        starting_image = keyframe.convert("RGB")
+
+                log("Generating video frames...")
+                # Re-planned per scene, from the memory that is free at that point
+                svd_plan = svd_planner.plan(device, svd_pipeline.unet.dtype, num_frames=SCENE_FRAMES, offloaded=False)
+                svd_planner.log_plan(svd_plan)
+                with EVENTS.stage("animate", scene=i + 1, total_scenes=len(scenes)), PROFILER.torch_profile(f"animate_{i+1}"), \
+                        clock.stage("animate"):
+                    latents = svd_planner.denoise(
+                        svd_pipeline,
+                        starting_image,
+                        svd_plan,
+                        motion_bucket_id=140,
+                        noise_aug_strength=0.01,
+                        **pipeline_callback_kwargs(StepProgress(f"animate_{i+1}", 25))
+                    )
+
+                with EVENTS.stage("decode_scene", scene=i + 1, total_scenes=len(scenes)):
+                    chunks = svd_planner.decode_chunks(svd_pipeline, latents, svd_plan)
+                    while True:
+                        with clock.stage("decode"):
+                            frames = next(chunks, None)
+                        if frames is None:
+                            break
+                        frame_encoder.submit(("frames", i, frames))
+                frame_encoder.submit(("end", i, None))
+
+            except Exception as e:
+                failed[i] = e
+                frame_encoder.submit(("abort", i, None))
+                print(f"Error generating video for scene {i+1}: {e}", file=sys.stderr)
+                EVENTS.warning(f"Scene {i+1} skipped: {e}")
+                continue
+
+        try:
+            keyframe_writer.close()
+            frame_encoder.close()
         except Exception as e:
-            print(f"Error generating video for scene {i+1}: {e}", file=sys.stderr)
-            continue
+            fail(f"Error encoding scenes: {e}")
+        if pending:
+            del svd_pipeline
+            residency.default_manager.drop("svd_xt", reason="scenes done")
+        stage_pipeline.utilisation(time.perf_counter() - loop_start, clock, [keyframe_writer, frame_encoder])
 
-    if not all_video_frames:
-        print("No video frames were generated.", file=sys.stderr)
-        sys.exit(1)
+    segment_paths = [job.path(segment_name(i)) for i in range(len(scenes)) if job.done(segment_name(i))]
+
+    if not segment_paths:
+        fail("No video frames were generated.")
 
     output_dir = os.path.join(os.path.dirname(__file__), '..', 'storage', 'videos')
     os.makedirs(output_dir, exist_ok=True)
@@ -161,21 +351,32 @@ def generate_story_video(file_path, content_id):
     output_path = os.path.join(output_dir, output_filename)
 
     try:
-        print("Stitching scenes together into a final video...")
-        export_to_video(all_video_frames, output_path, fps=8)
-        print(f"storage/videos/{output_filename}") # The app.js script expects this path to be printed to stdout
+        log("Stitching scenes together into a final video...")
+        with memory.stage("export"), EVENTS.stage("export", segments=len(segment_paths)):
+            video_encoder.concat_segments(segment_paths, output_path)
     except Exception as e:
-        print(f"Error saving final video: {e}", file=sys.stderr)
-        sys.exit(1)
+        fail(f"Error saving final video: {e}")
+    EVENTS.emit("stage_memory", stages=memory.stages)
+
+    if len(segment_paths) == len(scenes):
+        job.remove()
+    else:
+        # Keep the finished scenes so a --resume run only has to render the skipped ones
+        log(f"{len(scenes) - len(segment_paths)} scene(s) were skipped; rerun with --resume to render them.")
+
+    EVENTS.result(path=f"storage/videos/{output_filename}", scenes=len(scenes))
+    print(f"storage/videos/{output_filename}") # The app.js script expects this path to be printed to stdout
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 2:
-        file_path_arg = sys.argv[1]
-        content_id_arg = sys.argv[2]
-        generate_story_video(file_path_arg, content_id_arg)
+    profiling.enable_from_argv()
+    # --resume reuses the finished stages in storage/jobs/<content_id>
+    resume = "--resume" in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg != "--resume"]
+    if len(args) > 1:
+        generate_story_video(args[0], args[1], resume)
     else:
-        print("Usage: python story_to_video_gen.py <file_path> <content_id>", file=sys.stderr)
+        print("Usage: python story_to_video_gen.py <file_path> <content_id> [--resume] [--profile] [--torch-profile]", file=sys.stderr)
         sys.exit(1)
 
 
@@ -0,0 +1,232 @@
+# ml_scripts/svd_planner.py
+#
+# Chooses Stable Video Diffusion's num_frames and decode_chunk_size from the memory that is
+# actually free when the clip is rendered, instead of the values hard-coded after OOM crashes
+# on one particular card. The requested frame count is kept whenever the denoising working
+# set fits; decode_chunk_size is the largest that fits next to it.
+#
+# The per-frame costs below are estimates for 1024x576 fp16 (scaled for other sizes, and x2
+# for fp32 on CPU). Every plan and every fallback is logged to stderr and emitted as an
+# "svd_plan" event, so they can be tuned per host:
+#   ML_SVD_UNET_MB_PER_FRAME    denoising activations per frame (default 120)
+#   ML_SVD_DECODE_MB_PER_FRAME  VAE decode memory per frame in a chunk (default 550)
+#   ML_SVD_MAX_DECODE_CHUNK     upper bound for decode_chunk_size (default 14)
+#
+# If a run still runs out of memory, it is retried instead of failing the job: denoising
+# retries with UNet forward chunking, then with fewer frames; decoding retries the current
+# chunk at half the size (the denoised latents are kept, so it does not repeat denoising).
+# Decoded chunks are yielded as uint8 arrays for video_encoder.py, one chunk at a time.
+import os
+import sys
+
+from events import EVENTS
+
+REFERENCE_PIXELS = 1024 * 576
+MIN_FRAMES = 14 # SVD's shortest trained clip length
+UNET_MB_PER_FRAME = float(os.environ.get("ML_SVD_UNET_MB_PER_FRAME", "120"))
+DECODE_MB_PER_FRAME = float(os.environ.get("ML_SVD_DECODE_MB_PER_FRAME", "550"))
+MAX_DECODE_CHUNK = int(os.environ.get("ML_SVD_MAX_DECODE_CHUNK", "14"))
+UNET_WEIGHTS_MB = 3000 # fp16 UNet, brought onto the GPU per call under model CPU offload
+VAE_WEIGHTS_MB = 200
+SAFETY_FRACTION = 0.85 # Headroom for fragmentation and the allocator's own caches
+
+
+def free_memory_mb(device):
+    """Memory available to the next allocation: free VRAM on CUDA, MemAvailable on CPU."""
+    if device == "cuda":
+        import torch
+        free_bytes, _ = torch.cuda.mem_get_info()
+        # Blocks cached by PyTorch's allocator are free for PyTorch too
+        free_bytes += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+        return free_bytes / (1024 * 1024)
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.virtual_memory().available / (1024 * 1024)
+    except ImportError:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES") / (1024 * 1024)
+
+
+def is_out_of_memory(error):
+    if isinstance(error, MemoryError):
+        return True
+    try:
+        import torch
+        if isinstance(error, torch.cuda.OutOfMemoryError):
+            return True
+    except (ImportError, AttributeError):
+        pass
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+
+def free_cached_memory():
+    import gc
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+class SvdPlan:
+    def __init__(self, num_frames, decode_chunk_size, requested_frames, free_mb, budget_mb, device, height, width):
+        self.num_frames = num_frames
+        self.decode_chunk_size = decode_chunk_size
+        self.requested_frames = requested_frames
+        self.free_mb = free_mb
+        self.budget_mb = budget_mb
+        self.device = device
+        self.height = height
+        self.width = width
+        self.forward_chunking = False
+        self.notes = []
+        self.over_budget = False
+
+    def as_dict(self):
+        return {
+            "num_frames": self.num_frames,
+            "decode_chunk_size": self.decode_chunk_size,
+            "requested_frames": self.requested_frames,
+            "free_mb": round(self.free_mb),
+            "budget_mb": round(self.budget_mb),
+            "device": self.device,
+            "size": [self.width, self.height],
+            "forward_chunking": self.forward_chunking,
+            "over_budget": self.over_budget,
+            "notes": self.notes,
+        }
+
+
+def plan(device, dtype, num_frames=25, height=576, width=1024, offloaded=True, free_mb=None):
+    """
+    Returns the SvdPlan for a `num_frames` clip at `width`x`height`. `offloaded` means the
+    UNet weights are not on the device yet (model CPU offload), so they count against the
+    denoising budget; `free_mb` overrides the measurement (for tests and dry runs).
+    """
+    free_mb = free_memory_mb(device) if free_mb is None else free_mb
+    budget_mb = free_mb * SAFETY_FRACTION
+    scale = (height * width) / REFERENCE_PIXELS * (1 if "16" in str(dtype) else 2)
+    unet_weights_mb = UNET_WEIGHTS_MB * (1 if "16" in str(dtype) else 2) if offloaded and device == "cuda" else 0
+
+    def denoise_mb(frames):
+        return unet_weights_mb + frames * UNET_MB_PER_FRAME * scale
+
+    def decode_mb(chunk):
+        return VAE_WEIGHTS_MB + chunk * DECODE_MB_PER_FRAME * scale
+
+    result = SvdPlan(num_frames, 1, num_frames, free_mb, budget_mb, device, height, width)
+
+    frames = num_frames
+    while frames > MIN_FRAMES and denoise_mb(frames) > budget_mb:
+        frames -= 1
+    if frames < num_frames:
+        result.notes.append(f"frames reduced {num_frames}->{frames}: denoising needs ~{denoise_mb(num_frames):.0f} MB")
+    result.num_frames = frames
+
+    chunk = max(1, min(frames, MAX_DECODE_CHUNK))
+    while chunk > 1 and decode_mb(chunk) > budget_mb:
+        chunk -= 1
+    result.decode_chunk_size = chunk
+
+    if denoise_mb(frames) > budget_mb or decode_mb(chunk) > budget_mb:
+        result.over_budget = True
+        result.notes.append("minimum settings exceed the estimated budget; relying on OOM fallback")
+    return result
+
+
+def log_plan(svd_plan, stage="plan"):
+    details = "; ".join(svd_plan.notes) or "requested length fits"
+    sys.stderr.write(
+        f"SVD {stage}: {svd_plan.num_frames} frames, decode_chunk_size={svd_plan.decode_chunk_size} "
+        f"({svd_plan.free_mb:.0f} MB free on {svd_plan.device}, budget {svd_plan.budget_mb:.0f} MB; {details})\n"
+    )
+    EVENTS.emit("svd_plan", stage=stage, **svd_plan.as_dict())
+
+
+def denoise(svd_pipeline, image, svd_plan, **kwargs):
+    """Runs the SVD denoising loop under `svd_plan` and returns the latents, retrying on OOM."""
+    while True:
+        try:
+            return svd_pipeline(
+                image,
+                height=svd_plan.height,
+                width=svd_plan.width,
+                num_frames=svd_plan.num_frames,
+                decode_chunk_size=svd_plan.decode_chunk_size,
+                output_type="latent",
+                **kwargs
+            ).frames
+        except Exception as e:
+            if not is_out_of_memory(e):
+                raise
+            free_cached_memory()
+            if not svd_plan.forward_chunking:
+                # Same output, lower peak: feed-forward layers run one frame chunk at a time
+                svd_pipeline.unet.enable_forward_chunking()
+                svd_plan.forward_chunking = True
+                svd_plan.notes.append("denoise OOM: enabled UNet forward chunking")
+            elif svd_plan.num_frames > MIN_FRAMES:
+                frames = max(MIN_FRAMES, svd_plan.num_frames * 3 // 4)
+                svd_plan.notes.append(f"denoise OOM: frames {svd_plan.num_frames}->{frames}")
+                svd_plan.num_frames = frames
+                svd_plan.decode_chunk_size = min(svd_plan.decode_chunk_size, frames)
+            else:
+                raise
+            log_plan(svd_plan, stage="fallback")
+
+
+def frames_to_uint8(frames):
+    """[1, C, F, H, W] float frames in [-1, 1] -> F x H x W x 3 uint8 array (as the pipeline's postprocess)."""
+    import torch
+    frames = (frames[0].permute(1, 2, 3, 0) / 2 + 0.5).clamp(0, 1)
+    return (frames * 255).round().to(torch.uint8).cpu().numpy()
+
+
+def decode_chunks(svd_pipeline, latents, svd_plan):
+    """
+    Decodes denoised latents `decode_chunk_size` frames at a time and yields each chunk as an
+    N x H x W x 3 uint8 array, so frames can be encoded while the rest are still decoding.
+    On OOM the chunk is retried at half the size.
+    """
+    import torch
+
+    # The pipeline upcasts the VAE for image encoding and only casts it back when it decodes
+    # itself; output_type="latent" skips that, so do it here
+    if latents.dtype == torch.float16 and svd_pipeline.vae.dtype != torch.float16:
+        svd_pipeline.vae.to(dtype=torch.float16)
+
+    start = 0
+    total = latents.shape[1]
+    while start < total:
+        chunk = latents[:, start:start + svd_plan.decode_chunk_size]
+        try:
+            with torch.no_grad():
+                frames = svd_pipeline.decode_latents(chunk, chunk.shape[1], chunk.shape[1])
+        except Exception as e:
+            if not is_out_of_memory(e) or svd_plan.decode_chunk_size <= 1:
+                raise
+            free_cached_memory()
+            size = svd_plan.decode_chunk_size // 2
+            svd_plan.notes.append(f"decode OOM: decode_chunk_size {svd_plan.decode_chunk_size}->{size}")
+            svd_plan.decode_chunk_size = size
+            log_plan(svd_plan, stage="fallback")
+            continue
+        start += chunk.shape[1]
+        yield frames_to_uint8(frames)
+
+
+def render_clip(svd_pipeline, image, svd_plan, encoder, **kwargs):
+    """Denoises one clip under `svd_plan` and streams its decoded frames into `encoder`."""
+    latents = denoise(svd_pipeline, image, svd_plan, **kwargs)
+    for frames in decode_chunks(svd_pipeline, latents, svd_plan):
+        encoder.write_frames(frames)
+    return svd_plan.num_frames
@@ -1,77 +1,177 @@
 import sys
 import os
-import torch
 import random
-from diffusers import StableDiffusionPipeline, StableVideoDiffusionPipeline
-from diffusers.utils import export_to_video
+import argparse
+from inference_client import call_server, InferenceServerError
+import quality_tiers
+import svd_planner
+import video_encoder
+from events import EVENTS, StepProgress, pipeline_callback_kwargs, fail
+import profiling
+from profiling import PROFILER
 
-def generate_svd_video(prompt, content_id):
+# The keyframe only seeds the animation: 25 DPM-Solver++ steps (was 25 steps of the default scheduler)
+DEFAULT_QUALITY = "standard"
+SVD_INFERENCE_STEPS = 25 # StableVideoDiffusionPipeline's default, made explicit for progress reporting
+VIDEO_FPS = 10 # Playback rate (export_to_video's default); the fps=7 passed to SVD is motion conditioning
+DEFAULT_NUM_FRAMES = 25 # SVD-XT's trained length; svd_planner.py shortens it only if memory is short
+
+# torch/diffusers are imported inside the functions below so that the thin-client
+# path (a resident inference_server.py is running) never pays their import cost.
+
+def get_device():
+    import sd_components
+    return sd_components.select_device()
+
+
+def load_image_pipeline(device):
+    """Phase 1 model: the shared Stable Diffusion 1.5 txt2img view for the starting keyframe."""
+    import sd_components
+    return sd_components.get_pipeline("txt2img", device)
+
+
+def load_video_pipeline(device):
+    """Phase 2 model: Stable Video Diffusion XT, kept resident by residency.py between jobs."""
+    import torch
+    import residency
+
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    return residency.default_manager.acquire(
+        f"svd_xt@{device}",
+        lambda: _load_video_pipeline(device, dtype),
+        footprint_mb=residency.footprint_mb("svd_xt", dtype),
+        # With model CPU offload the weights live in RAM and visit the GPU one module at a time
+        tier="ram",
+        working_vram_mb=residency.WORKING_VRAM_MB["svd_xt"] if device == "cuda" else 0,
+    )
+
+
+def _load_video_pipeline(device, dtype):
+    from diffusers import StableVideoDiffusionPipeline
+
+    svd_pipeline = StableVideoDiffusionPipeline.from_pretrained(
+        "stabilityai/stable-video-diffusion-img2vid-xt",
+        torch_dtype=dtype,
+        variant="fp16" if device == "cuda" else None
+    )
+
+    if device == "cuda":
+        # This is the magic line for lower VRAM (8GB-12GB cards)
+        svd_pipeline.enable_model_cpu_offload()
+    else:
+        svd_pipeline.to("cpu")
+    # With --profile, frame decoding shows up as its own span inside "animate"
+    profiling.instrument(svd_pipeline, "decode_latents", "vae_decode")
+    return svd_pipeline
+
+
+def render_keyframe(pipeline, prompt, quality=None):
+    """Generates the starting image for the clip with a fresh random seed."""
+    import torch
+
+    num_inference_steps = quality_tiers.apply_tier(pipeline, quality or DEFAULT_QUALITY)
+    final_seed = random.randint(1, 1000000000)
+    generator = torch.Generator(pipeline.device).manual_seed(final_seed)
+
+    return pipeline(
+        prompt,
+        num_inference_steps=num_inference_steps,
+        generator=generator,
+        **pipeline_callback_kwargs(StepProgress("keyframe", num_inference_steps))
+    ).images[0]
+
+
+def render_video(svd_pipeline, starting_image, content_id, num_frames=DEFAULT_NUM_FRAMES):
+    """Animates the starting image and saves the clip. Returns the relative output path."""
+    # Frame count and decode chunk size are sized to the memory free right now (svd_planner.py)
+    # Under model CPU offload, .device is "cpu" while the modules run on the GPU
+    device = getattr(svd_pipeline, "_execution_device", svd_pipeline.device).type
+    svd_plan = svd_planner.plan(device, svd_pipeline.unet.dtype, num_frames=num_frames)
+    svd_planner.log_plan(svd_plan)
+
+    with EVENTS.stage("animate", num_frames=svd_plan.num_frames), PROFILER.torch_profile("animate"):
+        latents = svd_planner.denoise(
+            svd_pipeline,
+            starting_image,
+            svd_plan,
+            motion_bucket_id=100,
+            fps=7,
+            num_inference_steps=SVD_INFERENCE_STEPS,
+            **pipeline_callback_kwargs(StepProgress("animate", SVD_INFERENCE_STEPS))
+        )
+
+    output_dir = os.path.join(os.path.dirname(__file__), '..', 'storage', 'videos')
+    os.makedirs(output_dir, exist_ok=True)
+
+    output_filename = f"video_{content_id}.mp4"
+    output_path = os.path.join(output_dir, output_filename)
+
+    # Each decoded chunk goes straight to ffmpeg; the MP4 is validated before it is moved into place
+    with EVENTS.stage("export", decode_chunk_size=svd_plan.decode_chunk_size):
+        with video_encoder.VideoEncoder(output_path, fps=VIDEO_FPS) as encoder:
+            for frames in svd_planner.decode_chunks(svd_pipeline, latents, svd_plan):
+                encoder.write_frames(frames)
+    return f"storage/videos/{output_filename}"
+
+
+def generate_svd_video(prompt, content_id, quality=None, num_frames=DEFAULT_NUM_FRAMES):
+    try:
+        with EVENTS.stage("remote_generate"):
+            result = call_server("generate_svd_video", {
+                "prompt": prompt, "content_id": content_id, "quality": quality, "num_frames": num_frames
+            }, on_event=EVENTS.forward)
+    except InferenceServerError as e:
+        fail(f"CRITICAL ERROR: {e}")
+
+    if result is not None:
+        EVENTS.result(path=result["path"])
+        print(result["path"]) # Clean path for Node.js
+        return
+
+    # No server running: load both phases in this process, one at a time
     # 1. Setup Device
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = get_device()
     sys.stderr.write(f"Using device: {device}\n")
 
     try:
         # 2. Load Base Image Model (Phase 1)
         sys.stderr.write("Loading Phase 1: Image Model...\n")
-        pipeline = StableDiffusionPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5", 
-            torch_dtype=torch.float16 if device == "cuda" else torch.float32
-        )
-        pipeline.to(device)
+        with EVENTS.stage("load_image_model"):
+            pipeline = load_image_pipeline(device)
 
         # Generate the starting image
-        final_seed = random.randint(1, 1000000000)
-        generator = torch.Generator(device).manual_seed(final_seed)
-        
-        starting_image = pipeline(
-            prompt,
-            num_inference_steps=25,
-            generator=generator
-        ).images[0]
-
-        # 3. CLEAN UP MEMORY BEFORE PHASE 2
-        del pipeline # Remove image model from RAM/VRAM
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        with EVENTS.stage("keyframe", quality=quality or DEFAULT_QUALITY):
+            starting_image = render_keyframe(pipeline, prompt, quality)
+
+        # 3. MAKE ROOM FOR PHASE 2
+        # SVD's working set goes through the residency manager, which moves the SD weights
+        # to RAM (or drops them) only if the budgets require it
+        del pipeline
 
         # 4. Load Video Model (Phase 2)
         sys.stderr.write("Loading Phase 2: Video Model...\n")
-        svd_pipeline = StableVideoDiffusionPipeline.from_pretrained(
-            "stabilityai/stable-video-diffusion-img2vid-xt",
-            torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-            variant="fp16" if device == "cuda" else None
-        )
-        
-        if device == "cuda":
-            # This is the magic line for lower VRAM (8GB-12GB cards)
-            svd_pipeline.enable_model_cpu_offload() 
-        else:
-            svd_pipeline.to("cpu")
-
-        video_frames = svd_pipeline(
-            starting_image,
-            num_frames=25, # Reduced from 40 to prevent OOM crash
-            decode_chunk_size=4, # Lower chunks = less VRAM
-            motion_bucket_id=100,
-            fps=7
-        ).frames[0]
+        with EVENTS.stage("load_video_model"):
+            svd_pipeline = load_video_pipeline(device)
+
+        # 5. Animate and Save the Video
+        relative_path = render_video(svd_pipeline, starting_image, content_id, num_frames)
 
     except Exception as e:
-        sys.stderr.write(f"CRITICAL ERROR: {e}\n")
-        sys.exit(1)
+        fail(f"CRITICAL ERROR: {e}")
 
-    # 5. Save the Video
-    output_dir = os.path.join(os.path.dirname(__file__), '..', 'storage', 'videos')
-    os.makedirs(output_dir, exist_ok=True)
-    
-    output_filename = f"video_{content_id}.mp4"
-    output_path = os.path.join(output_dir, output_filename)
-    
-    export_to_video(video_frames, output_path)
-    print(f"storage/videos/{output_filename}") # Clean path for Node.js
+    EVENTS.result(path=relative_path)
+    print(relative_path) # Clean path for Node.js
 
 if __name__ == "__main__":
-    if len(sys.argv) > 2:
-        generate_svd_video(sys.argv[1], sys.argv[2])
-    else:
-        sys.exit(1)
\ No newline at end of file
+    parser = argparse.ArgumentParser(usage="python svd_video_gen.py <prompt> <content_id> [--quality draft|standard|max]")
+    parser.add_argument("prompt")
+    parser.add_argument("content_id")
+    parser.add_argument("--quality", choices=quality_tiers.tier_names(), default=DEFAULT_QUALITY,
+                        help="Quality tier for the starting keyframe")
+    parser.add_argument("--num-frames", type=int, default=DEFAULT_NUM_FRAMES,
+                        help="Requested clip length; shortened only if free memory cannot fit it")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+
+    generate_svd_video(args.prompt, args.content_id, args.quality, args.num_frames)
@@ -0,0 +1,225 @@
+# ml_scripts/video_encoder.py
+#
+# Streaming MP4 encoder shared by the video scripts. Frames are written as uint8 RGB arrays
+# (H x W x 3, or N x H x W x 3 batches) straight into an ffmpeg process reading rawvideo on
+# stdin, as soon as they are decoded. No list of PIL images is ever built, so peak memory
+# does not grow with clip length.
+#
+# The MP4 is written to a temporary file and only moved into place once ffmpeg has exited
+# cleanly and the file decodes to the number of frames that were written.
+# concat_segments() joins clips written with the same settings without re-encoding them.
+#
+#   FFMPEG_PATH        ffmpeg binary (default: imageio-ffmpeg's bundled binary, then PATH)
+#   ML_VIDEO_CODEC     default libx264
+#   ML_VIDEO_CRF       default 18 (visually lossless for x264)
+#   ML_VIDEO_PRESET    default medium
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+VIDEO_CODEC = os.environ.get("ML_VIDEO_CODEC", "libx264")
+VIDEO_CRF = int(os.environ.get("ML_VIDEO_CRF", "18"))
+VIDEO_PRESET = os.environ.get("ML_VIDEO_PRESET", "medium")
+
+
+class VideoEncoderError(RuntimeError):
+    pass
+
+
+def ffmpeg_path():
+    if os.environ.get("FFMPEG_PATH"):
+        return os.environ["FFMPEG_PATH"]
+    try:
+        import imageio_ffmpeg # Installed with diffusers' video export dependencies
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        pass
+    path = shutil.which("ffmpeg")
+    if path is None:
+        raise VideoEncoderError("ffmpeg not found: set FFMPEG_PATH or install imageio-ffmpeg.")
+    return path
+
+
+def count_frames(path):
+    """Decodes the video stream of `path` to a null sink and returns its frame count."""
+    process = subprocess.run(
+        [ffmpeg_path(), "-hide_banner", "-nostdin", "-i", path, "-map", "0:v:0", "-f", "null", "-"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors="replace",
+    )
+    if process.returncode != 0:
+        raise VideoEncoderError(f"{os.path.basename(path)} is not a readable video: {process.stderr.strip()[-500:]}")
+    matches = re.findall(r"frame=\s*(\d+)", process.stderr)
+    return int(matches[-1]) if matches else 0
+
+
+def validate_mp4(path, expected_frames):
+    """Raises VideoEncoderError unless `path` is an MP4 holding `expected_frames` frames."""
+    with open(path, "rb") as f:
+        header = f.read(12)
+    if header[4:8] != b"ftyp":
+        raise VideoEncoderError(f"{os.path.basename(path)} is not an MP4 file.")
+    frames = count_frames(path)
+    if frames != expected_frames:
+        raise VideoEncoderError(f"{os.path.basename(path)} has {frames} frames, expected {expected_frames}.")
+
+
+def concat_segments(segment_paths, output_path):
+    """
+    Joins MP4 segments encoded with identical settings into `output_path` with ffmpeg's
+    concat demuxer (stream copy, so lossless and fast), then validates the frame count.
+    """
+    expected_frames = sum(count_frames(path) for path in segment_paths)
+    temp_path = f"{output_path}.{os.getpid()}.partial.mp4"
+    list_path = f"{output_path}.{os.getpid()}.segments.txt"
+    with open(list_path, "w", encoding="utf-8") as f:
+        for path in segment_paths:
+            # The concat demuxer reads single-quoted paths; a quote is written as '\''
+            escaped = os.path.abspath(path).replace("\\", "/").replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+    start = time.perf_counter()
+    try:
+        process = subprocess.run(
+            [ffmpeg_path(), "-hide_banner", "-loglevel", "error", "-nostdin", "-y",
+             "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", "-movflags", "+faststart", "-f", "mp4", temp_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors="replace",
+        )
+        if process.returncode != 0:
+            raise VideoEncoderError(f"ffmpeg concat failed with exit code {process.returncode}: {process.stderr.strip()[-1000:]}")
+        validate_mp4(temp_path, expected_frames)
+        os.replace(temp_path, output_path)
+    finally:
+        for path in (list_path, temp_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    sys.stderr.write(f"Joined {len(segment_paths)} segments ({expected_frames} frames) into "
+                     f"{os.path.basename(output_path)} in {time.perf_counter() - start:.1f}s.\n")
+    return {"segments": len(segment_paths), "frames": expected_frames, "bytes": os.path.getsize(output_path)}
+
+
+class VideoEncoder:
+    """
+    Usage:
+        with VideoEncoder(output_path, fps=10) as encoder:
+            for chunk in frame_chunks:
+                encoder.write_frames(chunk)
+        encoder.summary  # {"frames": ..., "bytes": ..., "encode_seconds": ...}
+    The ffmpeg process starts with the first frame, which fixes the video size.
+    """
+
+    def __init__(self, output_path, fps, codec=None, crf=None, preset=None):
+        self.output_path = output_path
+        self.fps = fps
+        self.codec = codec or VIDEO_CODEC
+        self.crf = VIDEO_CRF if crf is None else crf
+        self.preset = preset or VIDEO_PRESET
+        self.temp_path = f"{output_path}.{os.getpid()}.partial.mp4"
+        self.process = None
+        self.stderr_file = None
+        self.size = None
+        self.frames_written = 0
+        self.start = None
+        self.summary = None
+
+    def _open(self, width, height):
+        self.size = (width, height)
+        command = [
+            ffmpeg_path(), "-hide_banner", "-loglevel", "error", "-y",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(self.fps), "-i", "-",
+            "-an", "-c:v", self.codec, "-preset", self.preset, "-crf", str(self.crf),
+            # yuv420p (for browser playback) needs even dimensions
+            "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p",
+            "-movflags", "+faststart", "-f", "mp4", self.temp_path,
+        ]
+        os.makedirs(os.path.dirname(os.path.abspath(self.output_path)), exist_ok=True)
+        # A file rather than a pipe, so a chatty ffmpeg can never block on a full stderr pipe
+        self.stderr_file = tempfile.TemporaryFile()
+        self.start = time.perf_counter()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.stderr_file)
+
+    def _ffmpeg_errors(self):
+        self.stderr_file.seek(0)
+        return self.stderr_file.read().decode("utf-8", errors="replace").strip()[-1000:]
+
+    def write(self, frame):
+        """Writes one frame: an H x W x 3 uint8 array (a PIL image is converted)."""
+        import numpy as np
+
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if frame.ndim != 3 or frame.shape[2] != 3:
+            raise ValueError(f"Expected an H x W x 3 RGB frame, got shape {frame.shape}.")
+        height, width = frame.shape[:2]
+        if self.process is None:
+            self._open(width, height)
+        elif (width, height) != self.size:
+            raise ValueError(f"Frame size {width}x{height} differs from the video's {self.size[0]}x{self.size[1]}.")
+
+        try:
+            self.process.stdin.write(memoryview(frame).cast("B"))
+        except (BrokenPipeError, OSError):
+            self.process.wait()
+            raise VideoEncoderError(f"ffmpeg exited while encoding: {self._ffmpeg_errors()}")
+        self.frames_written += 1
+
+    def write_frames(self, frames):
+        """Writes an N x H x W x 3 uint8 array, or any iterable of frames."""
+        for frame in frames:
+            self.write(frame)
+
+    def close(self):
+        """Finishes encoding, validates the MP4 and moves it into place. Returns a summary dict."""
+        if self.process is None:
+            raise VideoEncoderError("No frames were written.")
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise VideoEncoderError(f"ffmpeg failed with exit code {returncode}: {self._ffmpeg_errors()}")
+        self.stderr_file.close()
+
+        validate_mp4(self.temp_path, self.frames_written)
+        os.replace(self.temp_path, self.output_path)
+
+        elapsed = time.perf_counter() - self.start
+        self.summary = {
+            "frames": self.frames_written,
+            "bytes": os.path.getsize(self.output_path),
+            "encode_seconds": round(elapsed, 3),
+            "codec": self.codec,
+            "crf": self.crf,
+        }
+        sys.stderr.write(f"Encoded {self.frames_written} frames ({self.size[0]}x{self.size[1]}, {self.codec}, crf {self.crf}) "
+                         f"to {os.path.basename(self.output_path)} in {elapsed:.1f}s.\n")
+        return self.summary
+
+    def abort(self):
+        """Stops ffmpeg and removes the partial file."""
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        if self.stderr_file is not None:
+            self.stderr_file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+            return False
+        try:
+            self.close()
+        except BaseException:
+            self.abort()
+            raise
+        return False